@@ -0,0 +1,129 @@
+import datetime
+import time
+from collections import deque
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+# "22:00-22:09,tue 13:00-16:00" (UTC) -> [(weekday o None, minuto inicial, minuto final)]
+def parse_windows(value):
+    windows = []
+    for window in (value or "").split(","):
+        window = window.strip().lower()
+        if not window:
+            continue
+        weekday = None
+        if " " in window:
+            day, window = window.split(" ", 1)
+            weekday = WEEKDAYS.index(day[:3])
+        start, end = window.split("-")
+        windows.append((weekday, to_minutes(start), to_minutes(end)))
+    return windows
+
+
+def to_minutes(value):
+    hours, minutes = value.strip().split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+# Segundos que quedan de la ventana en la que está 'now', o 0 si no está en ninguna
+def window_remaining(windows, now):
+    minute = now.hour * 60 + now.minute + now.second / 60
+    for weekday, start, end in windows:
+        if weekday is not None and weekday != now.weekday():
+            continue
+        if start <= minute < end:
+            return (end - minute) * 60
+    return 0
+
+
+# Intervalo de sondeo adaptativo:
+#   - mínimo tras un cambio reciente (hot_period) o dentro de una ventana de lanzamientos (drop_windows)
+#   - el intervalo base mientras no pase 'quiet_after' sin cambios; después crece poco a poco hasta el máximo
+#   - con errores crece más rápido
+#   - no se sondea dentro de las ventanas de pausa y nunca se supera el presupuesto de peticiones por hora
+class AdaptivePoller(object):
+    def __init__(
+        self,
+        base,
+        min_interval,
+        max_interval,
+        requests_per_hour,
+        drop_windows="",
+        pause_windows="",
+        hot_period=900,
+        quiet_after=3600,
+        quiet_factor=1.25,
+        error_factor=2,
+    ):
+        self.base = base
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.requests_per_hour = requests_per_hour
+        self.drop_windows = parse_windows(drop_windows)
+        self.pause_windows = parse_windows(pause_windows)
+        self.hot_period = hot_period
+        self.quiet_after = quiet_after
+        self.quiet_factor = quiet_factor
+        self.error_factor = error_factor
+
+        self.interval = base
+        self.errors = 0
+        self.last_flip = None
+        self.started = time.monotonic()
+        self.requests = deque()
+
+    def record_requests(self, count):
+        now = time.monotonic()
+        self.requests.extend([now] * count)
+
+    def record_flip(self):
+        self.last_flip = time.monotonic()
+
+    def record_result(self, ok):
+        self.errors = 0 if ok else self.errors + 1
+
+    def pause_remaining(self):
+        return window_remaining(self.pause_windows, datetime.datetime.utcnow())
+
+    def budget_delay(self, cost):
+        now = time.monotonic()
+        while self.requests and now - self.requests[0] >= 3600:
+            self.requests.popleft()
+        excess = len(self.requests) + cost - self.requests_per_hour
+        if excess <= 0:
+            return 0
+        # Hay que esperar a que salgan de la última hora las 'excess' peticiones más antiguas
+        return 3600 - (now - self.requests[min(excess, len(self.requests)) - 1])
+
+    # Devuelve (segundos hasta la siguiente pasada, motivo)
+    def next_delay(self, cost):
+        now = datetime.datetime.utcnow()
+        since_flip = time.monotonic() - (self.last_flip if self.last_flip is not None else self.started)
+        hot = self.last_flip is not None and since_flip < self.hot_period
+
+        if self.errors:
+            self.interval = min(self.max_interval, self.base * self.error_factor**self.errors)
+            reason = "error"
+        elif hot:
+            self.interval = self.min_interval
+            reason = "flip"
+        elif window_remaining(self.drop_windows, now):
+            self.interval = self.min_interval
+            reason = "drop window"
+        elif since_flip < self.quiet_after:
+            self.interval = self.base
+            reason = "base"
+        else:
+            self.interval = min(self.max_interval, max(self.interval, self.min_interval) * self.quiet_factor)
+            reason = "quiet"
+
+        delay = self.interval
+        budget = self.budget_delay(cost)
+        if budget > delay:
+            delay, reason = budget, "budget"
+
+        pause = window_remaining(self.pause_windows, now + datetime.timedelta(seconds=delay))
+        if pause:
+            delay, reason = delay + pause, "pause"
+        return delay, reason
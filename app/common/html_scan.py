@@ -0,0 +1,220 @@
+import html as html_entities
+import re
+
+import lxml.etree
+import lxml.html
+import ujson
+
+# Extrae bloques <script> y atributos directamente del HTML, sin construir el DOM de toda la página.
+# El DOM completo (Page.document) solo se construye si algún parser lo pide (xpath/cssselect sobre la página).
+
+# Atributos de una etiqueta de apertura, con la misma gramática que ATTRIBUTE: un '>' entre comillas no la cierra
+TAG_BODY = r"""(?:[^>"']|"[^"]*"|'[^']*')*"""
+COMMENT = re.compile(r"<!--.*?-->", re.S)
+SCRIPT = re.compile(rf"<script\b({TAG_BODY})>(.*?)</script\s*>", re.S | re.I)
+ATTRIBUTE = re.compile(r"""([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?""")
+HEAD = re.compile(rf"<head\b{TAG_BODY}>(.*?)</head\s*>", re.S | re.I)
+
+CHECK_EVERY = 32 * 1024  # Caracteres recibidos entre comprobaciones del Extractor
+
+# Páginas escaneadas, DOMs completos construidos y fragmentos parseados
+stats = {"pages": 0, "documents": 0, "fragments": 0}
+
+
+def parse_attributes(text):
+    attributes = {}
+    for name, double, single, bare in ATTRIBUTE.findall(text):
+        name = name.lower()
+        if name not in attributes:
+            attributes[name] = html_entities.unescape(double or single or bare)
+    return attributes
+
+
+def matches(attributes, id=None, class_name=None, class_contains=None, classes=None):
+    if id is not None and attributes.get("id", None) != id:
+        return False
+    value = attributes.get("class", None)
+    # Igual que @class='...' y contains(@class, '...') en XPath y que div.a.b en CSS
+    if class_name is not None and value != class_name:
+        return False
+    if class_contains is not None and (value is None or class_contains not in value):
+        return False
+    if classes is not None and (value is None or not set(classes).issubset(value.split())):
+        return False
+    return True
+
+
+class Page(object):
+    def __init__(self, html, track=True):
+        if isinstance(html, bytes):
+            html = html.decode("utf-8", "replace")
+        # Lo que hay dentro de un comentario no forma parte del DOM
+        if "<!--" in html:
+            html = COMMENT.sub("", html)
+        self.html = html
+        self.parsed = None
+        if track:
+            stats["pages"] += 1
+
+    @property
+    def document(self):
+        if self.parsed is None:
+            self.parsed = lxml.html.fromstring(self.html)
+            stats["documents"] += 1
+        return self.parsed
+
+    def xpath(self, expression):
+        return self.document.xpath(expression)
+
+    def cssselect(self, expression):
+        return self.document.cssselect(expression)
+
+    # Contenido de los <script> con ese type/id, en orden de aparición
+    def scripts(self, type=None, id=None, in_head=False):
+        html = self.html
+        if in_head:
+            head = HEAD.search(html)
+            html = head.group(1) if head else html
+
+        scripts = []
+        for attributes, content in SCRIPT.findall(html):
+            attributes = parse_attributes(attributes)
+            if type is not None and attributes.get("type", None) != type:
+                continue
+            if id is not None and attributes.get("id", None) != id:
+                continue
+            scripts.append(content)
+        return scripts
+
+    # [(inicio, fin de la etiqueta de apertura, atributos)] de las etiquetas 'tag' que cumplen los filtros
+    def start_tags(self, tag, **filters):
+        tags = []
+        # Descarta sin parsear los atributos las etiquetas que no contienen el valor buscado
+        needles = [value for value in filters.values() if isinstance(value, str)] + list(filters.get("classes", None) or [])
+        for match in re.finditer(rf"<{tag}\b({TAG_BODY})>", self.html, re.I):
+            if any(value not in match.group(1) for value in needles):
+                continue
+            attributes = parse_attributes(match.group(1))
+            if matches(attributes, **filters):
+                tags.append((match.start(), match.end(), attributes))
+        return tags
+
+    def attribute(self, tag, attribute, **filters):
+        for unused, unused, attributes in self.start_tags(tag, **filters):
+            if attribute in attributes:
+                return attributes[attribute]
+        return None
+
+    # Final de la etiqueta de cierre del elemento que empieza en 'end', contando las etiquetas anidadas del mismo tipo.
+    # None si todavía no se ha recibido
+    def element_end(self, tag, end):
+        depth = 1
+        for match in re.compile(rf"<(/?){tag}\b{TAG_BODY}>", re.I).finditer(self.html, end):
+            depth += -1 if match.group(1) else 1
+            if depth == 0:
+                return match.end()
+        return None
+
+    # HTML de un elemento completo a partir de su etiqueta de apertura
+    def element_html(self, tag, start, end):
+        element_end = self.element_end(tag, end)
+        return self.html[start:element_end] if element_end is not None else self.html[start:]
+
+    # Elementos que cumplen los filtros, parseados por separado
+    def fragments(self, tag, **filters):
+        fragments = []
+        for start, end, unused in self.start_tags(tag, **filters):
+            try:
+                fragments.append(lxml.html.fromstring(self.element_html(tag, start, end)))
+            except (lxml.etree.ParserError, ValueError):
+                continue
+            stats["fragments"] += 1
+        return fragments
+
+    def fragment(self, tag, **filters):
+        fragments = self.fragments(tag, **filters)
+        return fragments[0] if fragments else None
+
+    # Resultado de 'expression' sobre cada elemento que cumple los filtros: select("div", ".//a/@href", class_contains="gallery")
+    def select(self, tag, expression, **filters):
+        results = []
+        for fragment in self.fragments(tag, **filters):
+            results.extend(fragment.xpath(expression))
+        return results
+
+
+# Decodifica el primer valor encontrado con el escaneo; si no hay o no es JSON válido, el que devuelve dom_values()
+# sobre el DOM completo. Lanza la excepción de ujson si tampoco ese es válido
+def load_json(scanned, dom_values):
+    if scanned:
+        try:
+            return ujson.loads(scanned[0])
+        except (TypeError, ValueError):
+            pass
+    return ujson.loads(dom_values()[0])
+
+
+# Condiciones para el Extractor: reciben la Page con lo descargado hasta el momento
+def scripts_needed(count, **filters):
+    def need(page):
+        return len(page.scripts(**filters)) >= count
+
+    return need
+
+
+def start_tag_needed(tag, **filters):
+    def need(page):
+        return bool(page.start_tags(tag, **filters))
+
+    return need
+
+
+def element_needed(tag, **filters):
+    def need(page):
+        return any(page.element_end(tag, end) is not None for unused, end, unused in page.start_tags(tag, **filters))
+
+    return need
+
+
+# Recibe el HTML por trozos y avisa cuando ya se han recibido completos todos los elementos que se necesitan.
+# Sin condiciones no avisa nunca: la página se descarga entera
+class Extractor(object):
+    def __init__(self, needs, check_every=CHECK_EVERY):
+        self.needs = list(needs)
+        self.check_every = check_every
+        self.chunks = []
+        self.size = 0
+        self.checked = 0
+        self.html = None
+
+    @property
+    def text(self):
+        return self.html if self.html is not None else "".join(self.chunks)
+
+    def feed(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if not self.needs or self.size - self.checked < self.check_every:
+            return False
+
+        self.checked = self.size
+        html = "".join(self.chunks)
+        self.chunks = [html]
+        # Un comentario sin cerrar todavía puede contener etiquetas
+        comment = html.rfind("<!--")
+        if comment != -1 and html.find("-->", comment) == -1:
+            html = html[:comment]
+
+        page = Page(html, track=False)
+        self.needs = [need for need in self.needs if not need(page)]
+        if self.needs:
+            return False
+        self.html = html
+        return True
+
+
+def pop_report():
+    report = dict(stats)
+    for key in stats:
+        stats[key] = 0
+    return report
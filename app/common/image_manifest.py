@@ -0,0 +1,404 @@
+import asyncio
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import struct
+import sys
+import time
+
+import ujson
+
+from app.shared.environment_variables import IMAGE_BASE_DIR
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+# Manifiesto por tienda: carpeta (part number) -> ficheros con tamaño, hash y fecha.
+# Se guarda junto a la carpeta de la tienda: <IMAGE_BASE_DIR>/<tienda>.manifest.json
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_VERSION = 1
+SAVE_INTERVAL = 30  # Seconds
+MAX_CHANGES = 10000
+USE_INOTIFY = os.environ.get("IMAGES_INOTIFY", "0") == "1" and sys.platform.startswith("linux")
+
+manifests = {}
+last_save = {}
+watchers = {}
+load_locks = {}
+
+
+# shop_dir se normaliza para que check_images y los scripts de producto compartan la misma entrada
+def manifest_path(shop_dir):
+    return f"{shop_dir.rstrip('/')}{MANIFEST_SUFFIX}"
+
+
+def folder_candidates(part_number):
+    folder = part_number.replace("/", "_--_")
+    return [folder.lower(), folder, folder.upper()]
+
+
+def find_folder(shop_dir, part_number):
+    if not part_number:
+        return None
+    for folder in folder_candidates(str(part_number)):
+        if os.path.isdir(f"{shop_dir}/{folder}"):
+            return folder
+    return None
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_folder(shop_dir, folder, previous=None):
+    # Los validadores HTTP de cada tamaño se conservan entre escaneos
+    sizes = (previous or {}).get("sizes", {})
+    previous = (previous or {}).get("files", {})
+    files = {}
+    try:
+        entries = list(os.scandir(f"{shop_dir}/{folder}"))
+    except FileNotFoundError:
+        return None
+
+    for entry in entries:
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        old = previous.get(entry.name, {})
+        # Si no ha cambiado ni el tamaño ni la fecha se reutiliza el hash anterior
+        if old.get("size") == stat.st_size and old.get("mtime") == stat.st_mtime and old.get("sha256"):
+            files[entry.name] = old
+            continue
+        files[entry.name] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_hash(entry.path)}
+
+    # La fecha de la carpeta cambia al crear, borrar o renombrar ficheros: es lo que compara rescan() sin inotify
+    entry = {"files": files, "mtime": os.stat(f"{shop_dir}/{folder}").st_mtime, "updated_at": time.time()}
+    if sizes:
+        entry["sizes"] = sizes
+    return entry
+
+
+def read_manifest(shop_dir):
+    try:
+        with open(manifest_path(shop_dir)) as file:
+            manifest = ujson.load(file)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+
+def load(shop_dir):
+    shop_dir = os.path.normpath(shop_dir)
+    manifest = manifests.get(shop_dir, None)
+    if manifest is not None:
+        return manifest
+
+    manifest = read_manifest(shop_dir)
+    if manifest is None:
+        return rebuild(shop_dir)
+    manifests[shop_dir] = manifest
+    return manifest
+
+
+# Igual que load(), pero el fichero se lee y, si hace falta, las carpetas se escanean en otro hilo.
+# El manifiesto solo se modifica en el hilo del bucle de eventos
+async def load_async(shop_dir):
+    shop_dir = os.path.normpath(shop_dir)
+    manifest = manifests.get(shop_dir, None)
+    if manifest is not None:
+        return manifest
+
+    lock = load_locks.get(shop_dir, None)
+    if lock is None:
+        lock = load_locks[shop_dir] = asyncio.Lock()
+    async with lock:
+        if shop_dir in manifests:
+            return manifests[shop_dir]
+        manifest = await asyncio.to_thread(read_manifest, shop_dir)
+        if manifest is None:
+            t0 = time.monotonic()
+            return install(shop_dir, await asyncio.to_thread(scan_shop, shop_dir, {}), t0)
+        manifests[shop_dir] = manifest
+        return manifest
+
+
+def save(shop_dir, force=True):
+    manifest = manifests.get(shop_dir, None)
+    if manifest is None or not manifest.get("dirty", False):
+        return
+    if not force and time.monotonic() - last_save.get(shop_dir, 0) < SAVE_INTERVAL:
+        return
+
+    manifest["dirty"] = False
+    path = manifest_path(shop_dir)
+    try:
+        with open(f"{path}.tmp", "w") as file:
+            ujson.dump(manifest, file)
+        os.replace(f"{path}.tmp", path)
+    except OSError as err:
+        manifest["dirty"] = True
+        logger.error(f"No se ha podido guardar el manifiesto {path}: {err}")
+        return
+    last_save[shop_dir] = time.monotonic()
+
+
+def flush():
+    for shop_dir in list(manifests):
+        save(shop_dir)
+
+
+def scan_shop(shop_dir, previous):
+    folders = {}
+    try:
+        with os.scandir(shop_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                folder = scan_folder(shop_dir, entry.name, previous.get(entry.name, None))
+                if folder is not None:
+                    folders[entry.name] = folder
+    except FileNotFoundError:
+        pass
+    return folders
+
+
+# Tras reconstruirlo no se sabe qué ha cambiado: la siguiente comprobación contra la base de datos es completa
+def install(shop_dir, folders, t0):
+    manifest = {"version": MANIFEST_VERSION, "folders": folders, "changes": [], "full_check": True, "dirty": True}
+    manifests[shop_dir] = manifest
+    save(shop_dir)
+    logger.info(f"Manifiesto {shop_dir} reconstruido: {len(folders)} carpetas en {round(time.monotonic() - t0, 1)} s")
+    return manifest
+
+
+def rebuild(shop_dir):
+    shop_dir = os.path.normpath(shop_dir)
+    t0 = time.monotonic()
+    previous = manifests.get(shop_dir, {}).get("folders", {})
+    return install(shop_dir, scan_shop(shop_dir, previous), t0)
+
+
+def update_folder(shop_dir, folder):
+    shop_dir = os.path.normpath(shop_dir)
+    manifest = load(shop_dir)
+    entry = scan_folder(shop_dir, folder, manifest["folders"].get(folder, None))
+    return set_folder(shop_dir, folder, entry)
+
+
+# Igual que update_folder(), pero los hashes se calculan en otro hilo
+async def update_folder_async(shop_dir, folder):
+    shop_dir = os.path.normpath(shop_dir)
+    manifest = await load_async(shop_dir)
+    entry = await asyncio.to_thread(scan_folder, shop_dir, folder, manifest["folders"].get(folder, None))
+    return set_folder(shop_dir, folder, entry)
+
+
+def set_folder(shop_dir, folder, entry):
+    manifest = manifests[shop_dir]
+    if entry is None:
+        manifest["folders"].pop(folder, None)
+    else:
+        manifest["folders"][folder] = entry
+
+    # Si se pierden cambios por el límite, la siguiente comprobación contra la base de datos es completa
+    manifest["changes"].append(folder)
+    if len(manifest["changes"]) > MAX_CHANGES:
+        manifest["changes"] = []
+        manifest["full_check"] = True
+    manifest["dirty"] = True
+    save(shop_dir, force=False)
+    return entry
+
+
+def update_part_number(shop_dir, part_number):
+    shop_dir = os.path.normpath(shop_dir)
+    folder = find_folder(shop_dir, part_number)
+    if not folder:
+        return None
+    return update_folder(shop_dir, folder)
+
+
+def touch(shop_dir):
+    shop_dir = os.path.normpath(shop_dir)
+    load(shop_dir)["dirty"] = True
+
+
+def shop_names():
+    return [entry.name for entry in os.scandir(IMAGE_BASE_DIR) if entry.is_dir() and not entry.name.startswith(".")]
+
+
+def get_folders(shop_dir):
+    shop_dir = os.path.normpath(shop_dir)
+    return load(shop_dir)["folders"]
+
+
+def get_empty_folders(shop_dir):
+    return [folder for folder, entry in get_folders(shop_dir).items() if not entry["files"]]
+
+
+# Carpetas modificadas desde la última llamada, o None si hay que comprobarlas todas (manifiesto reconstruido o demasiados cambios)
+def pop_changes(shop_dir):
+    shop_dir = os.path.normpath(shop_dir)
+    manifest = load(shop_dir)
+    changes = None if manifest.get("full_check", False) else list(dict.fromkeys(manifest["changes"]))
+    manifest["changes"] = []
+    manifest["full_check"] = False
+    manifest["dirty"] = True
+    return changes
+
+
+# Recoge los cambios hechos fuera de los scrapers: con inotify si está activado y si no comparando la fecha de cada carpeta.
+# Al crear el watcher también se compara con el manifiesto guardado lo que haya cambiado con el proceso parado
+def refresh(shop_dir):
+    shop_dir = os.path.normpath(shop_dir)
+    folders = dict(load(shop_dir)["folders"])
+    apply_scans(shop_dir, folders, find_changes(shop_dir, folders))
+
+
+# Igual que refresh(), pero escaneando en otro hilo. Los resultados se aplican en el hilo del bucle de eventos
+async def refresh_async(shop_dir):
+    shop_dir = os.path.normpath(shop_dir)
+    folders = dict((await load_async(shop_dir))["folders"])
+    apply_scans(shop_dir, folders, await asyncio.to_thread(find_changes, shop_dir, folders))
+
+
+# No modifica el manifiesto: recibe una copia de las carpetas y devuelve [(carpeta, entrada o None)] con las que han cambiado
+def find_changes(shop_dir, folders):
+    if not USE_INOTIFY:
+        return rescan(shop_dir, folders)
+
+    watcher = watchers.get(shop_dir, None)
+    if watcher is None:
+        try:
+            watcher = InotifyWatcher(shop_dir)
+        except OSError as err:
+            logger.warning(f"inotify no disponible para {shop_dir}, se compara la fecha de las carpetas: {err}")
+            return rescan(shop_dir, folders)
+        watchers[shop_dir] = watcher
+        return rescan(shop_dir, folders)
+
+    touched, overflow = watcher.read_events()
+    if overflow:
+        # Se han perdido eventos: se vuelven a escanear todas las carpetas, reutilizando los hashes que no han cambiado
+        scanned = scan_shop(shop_dir, folders)
+        return list(scanned.items()) + [(folder, None) for folder in set(folders) - set(scanned)]
+    return [(folder, scan_folder(shop_dir, folder, folders.get(folder, None))) for folder in touched]
+
+
+# Solo vuelve a escanear las carpetas nuevas, borradas o con otra fecha. Un fichero sobrescrito sin cambiar
+# de nombre no cambia la fecha de la carpeta: eso solo lo detecta inotify o una reconstrucción
+def rescan(shop_dir, folders):
+    scans = []
+    seen = set()
+    try:
+        with os.scandir(shop_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                seen.add(entry.name)
+                old = folders.get(entry.name, None)
+                if old is None or old.get("mtime", None) != entry.stat().st_mtime:
+                    scans.append((entry.name, scan_folder(shop_dir, entry.name, old)))
+    except FileNotFoundError:
+        pass
+    return scans + [(folder, None) for folder in set(folders) - seen]
+
+
+# Aplica los escaneos salvo en las carpetas que se han actualizado mientras tanto (su entrada ya no es la de la copia).
+# Las carpetas con los mismos ficheros solo actualizan la entrada, sin contar como cambio
+def apply_scans(shop_dir, folders, scans):
+    manifest = manifests[shop_dir]
+    for folder, entry in scans:
+        current = manifest["folders"].get(folder, None)
+        if current is not folders.get(folder, None):
+            continue
+        if current is not None and entry is not None and current["files"] == entry["files"]:
+            manifest["folders"][folder] = entry
+            manifest["dirty"] = True
+            continue
+        set_folder(shop_dir, folder, entry)
+    save(shop_dir, force=False)
+
+
+class InotifyWatcher(object):
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    EVENT_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, shop_dir):
+        self.shop_dir = shop_dir
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        self.folders = {}
+        self.root = self.add_watch(shop_dir)
+        with os.scandir(shop_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    self.folders[self.add_watch(entry.path)] = entry.name
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.EVENT_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {path}")
+        return wd
+
+    def read_events(self):
+        touched = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + self.EVENT_HEADER.size : offset + self.EVENT_HEADER.size + length].rstrip(b"\0").decode()
+                offset += self.EVENT_HEADER.size + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    return set(), True
+                if wd == self.root:
+                    if mask & self.IN_ISDIR and name:
+                        touched.add(name)
+                        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                            try:
+                                self.folders[self.add_watch(f"{self.shop_dir}/{name}")] = name
+                            except OSError:
+                                pass
+                elif wd in self.folders:
+                    touched.add(self.folders[wd])
+
+        return touched, False
+
+
+if __name__ == "__main__":
+    # Reconstrucción completa: python3 -m app.common.image_manifest rebuild [tienda ...]
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Uso: python3 -m app.common.image_manifest rebuild [tienda ...]")
+        sys.exit(1)
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    logger.propagate = True
+    shops = sys.argv[2:] or shop_names()
+    for shop in shops:
+        rebuild(f"{IMAGE_BASE_DIR}/{shop.lower()}")
@@ -0,0 +1,228 @@
+import hashlib
+import logging
+import os
+import sys
+import time
+
+import ujson
+
+import app.common.image_manifest as image_manifest
+from app.shared.environment_variables import IMAGE_BASE_DIR
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+# Almacén por contenido: cada imagen única se guarda una vez en <IMAGE_BASE_DIR>/.store/<aa>/<sha256><ext>
+# y las rutas <tienda>/<part number>/<fichero> son hardlinks al blob. Un blob con un solo enlace no lo usa nadie.
+STORE_DIR = os.environ.get("IMAGES_STORE_DIR", f"{IMAGE_BASE_DIR}/.store")
+USE_STORE = os.environ.get("IMAGES_STORE", "1") == "1"
+# Ficheros que generó shared para cada conjunto de imágenes originales (hash de los originales + tamaño):
+# <STORE_DIR>/sources/<aa>/<clave>.json -> {"files": {fichero: sha256}, "result", "names"}. Con ellos un conjunto
+# ya convertido para otra tienda o producto se enlaza sin volver a decodificarlo ni codificarlo
+SOURCES_DIR = f"{STORE_DIR}/sources"
+
+
+def blob_path(sha256, name):
+    extension = os.path.splitext(name)[1].lower()
+    return f"{STORE_DIR}/{sha256[:2]}/{sha256}{extension}"
+
+
+def replace_with_link(source, target):
+    tmp = f"{target}.link"
+    os.link(source, tmp)
+    os.replace(tmp, target)
+
+
+# Enlaza los ficheros de una carpeta con el almacén. Devuelve los bytes que se ahorran en disco
+def link_folder(folder_path, entry):
+    if not USE_STORE or not entry:
+        return 0
+
+    saved = 0
+    for name, file in entry.get("files", {}).items():
+        sha256 = file.get("sha256", None)
+        if not sha256:
+            continue
+        path = f"{folder_path}/{name}"
+        blob = blob_path(sha256, name)
+        try:
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.link(path, blob)
+                continue
+            if os.path.samefile(path, blob):
+                continue
+
+            replace_with_link(blob, path)
+            saved += file.get("size", 0)
+            file["mtime"] = os.stat(path).st_mtime
+        except OSError as err:
+            # Por ejemplo EXDEV si el almacén está en otro sistema de ficheros: la imagen se queda como copia propia
+            logger.warning(f"No se ha podido enlazar {path} con el almacén: {err}")
+            return saved
+
+    return saved
+
+
+# Antes de volver a descargar una carpeta se quitan todos sus hardlinks, estén o no en el manifiesto, para no
+# sobrescribir un blob compartido con otras tiendas
+def detach_folder(folder_path, entry):
+    detached = []
+    if not USE_STORE:
+        return detached
+
+    files = (entry or {}).get("files", {})
+    try:
+        entries = list(os.scandir(folder_path))
+    except FileNotFoundError:
+        return detached
+
+    for item in entries:
+        try:
+            if not item.is_file() or item.stat().st_nlink < 2:
+                continue
+            stat = item.stat()
+            file = files.get(item.name, {})
+            if file.get("sha256", None) and file.get("size", None) == stat.st_size and file.get("mtime", None) == stat.st_mtime:
+                sha256 = file["sha256"]
+            else:
+                sha256 = image_manifest.file_hash(item.path)
+            os.unlink(item.path)
+        except OSError:
+            continue
+        detached.append((item.name, blob_path(sha256, item.name)))
+    return detached
+
+
+# Vuelve a enlazar los ficheros que la descarga no ha reemplazado
+def restore_folder(folder_path, detached):
+    for name, blob in detached:
+        path = f"{folder_path}/{name}"
+        if os.path.exists(path) or not os.path.exists(blob):
+            continue
+        try:
+            os.link(blob, path)
+        except OSError as err:
+            logger.warning(f"No se ha podido restaurar {path}: {err}")
+
+
+def source_key(size, hashes):
+    return hashlib.sha256(f"{size}:{','.join(hashes)}".encode()).hexdigest()
+
+
+def source_path(key):
+    return f"{SOURCES_DIR}/{key[:2]}/{key}.json"
+
+
+# Ficheros ya generados para esos originales, o None si no se han convertido nunca o falta algún blob
+def find_outputs(key):
+    if not USE_STORE:
+        return None
+    try:
+        with open(source_path(key)) as file:
+            record = ujson.load(file)
+    except (OSError, ValueError):
+        return None
+    if not record.get("files", None) or any(not os.path.exists(blob_path(sha256, name)) for name, sha256 in record["files"].items()):
+        return None
+    return record
+
+
+# 'names' son el código y la carpeta del producto con los que se generaron, por si shared los usa en el nombre del fichero
+def save_outputs(key, files, result, names):
+    if not USE_STORE or not files:
+        return
+    path = source_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w") as file:
+            ujson.dump({"files": files, "result": result, "names": names}, file)
+        os.replace(f"{path}.tmp", path)
+    except OSError as err:
+        logger.warning(f"No se ha podido guardar {path}: {err}")
+
+
+def rename_output(name, old_names, new_names):
+    for old, new in zip(old_names, new_names):
+        if old and new and old != new:
+            name = name.replace(old, new)
+    return name
+
+
+# Enlaza en la carpeta los ficheros ya convertidos, con el código y la carpeta de este producto en el nombre si los
+# originales los llevaban. Devuelve los bytes que no se han vuelto a generar o None si falla
+def link_outputs(folder_path, record, names):
+    saved = 0
+    try:
+        os.makedirs(folder_path, exist_ok=True)
+        for name, sha256 in record["files"].items():
+            blob = blob_path(sha256, name)
+            replace_with_link(blob, f"{folder_path}/{rename_output(name, record.get('names', []), names)}")
+            saved += os.stat(blob).st_size
+    except OSError as err:
+        logger.warning(f"No se han podido enlazar las imágenes ya convertidas en {folder_path}: {err}")
+        return None
+    return saved
+
+
+def link_shop(shop_dir):
+    manifest = image_manifest.load(shop_dir)
+    saved = 0
+    for folder, entry in manifest["folders"].items():
+        saved += link_folder(f"{shop_dir}/{folder}", entry)
+    if saved:
+        image_manifest.touch(shop_dir)
+        image_manifest.save(shop_dir)
+    logger.info(f"{shop_dir} enlazada con el almacén: {round(saved / 1024 / 1024, 1)} MB ahorrados")
+    return saved
+
+
+# Borra los blobs que ya no están enlazados desde ninguna tienda
+def collect_garbage(min_age=3600):
+    t0 = time.monotonic()
+    removed = 0
+    freed = 0
+    now = time.time()
+    try:
+        prefixes = list(os.scandir(STORE_DIR))
+    except FileNotFoundError:
+        return 0, 0
+
+    for prefix in prefixes:
+        # Los registros de sources/ no son blobs: si falta algún blob, find_outputs los ignora y se regeneran
+        if not prefix.is_dir() or prefix.path == SOURCES_DIR:
+            continue
+        with os.scandir(prefix.path) as blobs:
+            for blob in blobs:
+                stat = blob.stat()
+                # st_ctime cambia al quitar un enlace: si es reciente puede ser una carpeta que se está volviendo a descargar
+                if stat.st_nlink > 1 or now - stat.st_ctime < min_age:
+                    continue
+                try:
+                    os.unlink(blob.path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+
+    logger.info(f"GC del almacén de imágenes: {removed} blobs borrados, {round(freed / 1024 / 1024, 1)} MB en {round(time.monotonic() - t0, 1)} s")
+    return removed, freed
+
+
+if __name__ == "__main__":
+    # python3 -m app.common.image_store link [tienda ...]  -> enlaza las imágenes existentes con el almacén
+    # python3 -m app.common.image_store gc                 -> borra los blobs sin referencias
+    if len(sys.argv) < 2 or sys.argv[1] not in ("link", "gc"):
+        print("Uso: python3 -m app.common.image_store link [tienda ...] | gc")
+        sys.exit(1)
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    logger.propagate = True
+    image_manifest.logger.propagate = True
+    if sys.argv[1] == "gc":
+        collect_garbage()
+    else:
+        shops = sys.argv[2:] or image_manifest.shop_names()
+        for shop in shops:
+            link_shop(f"{IMAGE_BASE_DIR}/{shop.lower()}")
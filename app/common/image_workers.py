@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+# La descarga, el decodificado y la conversión a WebP de shared se ejecutan en procesos aparte para no bloquear el event loop.
+# El número de procesos depende de la memoria del contenedor y, dentro de cada uno, los conjuntos que se decodifican
+# a la vez dependen de la memoria del proceso (WORKER_MEMORY // DECODE_MEMORY).
+WORKER_MEMORY = int(os.environ.get("IMAGES_WORKER_MEMORY", str(96 * 1024 * 1024)))
+RESERVED_MEMORY = int(os.environ.get("IMAGES_RESERVED_MEMORY", str(128 * 1024 * 1024)))
+MAX_WORKERS = int(os.environ.get("IMAGES_MAX_WORKERS", "2"))
+# Conjuntos de imágenes que se envían a cada proceso de una vez
+WORKER_CONCURRENCY = int(os.environ.get("IMAGES_WORKER_CONCURRENCY", "4"))
+# Memoria que se reserva para decodificar un conjunto: una foto de 12 MP en RGBA ocupa unos 48 MB sin comprimir
+DECODE_MEMORY = int(os.environ.get("IMAGES_DECODE_MEMORY", str(48 * 1024 * 1024)))
+CGROUP_MEMORY_FILES = ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]
+
+executor = None
+workers = 0
+disabled = False
+# Descargas pendientes de enviar a los procesos y una tarea por proceso que las envía por lotes
+pending = None
+dispatchers = []
+
+# Estado de cada proceso
+worker_loop = None
+worker_sessions = {}
+decode_slots = None
+
+
+def memory_limit():
+    for path in CGROUP_MEMORY_FILES:
+        try:
+            with open(path) as file:
+                value = file.read().strip()
+        except OSError:
+            continue
+        # "max" o un valor enorme significa que el contenedor no tiene límite
+        if value.isdigit() and int(value) < 1 << 50:
+            return int(value)
+    return None
+
+
+def worker_count():
+    limit = memory_limit()
+    if limit is None:
+        return MAX_WORKERS
+    return max(0, min(MAX_WORKERS, (limit - RESERVED_MEMORY) // WORKER_MEMORY))
+
+
+def get_executor():
+    global executor, workers, disabled
+    if executor is not None or disabled:
+        return executor
+
+    workers = worker_count()
+    if workers == 0:
+        logger.info("Sin memoria para procesos de imágenes, se convierten en el proceso principal")
+        disabled = True
+        return None
+
+    # spawn: el proceso principal tiene hilos y un event loop en marcha, fork no es seguro
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker)
+    logger.info(f"{workers} procesos para convertir imágenes - {WORKER_MEMORY // 1024 // 1024} MB y {decode_concurrency()} conjuntos a la vez cada uno")
+    return executor
+
+
+def decode_concurrency():
+    return max(1, WORKER_MEMORY // DECODE_MEMORY)
+
+
+def init_worker():
+    global worker_loop, decode_slots
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(worker_loop)
+    decode_slots = asyncio.Semaphore(decode_concurrency())
+
+
+async def get_worker_session(headers):
+    import aiohttp
+
+    import app.common.images as images
+
+    key = tuple(sorted(headers.items()))
+    session = worker_sessions.get(key, None)
+    if session is None:
+        conn = aiohttp.TCPConnector(limit=4)
+        timeout = aiohttp.ClientTimeout(total=30)
+        session = aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[images.validators_trace_config()], headers=headers)
+        worker_sessions[key] = session
+    return session
+
+
+# Descarga un lote de conjuntos de imágenes a la vez. Devuelve (result, validadores) o la excepción de cada uno
+def run_downloads(batch):
+    import app.common.images as images
+
+    # shared descarga y decodifica en la misma llamada: el semáforo limita los conjuntos que pueden estar decodificándose
+    async def download(headers, images_list, part_number, code, size, image_shop_dir):
+        session = await get_worker_session(headers)
+        async with decode_slots:
+            result, sources = await images.download_capturing_validators(
+                logging.getLogger("image_worker"), session, images_list, part_number, code, size, image_shop_dir
+            )
+        return images.json_result(result), sources
+
+    async def download_all():
+        return await asyncio.gather(*[download(*arguments) for arguments in batch], return_exceptions=True)
+
+    return worker_loop.run_until_complete(download_all())
+
+
+def disable():
+    global executor, disabled
+    executor = None
+    disabled = True
+
+
+# Envía al proceso todas las descargas que estén esperando (hasta WORKER_CONCURRENCY) para que se ejecuten a la vez
+async def dispatch(pool):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await pending.get()]
+        while len(batch) < WORKER_CONCURRENCY and not pending.empty():
+            batch.append(pending.get_nowait())
+
+        try:
+            results = await loop.run_in_executor(pool, run_downloads, [arguments for arguments, unused in batch])
+        except BrokenProcessPool:
+            # Normalmente un proceso eliminado por falta de memoria: se sigue en el proceso principal
+            logger.error("El proceso de imágenes ha terminado de forma inesperada, se desactivan los procesos")
+            disable()
+            results = [None] * len(batch)
+            while not pending.empty():
+                batch.append(pending.get_nowait())
+                results.append(None)
+        except Exception as err:
+            # Por ejemplo un argumento que no se puede serializar: falla el lote, no el dispatcher
+            results = [err] * len(batch)
+
+        for (unused, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        if disabled:
+            return
+
+
+def start_dispatchers(pool):
+    global pending
+    if dispatchers:
+        return
+    pending = asyncio.Queue()
+    for unused in range(workers):
+        dispatchers.append(asyncio.create_task(dispatch(pool)))
+
+
+# Devuelve (result, validadores) o None si no hay procesos disponibles y hay que descargar en el proceso principal
+async def download_save_images(session, images_list, part_number, code, size, image_shop_dir):
+    pool = get_executor()
+    if pool is None:
+        return None
+
+    start_dispatchers(pool)
+    headers = {key: value for key, value in session.headers.items()}
+    future = asyncio.get_running_loop().create_future()
+    await pending.put(((headers, images_list, part_number, code, size, image_shop_dir), future))
+    return await future
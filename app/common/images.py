@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import os
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+import ujson
+
+import app.common.image_manifest as image_manifest
+import app.common.image_store as image_store
+import app.common.image_workers as image_workers
+from app.shared.auxiliary.functions import download_save_images as shared_download_save_images
+
+# Descargas de imágenes simultáneas en total y por host (CDN de cada tienda)
+GLOBAL_LIMIT = int(os.environ.get("IMAGES_GLOBAL_LIMIT", "8"))
+HOST_LIMIT = int(os.environ.get("IMAGES_HOST_LIMIT", "4"))
+PROGRESS_EVERY = 50  # Conjuntos de imágenes
+
+global_semaphore = None
+host_semaphores = {}
+folder_locks = {}
+# url -> validadores (ETag, Last-Modified, Content-Length) de las imágenes que se están descargando
+captured_validators = {}
+# image_shop_dir -> {"queued", "done", "failed", "unchanged", "reused", "bytes", "saved", "deduped", "seconds"}
+stats = {}
+
+
+def get_semaphores(url):
+    global global_semaphore
+    if global_semaphore is None:
+        global_semaphore = asyncio.Semaphore(GLOBAL_LIMIT)
+
+    host = urlparse(url).netloc if url else ""
+    semaphore = host_semaphores.get(host, None)
+    if semaphore is None:
+        semaphore = host_semaphores[host] = asyncio.Semaphore(HOST_LIMIT)
+    return global_semaphore, semaphore
+
+
+def get_stats(image_shop_dir):
+    shop_stats = stats.get(image_shop_dir, None)
+    if shop_stats is None:
+        shop_stats = stats[image_shop_dir] = {
+            "queued": 0,
+            "done": 0,
+            "failed": 0,
+            "unchanged": 0,
+            "reused": 0,
+            "bytes": 0,
+            "saved": 0,
+            "deduped": 0,
+            "seconds": 0.0,
+        }
+    return shop_stats
+
+
+def folder_bytes(entry):
+    if not entry:
+        return 0
+    return sum(file.get("size", 0) for file in entry.get("files", {}).values())
+
+
+def get_validators(headers):
+    length = headers.get("Content-Length", None)
+    return {
+        "etag": headers.get("ETag", None),
+        "last_modified": headers.get("Last-Modified", None),
+        "length": int(length) if length and length.isdigit() else None,
+    }
+
+
+async def on_request_end(session, trace_config_ctx, params):
+    url = str(params.url)
+    if url in captured_validators and params.response.status == 200:
+        captured_validators[url] = get_validators(params.response.headers)
+
+
+# Las sesiones de los scripts de producto la usan para guardar los validadores de las imágenes descargadas por shared
+def validators_trace_config():
+    config = aiohttp.TraceConfig()
+    config.on_request_end.append(on_request_end)
+    return config
+
+
+async def is_unchanged(session, url, validators):
+    headers = {}
+    if validators.get("etag", None):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified", None):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    if not headers and not validators.get("length", None):
+        return False
+
+    # Sin ETag ni Last-Modified solo se puede comparar el tamaño con una petición HEAD
+    method = session.get if headers else session.head
+    try:
+        async with method(url, headers=headers) as response:
+            if response.status == 304:
+                return True
+            if headers or response.status != 200:
+                return False
+            return get_validators(response.headers)["length"] == validators["length"]
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return False
+
+
+# Si todas las imágenes del conjunto tienen validadores y el servidor responde 304, no hace falta volver a descargarlas
+async def check_unchanged(session, images, entry, size):
+    if not entry or not entry.get("files", None):
+        return None
+    previous = entry.get("sizes", {}).get(size, None)
+    if not previous or sorted(previous.get("images", [])) != sorted(images):
+        return None
+
+    sources = previous.get("sources", {})
+    if any(not sources.get(url, None) for url in images):
+        return None
+    results = await asyncio.gather(*[is_unchanged(session, url, sources[url]) for url in images])
+    if not all(results):
+        return None
+    return previous
+
+
+# sha256 del contenido original de cada imagen, o None si alguna no se puede descargar
+async def hash_sources(session, images):
+    hashes = []
+    try:
+        for url in images:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return None
+                digest = hashlib.sha256()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    digest.update(chunk)
+                hashes.append(digest.hexdigest())
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+    return hashes
+
+
+# Ficheros que ha escrito la descarga: los nuevos o con otro contenido respecto a la entrada anterior del manifiesto
+def written_files(before, after):
+    previous = (before or {}).get("files", {})
+    files = {}
+    for name, file in (after or {}).get("files", {}).items():
+        if file.get("sha256", None) and previous.get(name, {}).get("sha256", None) != file["sha256"]:
+            files[name] = file["sha256"]
+    return files
+
+
+# Llama a download_save_images de shared y devuelve también los validadores HTTP de cada imagen
+async def download_capturing_validators(logger, session, images, part_number, code, size, image_shop_dir):
+    for url in images:
+        captured_validators[url] = None
+    try:
+        result = await shared_download_save_images(logger, session, images, part_number, code, size, image_shop_dir)
+    finally:
+        sources = {url: captured_validators.pop(url, None) for url in images}
+    return result, sources
+
+
+def json_result(result):
+    try:
+        return ujson.loads(ujson.dumps(result))
+    except (TypeError, ValueError, OverflowError):
+        return bool(result)
+
+
+def get_folder_lock(image_shop_dir, part_number):
+    key = (image_shop_dir, str(part_number).lower())
+    lock = folder_locks.get(key, None)
+    if lock is None:
+        lock = folder_locks[key] = asyncio.Lock()
+    return lock
+
+
+# Igual que download_save_images de shared, pero limitado por host y en total, mantiene actualizado el manifiesto
+# de imágenes y deduplica el contenido en el almacén (image_store)
+async def download_save_images(logger, session, images, part_number, code, size, image_shop_dir):
+    shop_stats = get_stats(image_shop_dir)
+    shop_stats["queued"] += 1
+    global_limit, host_limit = get_semaphores(images[0] if images else None)
+
+    # Los tamaños de un mismo producto comparten carpeta: se quitan y restauran sus hardlinks de uno en uno
+    async with get_folder_lock(image_shop_dir, part_number), global_limit, host_limit:
+        t0 = time.monotonic()
+        folder = image_manifest.find_folder(image_shop_dir, str(part_number)) if part_number else None
+        entry = (await image_manifest.load_async(image_shop_dir))["folders"].get(folder, None) if folder else None
+
+        unchanged = await check_unchanged(session, images, entry, size)
+        if unchanged:
+            shop_stats["seconds"] += time.monotonic() - t0
+            shop_stats["done"] += 1
+            shop_stats["unchanged"] += 1
+            shop_stats["saved"] += sum(source.get("length", None) or 0 for source in unchanged["sources"].values())
+            return unchanged.get("result", True)
+
+        # Si estos originales ya se convirtieron (otra tienda, otro producto), se enlazan los ficheros sin volver a convertirlos.
+        # Cuesta descargar los originales una vez más cuando no están en el almacén
+        key = None
+        if image_store.USE_STORE and part_number and images:
+            hashes = await hash_sources(session, images)
+            key = image_store.source_key(size, hashes) if hashes else None
+            record = await asyncio.to_thread(image_store.find_outputs, key) if key else None
+            if record:
+                # Las carpetas nuevas se crean en minúsculas, como las de shared (find_folder las busca primero así)
+                folder = folder or image_manifest.folder_candidates(str(part_number))[0]
+                linked = await asyncio.to_thread(image_store.link_outputs, f"{image_shop_dir}/{folder}", record, [str(code), folder])
+                if linked is not None:
+                    entry = await image_manifest.update_folder_async(image_shop_dir, folder)
+                    if entry is not None:
+                        entry.setdefault("sizes", {})[size] = {"images": list(images), "sources": {}, "result": record.get("result", True)}
+                        image_manifest.touch(image_shop_dir)
+                    shop_stats["seconds"] += time.monotonic() - t0
+                    shop_stats["done"] += 1
+                    shop_stats["reused"] += 1
+                    shop_stats["deduped"] += linked
+                    return record.get("result", True)
+
+        previous = entry
+        before = folder_bytes(entry)
+        detached = await asyncio.to_thread(image_store.detach_folder, f"{image_shop_dir}/{folder}", entry) if folder else []
+        try:
+            downloaded = await image_workers.download_save_images(session, images, part_number, code, size, image_shop_dir)
+            if downloaded is None:
+                downloaded = await download_capturing_validators(logger, session, images, part_number, code, size, image_shop_dir)
+            result, sources = downloaded
+        finally:
+            if detached:
+                image_store.restore_folder(f"{image_shop_dir}/{folder}", detached)
+            shop_stats["seconds"] += time.monotonic() - t0
+
+        folder = image_manifest.find_folder(image_shop_dir, str(part_number)) if part_number else None
+        entry = await image_manifest.update_folder_async(image_shop_dir, folder) if folder else None
+        deduped = image_store.link_folder(f"{image_shop_dir}/{folder}", entry) if folder else 0
+        if deduped:
+            shop_stats["deduped"] += deduped
+        if key and result:
+            await asyncio.to_thread(image_store.save_outputs, key, written_files(previous, entry), json_result(result), [str(code), folder])
+        if entry is not None and result:
+            entry.setdefault("sizes", {})[size] = {"images": list(images), "sources": sources, "result": json_result(result)}
+        if entry is not None:
+            image_manifest.touch(image_shop_dir)
+
+    shop_stats["bytes"] += max(0, folder_bytes(entry) - before)
+    if result:
+        shop_stats["done"] += 1
+    else:
+        shop_stats["failed"] += 1
+
+    finished = shop_stats["done"] + shop_stats["failed"]
+    if finished % PROGRESS_EVERY == 0:
+        logger.info(
+            f"Imágenes {image_shop_dir}: {finished}/{shop_stats['queued']} conjuntos - "
+            f"{shop_stats['failed']} fallidos - {round(shop_stats['bytes'] / 1024 / 1024, 1)} MB"
+        )
+    return result
+
+
+# Descarga a la vez los distintos tamaños ({"medium": [...], "large": [...]}) de un producto
+async def download_image_sizes(logger, session, image_sizes, part_number, code, image_shop_dir):
+    sizes = [size for size, image_list in image_sizes.items() if image_list]
+    results = await asyncio.gather(
+        *[download_save_images(logger, session, image_sizes[size], part_number, code, size, image_shop_dir) for size in sizes]
+    )
+    return {size: result for size, result in zip(sizes, results) if result}
+
+
+def pop_report():
+    report = {}
+    for image_shop_dir, shop_stats in stats.items():
+        report[os.path.basename(image_shop_dir.rstrip("/"))] = dict(shop_stats)
+    stats.clear()
+    return report
@@ -0,0 +1,134 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+
+import ujson
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+import app.shared.environment_variables as ev
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+# Si InfluxDB no responde, los puntos se guardan aquí y se reenvían en el siguiente envío correcto
+SPOOL_FILE = os.environ.get("METRICS_SPOOL_FILE", "/tmp/stockfinder_metrics_spool.jsonl")
+MAX_SPOOL_POINTS = 50000
+FLUSH_INTERVAL = 5  # Seconds
+BATCH_SIZE = 500
+
+pending = []
+client = None
+write_api = None
+flush_task = None
+spool_lock = threading.Lock()
+
+
+def get_write_api():
+    global client, write_api
+    if write_api is None:
+        client = InfluxDBClient(url=ev.INFLUXDB_URL, token=ev.INFLUXDB_TOKEN, org=ev.INFLUXDB_ORG)
+        write_api = client.write_api(write_options=SYNCHRONOUS)
+        atexit.register(close)
+    return write_api
+
+
+# Al salir se envían los puntos pendientes y se cierra la conexión con InfluxDB
+def close():
+    global client, write_api
+    flush_now()
+    atexit.unregister(close)
+    if write_api is not None:
+        write_api.close()
+    if client is not None:
+        client.close()
+    client = None
+    write_api = None
+
+
+# Encola uno o varios puntos. No bloquea: el envío se hace en segundo plano
+def write(record):
+    global flush_task
+    records = record if isinstance(record, list) else [record]
+    pending.extend(records)
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        flush_now()
+        return
+
+    if flush_task is None or flush_task.done():
+        flush_task = loop.create_task(flush_later())
+
+
+async def flush_later():
+    await asyncio.sleep(FLUSH_INTERVAL)
+    while pending:
+        batch = pending[:BATCH_SIZE]
+        del pending[:BATCH_SIZE]
+        await asyncio.to_thread(send, batch)
+
+
+def flush_now():
+    while pending:
+        batch = pending[:BATCH_SIZE]
+        del pending[:BATCH_SIZE]
+        send(batch)
+
+
+def send(batch):
+    try:
+        get_write_api().write(bucket=ev.INFLUXDB_BUCKET, record=batch)
+    except Exception as err:
+        logger.error(f"Cannot write {len(batch)} points to InfluxDB, spooling them - Trace: {err}")
+        spool(batch)
+        return False
+
+    replay_spool()
+    return True
+
+
+# El spool se recorta al escribir para que no crezca sin límite mientras InfluxDB siga caído
+def spool(batch):
+    with spool_lock:
+        try:
+            lines = []
+            if os.path.exists(SPOOL_FILE):
+                with open(SPOOL_FILE) as file:
+                    lines = [line for line in file if line.strip()]
+            lines.extend(ujson.dumps(point) + "\n" for point in batch)
+            with open(SPOOL_FILE, "w") as file:
+                file.writelines(lines[-MAX_SPOOL_POINTS:])
+        except OSError as err:
+            logger.error(f"Cannot spool {len(batch)} points - Trace: {err}")
+
+
+def replay_spool():
+    with spool_lock:
+        if not os.path.exists(SPOOL_FILE):
+            return
+
+        try:
+            with open(SPOOL_FILE) as file:
+                points = [ujson.loads(line) for line in file if line.strip()]
+        except (OSError, ValueError) as err:
+            logger.error(f"Cannot read the metrics spool - Trace: {err}")
+            return
+
+        for index in range(0, len(points), BATCH_SIZE):
+            try:
+                get_write_api().write(bucket=ev.INFLUXDB_BUCKET, record=points[index : index + BATCH_SIZE])
+            except Exception as err:
+                logger.warning(f"Cannot replay the metrics spool - Trace: {err}")
+                remaining = points[index:]
+                with open(SPOOL_FILE, "w") as file:
+                    for point in remaining:
+                        file.write(ujson.dumps(point) + "\n")
+                return
+
+        os.remove(SPOOL_FILE)
+        logger.info(f"Replayed {len(points)} spooled points")
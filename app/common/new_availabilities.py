@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import os
+import socket
+from contextlib import contextmanager
+from datetime import timedelta
+
+import psycopg2
+import psycopg2.extensions
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, and_, func, not_, or_, select, text, true
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import aliased
+
+import app.database_functions as database_functions
+import app.shared.auxiliary.inputs as auxiliary_inputs
+from app.stockfinder_models.Availability import Availability
+from app.stockfinder_models.base import engine
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+# Dominio de cada tienda, tal y como aparece en las URLs de NewAvailability / NewAvailabilityChannels (sin "www.").
+# Solo sirve para filtrar en SQL con el índice: la tienda de cada fila la decide auxiliary_inputs.get_shop_from_url
+SHOP_HOSTS = {
+    "ldlc": ["ldlc.com"],
+    "aussar": ["aussar.es"],
+    "coolmod": ["coolmod.com"],
+    "neobyte": ["neobyte.es"],
+    "casemod": ["casemod.es"],
+    "izarmicro": ["izarmicro.com", "izarmicro.net"],
+    "vsgamers": ["vsgamers.es"],
+    "speedler": ["speedler.es"],
+}
+# La expresión tiene que ser idéntica en el índice y en las consultas para que Postgres use el índice
+HOST_PATTERN = text(r"'^https?://(?:www\.)?([^/:?#]+)'")
+
+# Una fila reclamada no la ve ningún otro proceso hasta que se procesa o caduca su lease.
+# Si falla, la lease se mantiene y la fila se reintenta cuando caduca.
+VISIBILITY_TIMEOUT = int(os.environ.get("NEW_AVAILABILITIES_VISIBILITY_TIMEOUT", "600"))  # Seconds
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+CLAIM_ATTEMPTS = 10  # Lotes que se revisan como máximo en cada claim_pending
+
+metadata = MetaData()
+leases = Table(
+    "new_availability_leases",
+    metadata,
+    Column("queue", String(64), primary_key=True),
+    Column("row_id", Integer, primary_key=True),
+    Column("owner", String(128), nullable=False),
+    Column("leased_until", DateTime(timezone=True), nullable=False, index=True),
+)
+
+# Un trigger avisa con NOTIFY de cada NewAvailability nueva. El payload es el dominio de la URL
+NOTIFY_CHANNEL = "new_availability"
+LISTEN_DEBOUNCE = 2  # Seconds, agrupa varias altas seguidas en un único lote
+LISTEN_KEEPALIVE = 60  # Seconds
+LISTEN_RECONNECT = 30  # Seconds
+
+# Los modelos viven en el submódulo stockfinder_models y no hay migraciones en este repositorio: el DDL lo ejecuta
+# el primer contenedor que arranca, serializado con un advisory lock para que no choque con los demás
+SCHEMA_LOCK = 7310514  # Clave del pg_advisory_lock
+schema_ready = False
+
+
+def url_host(column):
+    return func.lower(func.substring(column, HOST_PATTERN))
+
+
+def get_shop_name(service_name):
+    return service_name.lower().replace("versus gamers", "vsgamers")
+
+
+def get_shop_hosts(service_name):
+    return SHOP_HOSTS.get(get_shop_name(service_name), [])
+
+
+def is_pending(model):
+    return and_(model.processed == False, model.invalid == False, model.counter != 3)
+
+
+def pending_index(model):
+    return Index(
+        f"ix_{model.__tablename__}_pending_host",
+        url_host(model.url),
+        model._id,
+        postgresql_where=and_(model.processed == False, model.invalid == False),
+        postgresql_concurrently=True,
+    )
+
+
+# Conexión en autocommit (CREATE INDEX CONCURRENTLY no puede ir en una transacción) con el advisory lock del esquema.
+# No se espera al lock para no bloquear el event loop: si lo tiene otro contenedor devuelve None y se reintenta más tarde
+@contextmanager
+def schema_lock():
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if not connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": SCHEMA_LOCK}).scalar():
+            yield None
+            return
+        try:
+            yield connection
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK})
+
+
+def create_pending_index(connection, model):
+    index = pending_index(model)
+    # Un CREATE INDEX CONCURRENTLY interrumpido deja el índice inválido: se borra y se vuelve a crear
+    valid = connection.execute(
+        text("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"), {"name": index.name}
+    ).scalar()
+    if valid:
+        return
+    if valid is not None:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+    index.create(bind=connection)
+
+
+# Índice parcial por dominio sobre las filas pendientes y tabla de leases. Si falla se reintenta en el siguiente barrido
+def ensure_schema(models):
+    global schema_ready
+    if schema_ready:
+        return True
+
+    try:
+        with schema_lock() as connection:
+            if connection is None:
+                logger.info("Otro contenedor está preparando el esquema de las disponibilidades nuevas, se reintentará")
+                return False
+            leases.create(bind=connection, checkfirst=True)
+            for model in models:
+                create_pending_index(connection, model)
+    except SQLAlchemyError as err:
+        logger.warning(f"No se ha podido preparar el esquema de las disponibilidades nuevas, se reintentará: {err}")
+        return False
+
+    schema_ready = True
+    return True
+
+
+# Reclama como máximo 'limit' filas pendientes de una tienda, junto con la disponibilidad que ya exista para su URL (o None).
+# FOR UPDATE SKIP LOCKED evita que dos procesos reclamen la misma fila a la vez y la lease la oculta hasta que caduque.
+# El join con las leases se evalúa con la foto del inicio de la consulta: si otro proceso hace commit de su lease
+# mientras tanto, la fila puede llegar igualmente. Por eso la lease solo se toma si no existe o ya ha caducado,
+# comprobándolo en el propio upsert (que espera al commit del otro proceso), y solo se devuelven las filas conseguidas.
+# La tienda de cada fila la decide get_shop_from_url, que no se puede evaluar en SQL. Las filas que tienen el dominio de
+# la tienda pero get_shop_from_url no reconoce se descartan como en discard_unknown, y las que asigna a otra tienda
+# también se reservan, para que no ocupen el LIMIT de cada consulta. Si de un lote no queda ninguna fila de la tienda
+# se pide el siguiente: una cabeza de cola con filas ajenas no deja la cola parada.
+# El caller tiene que hacer commit para que la lease sea visible para el resto
+def claim_pending(session, model, service_name, limit, visibility_timeout=VISIBILITY_TIMEOUT):
+    shop_name = get_shop_name(service_name)
+    hosts = get_shop_hosts(shop_name)
+    if not hosts:
+        return []
+
+    for unused in range(CLAIM_ATTEMPTS):
+        rows = select_pending(session, model, hosts, limit)
+        if not rows:
+            return []
+
+        shops = {row._id: auxiliary_inputs.get_shop_from_url(row.url) for row, unused in rows}
+        unknown = [row_id for row_id, shop in shops.items() if shop == "Unknown"]
+        if unknown:
+            session.query(model).filter(model._id.in_(unknown)).update({"processed": True}, synchronize_session=False)
+        foreign = {row.url for row, unused in rows if shops[row._id] not in ("Unknown", shop_name)}
+        if foreign:
+            logger.warning(f"URLs con el dominio de {shop_name} que get_shop_from_url asigna a otra tienda: {sorted(foreign)}")
+
+        leased = lease_rows(session, model, [row_id for row_id, shop in shops.items() if shop != "Unknown"], visibility_timeout)
+        rows = [(row, availability) for row, availability in rows if shops[row._id] == shop_name and row._id in leased]
+        if rows:
+            return rows
+    return []
+
+
+# Puede haber varias disponibilidades con la misma URL: el LATERAL ... LIMIT 1 devuelve solo una, como el .first() de antes,
+# para que cada fila de la cola aparezca una vez y no se creen alertas duplicadas
+def select_pending(session, model, hosts, limit):
+    active_lease = and_(leases.c.queue == model.__tablename__, leases.c.row_id == model._id, leases.c.leased_until > func.now())
+    first_availability = select(Availability).where(Availability.url == model.url).limit(1).lateral()
+    return (
+        session.query(model, aliased(Availability, first_availability))
+        .outerjoin(first_availability, true())
+        .outerjoin(leases, active_lease)
+        .filter(and_(is_pending(model), url_host(model.url).in_(hosts), leases.c.row_id == None))
+        .order_by(model._id)
+        .limit(limit)
+        .with_for_update(of=model, skip_locked=True)
+        .all()
+    )
+
+
+# Toma la lease de las filas que no tienen una en vigor y devuelve los ids conseguidos
+def lease_rows(session, model, ids, visibility_timeout):
+    if not ids:
+        return set()
+
+    leased_until = func.now() + timedelta(seconds=visibility_timeout)
+    statement = insert(leases).values([{"queue": model.__tablename__, "row_id": row_id, "owner": LEASE_OWNER, "leased_until": leased_until} for row_id in ids])
+    statement = statement.on_conflict_do_update(
+        index_elements=[leases.c.queue, leases.c.row_id],
+        set_={"owner": statement.excluded.owner, "leased_until": statement.excluded.leased_until},
+        where=leases.c.leased_until <= func.now(),
+    ).returning(leases.c.row_id)
+    return {row_id for row_id, in session.execute(statement)}
+
+
+# Libera las leases de las filas ya procesadas o inválidas. Las que han fallado esperan a que caduque su lease
+def release_finished(session, model, ids):
+    if not ids:
+        return
+    finished = select(model._id).where(and_(model._id.in_(ids), or_(model.processed == True, model.invalid == True)))
+    session.execute(leases.delete().where(and_(leases.c.queue == model.__tablename__, leases.c.row_id.in_(finished))))
+
+
+def purge_expired(session):
+    session.execute(leases.delete().where(leases.c.leased_until < func.now() - timedelta(days=1)))
+
+
+# Las URLs de tiendas desconocidas no las va a procesar ningún contenedor. Los dominios de SHOP_HOSTS solo
+# preseleccionan las filas: se descartan las que get_shop_from_url no reconoce, no las de tiendas sin contenedor aquí
+def discard_unknown(session, model):
+    known_hosts = [host for hosts in SHOP_HOSTS.values() for host in hosts]
+    candidates = (
+        session.query(model._id, model.url)
+        .filter(and_(is_pending(model), or_(url_host(model.url) == None, not_(url_host(model.url).in_(known_hosts)))))
+        .all()
+    )
+    unknown = [row_id for row_id, url in candidates if auxiliary_inputs.get_shop_from_url(url) == "Unknown"]
+    if not unknown:
+        return 0
+    return session.query(model).filter(model._id.in_(unknown)).update({"processed": True}, synchronize_session=False)
+
+
+# Devuelve False si otro contenedor tiene el lock del esquema
+def ensure_notify_trigger(model):
+    table = model.__tablename__
+    function = f"notify_{table}"
+    with schema_lock() as connection:
+        if connection is None:
+            return False
+        connection.execute(
+            text(
+                f"""
+                CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('{NOTIFY_CHANNEL}', lower(substring(NEW.url from {HOST_PATTERN.text})));
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql
+                """
+            )
+        )
+        connection.execute(
+            text(
+                f"""
+                DO $$ BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = '{function}') THEN
+                        CREATE TRIGGER {function} AFTER INSERT ON {table} FOR EACH ROW EXECUTE PROCEDURE {function}();
+                    END IF;
+                END $$
+                """
+            )
+        )
+    return True
+
+
+# Escucha las altas de la tienda y llama a on_notify() en cuanto llegan. Si la conexión se pierde se reconecta;
+# mientras tanto el barrido periódico de check_new_availabilities sigue procesando la cola
+async def listen(logger, model, service_name, on_notify):
+    hosts = set(get_shop_hosts(service_name))
+    if not hosts:
+        return
+
+    loop = asyncio.get_running_loop()
+    trigger_ready = False
+    while True:
+        # Hasta que exista el trigger solo funciona el barrido periódico
+        if not trigger_ready:
+            try:
+                trigger_ready = ensure_notify_trigger(model)
+            except SQLAlchemyError as err:
+                logger.warning(f"No se ha podido crear el trigger de {model.__tablename__}, se reintentará en {LISTEN_RECONNECT} s: {err}")
+            if not trigger_ready:
+                await asyncio.sleep(LISTEN_RECONNECT)
+                continue
+
+        connection = None
+        pending = asyncio.Event()
+
+        def on_readable():
+            try:
+                connection.poll()
+            except psycopg2.Error:
+                # La excepción se repite en el SELECT 1 del keepalive, que se encarga de reconectar
+                pending.set()
+                return
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                if notify.payload in hosts:
+                    pending.set()
+
+        try:
+            connection = database_functions.sql_connection()
+            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            loop.add_reader(connection.fileno(), on_readable)
+            logger.info(f"Escuchando altas de {service_name} en '{NOTIFY_CHANNEL}'")
+
+            while True:
+                try:
+                    await asyncio.wait_for(pending.wait(), timeout=LISTEN_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    continue
+
+                await asyncio.sleep(LISTEN_DEBOUNCE)
+                pending.clear()
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                logger.info(f"Nuevas disponibilidades notificadas para {service_name}")
+                try:
+                    await on_notify()
+                except (SQLAlchemyError, asyncio.TimeoutError) as err:
+                    logger.error(f"Error procesando las disponibilidades notificadas: {err}")
+
+        except psycopg2.Error as err:
+            logger.warning(f"Conexión LISTEN perdida, reconectando en {LISTEN_RECONNECT} s: {err}")
+        finally:
+            if connection is not None:
+                try:
+                    loop.remove_reader(connection.fileno())
+                except (ValueError, psycopg2.Error):
+                    pass
+                connection.close()
+
+        await asyncio.sleep(LISTEN_RECONNECT)
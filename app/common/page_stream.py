@@ -0,0 +1,92 @@
+import codecs
+import os
+
+import aiohttp
+
+import app.common.html_scan as html_scan
+import app.common.rate_limiter as rate_limiter
+import app.shared.error_messages as error
+
+# Descarga las páginas de producto por trozos y corta la conexión en cuanto el html_scan.Extractor tiene todo lo necesario.
+# Si algún elemento no aparece, la página se lee entera como hasta ahora
+STREAM = os.environ.get("PAGE_STREAM", "1") == "1"
+CHUNK_SIZE = 16 * 1024
+
+# shop -> {"pages", "aborted", "read", "avoided", "estimated", "full_pages", "full_bytes"}
+stats = {}
+
+
+def get_stats(shop):
+    shop_stats = stats.get(shop, None)
+    if shop_stats is None:
+        shop_stats = stats[shop] = {"pages": 0, "aborted": 0, "read": 0, "avoided": 0, "estimated": 0, "full_pages": 0, "full_bytes": 0}
+    return shop_stats
+
+
+def record(shop, response, read, aborted):
+    shop_stats = get_stats(shop)
+    shop_stats["pages"] += 1
+    shop_stats["read"] += read
+    if not aborted:
+        shop_stats["full_pages"] += 1
+        shop_stats["full_bytes"] += read
+        return
+
+    shop_stats["aborted"] += 1
+    # Content-Length solo sirve si el cuerpo no va comprimido, si no se estima con el tamaño medio de las páginas completas
+    length = response.content_length
+    if length and "Content-Encoding" not in response.headers:
+        shop_stats["avoided"] += max(0, length - read)
+    elif shop_stats["full_pages"]:
+        avoided = max(0, shop_stats["full_bytes"] // shop_stats["full_pages"] - read)
+        shop_stats["avoided"] += avoided
+        shop_stats["estimated"] += avoided
+
+
+def get_decoder(charset):
+    try:
+        return codecs.getincrementaldecoder(charset or "utf-8")(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+# Igual que rate_limiter.get, pero deja de leer la respuesta cuando se cumplen todas las condiciones de 'needs'.
+# Devuelve el HTML recibido (completo o no) o None si la petición falla
+async def get(logger, session, url, shop, needs):
+    if not STREAM:
+        return await rate_limiter.get(logger, session, url)
+
+    await rate_limiter.acquire(url)
+    extractor = html_scan.Extractor(needs)
+    read = 0
+    try:
+        async with session.get(url) as response:
+            if response.status != 200:
+                logger.error(error.code_not_200(url, response.status))
+                return None
+
+            decoder = get_decoder(response.charset)
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                read += len(chunk)
+                if extractor.feed(decoder.decode(chunk)):
+                    # Cerrar la conexión es más barato que leer el resto de la página; no se reutiliza
+                    response.close()
+                    record(shop, response, read, aborted=True)
+                    return extractor.text
+
+            extractor.feed(decoder.decode(b"", final=True))
+            record(shop, response, read, aborted=False)
+            return extractor.text
+
+    except aiohttp.ClientError as err:
+        logger.error(f"{url} - {err}")
+        return None
+
+
+def pop_report():
+    report = {}
+    for shop, shop_stats in stats.items():
+        report[shop] = {key: shop_stats[key] for key in ("pages", "aborted", "read", "avoided", "estimated")}
+        for key in report[shop]:
+            shop_stats[key] = 0
+    return report
@@ -0,0 +1,94 @@
+import re
+
+import app.common.tasks as tasks
+import app.shared.valid_messages as valid
+
+# Límite de seguridad para los listados que solo indican la página siguiente
+MAX_PAGES = 200
+
+
+def replace_page(url, param, page):
+    return re.sub(f"{param}\\d+", f"{param}{page}", url)
+
+
+# Una excepción en una página se trata como una página fallida (None)
+async def safe_fetch(logger, fetch_page, url):
+    try:
+        return await fetch_page(url)
+    except Exception as err:
+        logger.error(f"Error en la página {url}: {err!r}", exc_info=err)
+        return None
+
+
+# Descarga todas las páginas de un listado.
+#   url_for(page) -> url de la página
+#   fetch_page(url) -> (items, total_pages, next_page) o None si la página ha fallado
+# Si la primera página indica el total, el resto se piden de forma concurrente (máximo 'parallel' a la vez)
+# y una página fallida se salta sin perder las demás.
+# Si solo indica la siguiente página (LDLC, Coolmod), se recorren una a una y se para en la primera que falle,
+# conservando los productos de las anteriores.
+async def fetch_pages(logger, url_for, fetch_page, parallel=1, first_page=1):
+    url = url_for(first_page)
+    result = await safe_fetch(logger, fetch_page, url)
+    if not result:
+        return []
+
+    items, total_pages, next_page = result
+    items = list(items or [])
+
+    if total_pages:
+        logger.info(valid.actual_total_pages(first_page, total_pages, url))
+        return items + await fetch_remaining_pages(logger, url_for, fetch_page, parallel, first_page, total_pages)
+
+    logger.info(valid.actual_next_page(first_page, next_page, url))
+    return items + await fetch_next_pages(logger, url_for, fetch_page, first_page, next_page)
+
+
+async def fetch_remaining_pages(logger, url_for, fetch_page, parallel, first_page, total_pages):
+    items = []
+    last_fetched = first_page
+    while last_fetched < total_pages:
+        pages = list(range(last_fetched + 1, total_pages + 1))
+        urls = [url_for(page) for page in pages]
+        results = await tasks.gather_limited(parallel, [safe_fetch(logger, fetch_page, url) for url in urls])
+
+        # Los resultados se procesan en orden de página
+        new_total = total_pages
+        for page, url, result in zip(pages, urls, results):
+            if not result:
+                logger.warning(f"Página {page} sin datos, se salta: {url}")
+                continue
+
+            page_items, page_total, next_page = result
+            if page_total and page_total != new_total:
+                logger.warning(f"El número de páginas ha cambiado de {new_total} a {page_total}: {url}")
+                new_total = page_total
+            if page > new_total:
+                # El listado ha encogido, las páginas restantes ya no existen
+                return items
+
+            logger.info(valid.actual_total_pages(page, new_total, url))
+            items += page_items or []
+
+        last_fetched = pages[-1]
+        total_pages = new_total
+
+    return items
+
+
+async def fetch_next_pages(logger, url_for, fetch_page, current_page, next_page):
+    items = []
+    visited = 1
+    while next_page and next_page > current_page and visited < MAX_PAGES:
+        url = url_for(next_page)
+        result = await safe_fetch(logger, fetch_page, url)
+        if not result:
+            break
+
+        current_page = next_page
+        page_items, total_pages, next_page = result
+        logger.info(valid.actual_next_page(current_page, next_page, url))
+        items += page_items or []
+        visited += 1
+
+    return items
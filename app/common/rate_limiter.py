@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import app.shared.auxiliary.requests_handler as requests_handler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+logger.propagate = False
+
+# rate: peticiones/segundo sostenidas - burst: peticiones seguidas permitidas - min_interval: segundos mínimos entre peticiones
+HOST_LIMITS = {
+    "www.aussar.es": {"rate": 2, "burst": 2, "min_interval": 0.25},
+    "casemod.es": {"rate": 2, "burst": 2, "min_interval": 0.25},
+    "www.coolmod.com": {"rate": 3, "burst": 2, "min_interval": 0.2},
+    "www.izarmicro.net": {"rate": 1, "burst": 2, "min_interval": 0.5},
+    "www.ldlc.com": {"rate": 0.2, "burst": 1, "min_interval": 3},
+    "www.neobyte.es": {"rate": 1, "burst": 2, "min_interval": 0.5},
+    "www.speedler.es": {"rate": 1, "burst": 2, "min_interval": 0.5},
+    "www.vsgamers.es": {"rate": 1, "burst": 2, "min_interval": 0.5},
+    "api.store.nvidia.com": {"rate": 1, "burst": 4, "min_interval": 0},
+}
+DEFAULT_LIMIT = {"rate": 2, "burst": 2, "min_interval": 0.25}
+
+# Ante un 429/503 la tasa se divide entre 2 (hasta 1/16) y se recupera poco a poco con cada respuesta correcta
+THROTTLE_STATUS = (429, 503)
+MIN_FACTOR = 1 / 16
+RECOVERY_STEP = 0.05
+MAX_RETRY_AFTER = 300  # Seconds
+
+buckets = {}
+
+
+class TokenBucket(object):
+    def __init__(self, host, rate, burst, min_interval):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.min_interval = min_interval
+        self.factor = 1.0
+        # Planificación virtual del bucket: instante teórico en el que vuelve a estar lleno
+        self.full_at = 0.0
+        self.last_slot = 0.0
+        self.blocked_until = 0.0
+        #
+        self.requests = 0
+        self.throttled = 0.0
+        self.limited = 0
+
+    def reserve(self):
+        now = time.monotonic()
+        interval = 1 / (self.rate * self.factor)
+        tolerance = (self.burst - 1) * interval
+
+        slot = max(now, self.full_at - tolerance, self.last_slot + self.min_interval, self.blocked_until)
+        self.full_at = max(self.full_at, slot) + interval
+        self.last_slot = slot
+
+        self.requests += 1
+        self.throttled += slot - now
+        return slot - now
+
+    def penalize(self, retry_after=None):
+        self.limited += 1
+        self.factor = max(MIN_FACTOR, self.factor / 2)
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + min(retry_after, MAX_RETRY_AFTER))
+        logger.warning(f"{self.host} - throttling - factor: {self.factor} - retry_after: {retry_after}")
+
+    def recover(self):
+        if self.factor < 1:
+            self.factor = min(1.0, self.factor + RECOVERY_STEP)
+
+
+def get_bucket(host):
+    bucket = buckets.get(host, None)
+    if bucket:
+        return bucket
+
+    limit = HOST_LIMITS.get(host, DEFAULT_LIMIT)
+    bucket = TokenBucket(host, limit["rate"], limit["burst"], limit["min_interval"])
+    buckets[host] = bucket
+    return bucket
+
+
+async def acquire(url):
+    host = urlsplit(str(url)).hostname or ""
+    wait_time = get_bucket(host).reserve()
+    if wait_time > 0:
+        await asyncio.sleep(wait_time)
+    return wait_time
+
+
+def parse_retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def record_status(host, status, retry_after=None):
+    bucket = get_bucket(host)
+    if status in THROTTLE_STATUS:
+        bucket.penalize(parse_retry_after(retry_after))
+    elif status < 400:
+        bucket.recover()
+
+
+async def on_request_end(session, trace_config_ctx, params):
+    record_status(params.url.host, params.response.status, params.response.headers.get("Retry-After", None))
+
+
+# Las sesiones de aiohttp creadas con trace_configs=[rate_limiter.trace_config()] informan de los códigos de respuesta
+def trace_config():
+    config = aiohttp.TraceConfig()
+    config.on_request_end.append(on_request_end)
+    return config
+
+
+async def get(logger, session, url, **kwargs):
+    await acquire(url)
+    return await requests_handler.get(logger, session, url, **kwargs)
+
+
+async def post(logger, session, url, **kwargs):
+    await acquire(url)
+    return await requests_handler.post(logger, session, url, **kwargs)
+
+
+# Devuelve y reinicia las estadísticas por host: peticiones, segundos esperados y respuestas 429/503
+def pop_report():
+    report = {}
+    for host, bucket in buckets.items():
+        if not bucket.requests and not bucket.limited:
+            continue
+        report[host] = {"requests": bucket.requests, "throttled": round(bucket.throttled, 3), "limited": bucket.limited}
+        bucket.requests = 0
+        bucket.throttled = 0.0
+        bucket.limited = 0
+    return report
@@ -0,0 +1,7 @@
+import lxml.etree
+
+
+# Compila una sola vez las expresiones XPath de una tienda: {"campo": "expresión"} -> {"campo": lxml.etree.XPath}
+# Se usan igual que element.xpath(expresión): XPATHS["campo"](element)
+def compile_xpaths(definitions):
+    return {name: lxml.etree.XPath(expression, smart_strings=False) for name, expression in definitions.items()}
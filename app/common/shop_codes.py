@@ -0,0 +1,80 @@
+import app.database_functions as database_functions
+from app.stockfinder_models.base import Session
+from app.stockfinder_models.NewAvailabilityChannels import NewAvailabilityChannels
+
+SHOPS_ID = {
+    "ldlc": 5,
+    "aussar": 2,
+    "coolmod": 3,
+    "neobyte": 7,
+    "casemod": 10,
+    "izarmicro": 4,
+    "vsgamers": 12,
+    "speedler": 17,
+}
+
+# shop_id -> {code: True}. Se carga una vez por ciclo y se actualiza al registrar disponibilidades
+shop_codes = {}
+# URLs que ya se sabe que están en NewAvailabilityChannels, de cualquier tienda: shop_name no siempre está informado
+channel_urls = set()
+
+
+def get_shop_id(service_name):
+    service_name = service_name.lower().replace("versus gamers", "vsgamers")
+    return SHOPS_ID.get(service_name, False)
+
+
+def get_codes(shop_id):
+    codes = shop_codes.get(shop_id, None)
+    if codes is not None:
+        return codes
+
+    codes = database_functions.perform_select_availabilities(
+        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
+    )
+    # Un resultado vacío puede ser un error de la DB, no se guarda para reintentarlo en la siguiente página
+    if codes:
+        shop_codes[shop_id] = codes
+    return codes
+
+
+def add_code(shop_id, code):
+    codes = shop_codes.get(shop_id, None)
+    if codes is None or code is None:
+        return
+
+    try:
+        code = int(code)
+    except (TypeError, ValueError):
+        return
+    codes[code] = True
+
+
+def is_known_channel_url(url):
+    return url in channel_urls
+
+
+# Devuelve las URLs (sin repetir) que todavía no están en NewAvailabilityChannels, sea cual sea su shop_name.
+# Las que ya existen se recuerdan para no volver a consultarlas. Los errores de la DB se propagan
+def get_new_channel_urls(urls):
+    pending = [url for url in dict.fromkeys(urls) if url not in channel_urls]
+    if not pending:
+        return []
+
+    session = Session()
+    try:
+        existing = {row[0] for row in session.query(NewAvailabilityChannels.url).filter(NewAvailabilityChannels.url.in_(pending))}
+    finally:
+        session.close()
+
+    channel_urls.update(existing)
+    return [url for url in pending if url not in existing]
+
+
+def add_channel_urls(urls):
+    channel_urls.update(urls)
+
+
+def reset():
+    shop_codes.clear()
+    channel_urls.clear()
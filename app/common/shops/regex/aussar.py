@@ -3,7 +3,6 @@ import re
 
 import lxml.html
 import pandas as pd
-import ujson
 
 from app.shared.auxiliary.functions import parse_number
 
@@ -12,11 +11,10 @@ logger.setLevel(logging.DEBUG)
 logger.propagate = False
 
 
-def scrape_category(response, product, category):
+# product_details: JSON del atributo data-product de #product-details
+def scrape_category(product_details, product, category):
     try:
-        data = response.xpath("(//div[@id='product-details'])/@data-product")[0]
-        data = ujson.loads(data)
-        html_description = data["description"]
+        html_description = product_details["description"]
         html_description = lxml.html.fromstring(html_description)
     except:
         return False
@@ -0,0 +1,14 @@
+from app.common.selectors import compile_xpaths
+
+XPATHS = compile_xpaths(
+    {
+        "products": "//div[contains(@class,'productInfo')]",
+        "next_page_buttons": "//div[contains(@class,'infiniteloadercontainer')]//button",
+        "next_page": "./@data-page",
+        "code": "./@id",
+        "price": "./@data-price",
+        "stock": "(.//span[@class='stock on'])",
+        "name": ".//div[@class='productName']//div//div//a//text()",
+        "url": ".//div[@class='productName']//div//div//a/@href",
+    }
+)
@@ -0,0 +1,15 @@
+from app.common.selectors import compile_xpaths
+
+XPATHS = compile_xpaths(
+    {
+        "products": "(.//div[@class='divproportada2'])",
+        "featured": "(.//div[@class='plist_img2'])//span[@class='destacado']/text()",
+        "url": "(.//div[@class='plist_img2'])//a/@href",
+        "price": "(.//div[@class='tdispo4'])//div[2]//span/text()",
+        "stock": "(.//button[@class='compra2'])/text()",
+        "name": "(.//div[@class='plist_img2'])//a/text()",
+        "name_h2": "(.//div[@class='plist_img2'])//a//h2/text()",
+        "second_name": "(.//div[@class='plist_img2'])//span[@class='desport']/text()",
+        "part_number": "(.//div[@class='plist_img2'])//span[@class='mpntxt']/text()",
+    }
+)
@@ -0,0 +1,15 @@
+from app.common.selectors import compile_xpaths
+
+XPATHS = compile_xpaths(
+    {
+        "products": "(.//div[@class='listing-product'])//li[@class='pdt-item']",
+        "url": "(.//h3[@class='title-3']//a/@href)",
+        "price_int": "(.//div[@class='basket'])//div//div/text()",
+        "price_dec": "(.//div[@class='basket'])//div//div//sup/text()",
+        "no_stock_9": "(.//div[@data-stock-web='9'])",
+        "no_stock_10": "(.//div[@data-stock-web='10'])",
+        "name": "(.//h3[@class='title-3'])//a/text()",
+        "description": ".//div[@class='pdt-desc']//p/text()",
+        "total_page": "(.//li[@class='next'])//a/@data-page",
+    }
+)
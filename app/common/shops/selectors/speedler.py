@@ -0,0 +1,12 @@
+from app.common.selectors import compile_xpaths
+
+XPATHS = compile_xpaths(
+    {
+        "products": "//div[@class='JS_product prod prodGrid2']",
+        "code": "./@sku",
+        "price": "./@price",
+        "stock": ".//div[@class='side-loader']//span//text()",
+        "name": "./@name",
+        "url": ".//a[@class='JSproductName name']/@href",
+    }
+)
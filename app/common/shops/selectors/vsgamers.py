@@ -0,0 +1,12 @@
+from app.common.selectors import compile_xpaths
+
+XPATHS = compile_xpaths(
+    {
+        "products": "(//div[@class='vs-product-card'])",
+        "data_info": "(./@data-info)",
+        "price": "(.//span[@class='vs-product-card-prices-price'])/@data-price",
+        "stock": "(.//button[@type='button'])",
+        "url": "(.//div[@class='vs-product-card-title']//a/@href)",
+        "second_name": "(.//div[@class='vs-product-card-title']//a/@title)",
+    }
+)
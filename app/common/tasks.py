@@ -0,0 +1,49 @@
+import asyncio
+
+import app.shared.error_messages as error
+
+
+# Ejecuta las corrutinas de forma concurrente, como máximo 'limit' a la vez, y devuelve los resultados en orden
+async def gather_limited(limit, coroutines, return_exceptions=False):
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[run(coroutine) for coroutine in coroutines], return_exceptions=return_exceptions)
+
+
+# Procesa cada entrada de shop_data con process(entry), como máximo 'limit' a la vez, y guarda lo que devuelve en entry["result"].
+# Cualquier excepción queda registrada como error de esa entrada: no interrumpe el resto del lote
+async def process_entries(logger, limit, entries, process):
+    async def run(entry):
+        try:
+            entry["result"] = await process(entry)
+        except asyncio.TimeoutError:
+            logger.error(error.TIMEOUT_ERROR)
+            entry["result"] = {"error": True, "error_message": error.TIMEOUT_ERROR}
+        except Exception as err:
+            logger.error(f"Error procesando {entry.get('url', None)}: {err!r}", exc_info=err)
+            entry["result"] = {"error": True, "error_message": f"{type(err).__name__}: {err}"}
+
+    await gather_limited(limit, [run(entry) for entry in entries], return_exceptions=True)
+
+
+# Registra y descarta las excepciones devueltas por gather_limited(..., return_exceptions=True)
+def drop_exceptions(logger, results):
+    valid_results = []
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error(f"Error en una tarea: {result!r}", exc_info=result)
+            continue
+        valid_results.append(result)
+    return valid_results
+
+
+def flatten(results):
+    items = []
+    for result in results:
+        if result:
+            items.extend(result)
+    return items
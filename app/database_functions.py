@@ -1,9 +1,14 @@
+import io
 import logging
 import os
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from psycopg2 import Error
 from psycopg2.extras import execute_values
 
@@ -27,6 +32,21 @@ REMOTE_USER_PASSWORD = os.environ.get("POSGRESQL_REMOTE_USER_PASSWORD")
 REMOTE_URL = os.environ.get("POSGRESQL_REMOTE_URL")
 REMOTE_PORT = os.environ.get("POSGRESQL_REMOTE_PORT")
 
+POOL_MIN_CONNECTIONS = int(os.environ.get("POSGRESQL_POOL_MIN", 1))
+POOL_MAX_CONNECTIONS = int(os.environ.get("POSGRESQL_POOL_MAX", 4))
+# Las conexiones que llevan más tiempo sin usarse se comprueban con un SELECT 1 antes de entregarlas
+POOL_PING_AFTER = 60  # Seconds
+
+# Minutos entre dos marcas de "visto" para una disponibilidad sin cambios de precio/stock
+LAST_SEEN_INTERVAL = 30
+BULK_PAGE_SIZE = 1000
+# A partir de este número de filas se usa COPY + tabla temporal en lugar de execute_values
+COPY_THRESHOLD = 2000
+
+pool = None
+pool_lock = threading.Lock()
+last_used = {}
+
 
 def sql_connection():
     connection = psycopg2.connect(user=LOCAL_USER, password=LOCAL_USER_PASSWORD, host=LOCAL_URL, port=LOCAL_PORT, database=DATABASE)
@@ -41,12 +61,125 @@ def sql_connection():
     return connection
 
 
-def update_multiple_row_availabilities(columns, values, equal_params):
-    connection = sql_connection()
-    if connection is None:
+def get_pool():
+    global pool
+    if pool is not None and not pool.closed:
+        return pool
+
+    with pool_lock:
+        if pool is None or pool.closed:
+            pool = psycopg2.pool.ThreadedConnectionPool(
+                POOL_MIN_CONNECTIONS,
+                POOL_MAX_CONNECTIONS,
+                user=LOCAL_USER,
+                password=LOCAL_USER_PASSWORD,
+                host=LOCAL_URL,
+                port=LOCAL_PORT,
+                database=DATABASE,
+            )
+    return pool
+
+
+def is_healthy(connection):
+    if connection.closed:
+        return False
+
+    last_use = last_used.get(id(connection), None)
+    if last_use is None or time.monotonic() - last_use < POOL_PING_AFTER:
+        return True
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except Error:
         return False
 
+
+def release_connection(connection, broken=False):
+    broken = broken or connection.closed != 0
+    if broken:
+        last_used.pop(id(connection), None)
+    else:
+        last_used[id(connection)] = time.monotonic()
+
+    try:
+        get_pool().putconn(connection, close=broken)
+    except (Error, KeyError) as err:
+        logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "pool", err))
+
+
+def checkout_connection():
+    for attempt in range(2):
+        try:
+            connection = get_pool().getconn()
+        except psycopg2.pool.PoolError as err:
+            # Pool agotado: se usa una conexión directa, que se cierra al devolverla
+            logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "pool", err))
+            return sql_connection(), False
+        except Error as err:
+            logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "pool", err))
+            return None, False
+
+        if is_healthy(connection):
+            return connection, True
+
+        # Conexión rota (reinicio de Postgres, timeout...): se descarta y se pide otra
+        release_connection(connection, broken=True)
+
+    return None, False
+
+
+@contextmanager
+def pooled_connection():
+    try:
+        connection, pooled = checkout_connection()
+    except Error as err:
+        logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "pool", err))
+        connection, pooled = None, False
+
+    try:
+        yield connection
+    finally:
+        if connection is not None:
+            try:
+                if not connection.closed and connection.status != psycopg2.extensions.STATUS_READY:
+                    connection.rollback()
+            except Error:
+                pass
+
+            if pooled:
+                release_connection(connection)
+            else:
+                connection.close()
+
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+# Vuelca las filas en una tabla temporal con COPY, más rápido que execute_values para lotes grandes
+def copy_to_temp_table(cursor, table, columns, values):
+    column_str = ",".join(columns)
+    cursor.execute(f"CREATE TEMP TABLE {table} ON COMMIT DROP AS SELECT {column_str} FROM products_availabilities WITH NO DATA")
+
+    buffer = io.StringIO()
+    for value in values:
+        buffer.write("\t".join(copy_value(field) for field in value) + "\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({column_str}) FROM STDIN", buffer)
+
+
+def update_multiple_row_availabilities(columns, values, equal_params, use_copy=None):
     update_values = ""
+    distinct_str = ""
     data_str = ""
     for column in columns:
         if column in equal_params:
@@ -54,6 +187,7 @@ def update_multiple_row_availabilities(columns, values, equal_params):
             continue
 
         update_values += f"{column} = data.{column}, "
+        distinct_str += f"products_availabilities.{column} IS DISTINCT FROM data.{column} OR "
         data_str += column + ","
 
     equal_str = ""
@@ -63,33 +197,61 @@ def update_multiple_row_availabilities(columns, values, equal_params):
             equal_str += " AND "
 
     update_values = update_values[:-2]
+    distinct_str = distinct_str[:-4]
     data_str = data_str[:-1]
 
-    cursor = connection.cursor()
-    query = f"UPDATE products_availabilities SET {update_values} FROM (VALUES %s) AS data ({data_str}) WHERE {equal_str}"
+    if use_copy is None:
+        use_copy = len(values) >= COPY_THRESHOLD
 
-    try:
-        execute_values(cursor, query, values)
-        connection.commit()
-        logger.info(valid_messages.db_success(sys._getframe().f_code.co_name, "products_availabilities"))
-        cursor.close()
-        connection.close()
-        return True
-    except Error as err:
-        logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "products_availabilities", err))
-        cursor.close()
-        connection.close()
-        return False
+    if use_copy:
+        source = "tmp_availabilities AS data"
+        touch_source = source
+    else:
+        source = f"(VALUES %s) AS data ({data_str})"
+        touch_source = f"(VALUES %s) AS data ({','.join(equal_params)})"
+
+    # Solo se reescriben las filas en las que algún valor ha cambiado
+    query = (
+        f"UPDATE products_availabilities SET {update_values}, updated_at = NOW() FROM {source} "
+        f"WHERE {equal_str} AND ({distinct_str}) RETURNING products_availabilities.{equal_params[0]}"
+    )
+
+    # Las filas sin cambios solo se marcan como vistas, y como mucho una vez cada LAST_SEEN_INTERVAL minutos
+    touch_query = (
+        f"UPDATE products_availabilities SET updated_at = NOW() FROM {touch_source} "
+        f"WHERE {equal_str} AND products_availabilities.updated_at < NOW() - INTERVAL '{LAST_SEEN_INTERVAL} minutes' RETURNING 1"
+    )
+
+    with pooled_connection() as connection:
+        if connection is None:
+            return False
+
+        try:
+            with connection.cursor() as cursor:
+                if use_copy:
+                    copy_to_temp_table(cursor, "tmp_availabilities", columns, values)
+                    cursor.execute(query)
+                    changed = cursor.fetchall()
+                    cursor.execute(touch_query)
+                    touched = cursor.fetchall()
+                else:
+                    key_indexes = [columns.index(param) for param in equal_params]
+                    key_values = [tuple(value[index] for index in key_indexes) for value in values]
+                    changed = execute_values(cursor, query, values, page_size=BULK_PAGE_SIZE, fetch=True)
+                    touched = execute_values(cursor, touch_query, key_values, page_size=BULK_PAGE_SIZE, fetch=True)
+            connection.commit()
+            logger.info(valid_messages.db_success(sys._getframe().f_code.co_name, "products_availabilities"))
+            return {"scanned": len(values), "changed": len(changed), "touched": len(touched)}
+        except Error as err:
+            logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "products_availabilities", err))
+            return False
 
 
 def perform_select_availabilities(select_params, search_params, operator="AND", distinct=False, as_dict=False, data_askey=False, data_list=False, key=None):
-    connection = sql_connection()
     if data_askey:
         data = {}
     else:
         data = []
-    if connection is None:
-        return data
     search_params_list = list(search_params.keys())
     search_params_values_list = list(search_params.values())
 
@@ -104,67 +266,69 @@ def perform_select_availabilities(select_params, search_params, operator="AND",
     else:
         distinct = ""
 
-    try:
-        with connection:
-            if as_dict:
-                cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            else:
-                cursor = connection.cursor()
-            cursor.execute(f"SELECT {distinct} {select_clause} FROM products_availabilities WHERE {where_clause}")
-            cursor = cursor.fetchall()
-            if as_dict:
-                for row in cursor:
-                    if data_askey:
-                        if not key:
-                            raise Error
-
-                        row_dict = dict(row)
-                        key_value = row_dict[key]
-                        row_dict.pop(key, None)
-                        data[key_value] = row_dict if row_dict else True
-
-                    else:
-                        data.append(dict(row))
-            elif data_list:
-                for row in cursor:
-                    data.append(row[0])
-            else:
-                data = cursor
+    with pooled_connection() as connection:
+        if connection is None:
+            return data
 
-        connection.close()
-        logger.info(valid_messages.db_success(sys._getframe().f_code.co_name, "products_availabilities"))
-        return data
-    except Error as err:
-        logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "products_availabilities", err))
-        connection.close()
-        return data
+        try:
+            with connection:
+                if as_dict:
+                    cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+                else:
+                    cursor = connection.cursor()
+                cursor.execute(f"SELECT {distinct} {select_clause} FROM products_availabilities WHERE {where_clause}")
+                cursor = cursor.fetchall()
+                if as_dict:
+                    for row in cursor:
+                        if data_askey:
+                            if not key:
+                                raise Error
 
+                            row_dict = dict(row)
+                            key_value = row_dict[key]
+                            row_dict.pop(key, None)
+                            data[key_value] = row_dict if row_dict else True
+
+                        else:
+                            data.append(dict(row))
+                elif data_list:
+                    for row in cursor:
+                        data.append(row[0])
+                else:
+                    data = cursor
+
+            logger.info(valid_messages.db_success(sys._getframe().f_code.co_name, "products_availabilities"))
+            return data
+        except Error as err:
+            logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "products_availabilities", err))
+            return data
 
-def get_availabilities_stock_time(shop_id, in_stock=0, distinct=True, tiempo=5, limit="NULL"):
-    connection = sql_connection()
-    data = []
-    if connection is None:
-        return data
 
+# updated_at solo se renueva cada LAST_SEEN_INTERVAL minutos si no hay cambios, así que 'tiempo' no puede ser menor
+def get_availabilities_stock_time(shop_id, in_stock=0, distinct=True, tiempo=LAST_SEEN_INTERVAL, limit="NULL"):
+    tiempo = max(tiempo, LAST_SEEN_INTERVAL)
+    data = []
     if distinct:
         distinct = "distinct"
     else:
         distinct = ""
 
-    cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    try:
-        with connection:
-            cursor.execute(
-                f"SELECT {distinct} url, url_code FROM products_availabilities pu WHERE pu.shop_id = '{shop_id}' AND pu.in_stock = '{in_stock}' AND pu.updated_at < NOW() - INTERVAL '{tiempo} minutes' LIMIT {limit}"
-            )
-            cursor = cursor.fetchall()
-            for row in cursor:
-                data.append(dict(row))
+    with pooled_connection() as connection:
+        if connection is None:
+            return data
 
-        logger.info(valid_messages.db_success(sys._getframe().f_code.co_name, "products_availabilities"))
-        connection.close()
-        return data
-    except Error as err:
-        logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "products_availabilities", err))
-        connection.close()
-        return []
+        try:
+            with connection:
+                cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+                cursor.execute(
+                    f"SELECT {distinct} url, url_code FROM products_availabilities pu WHERE pu.shop_id = '{shop_id}' AND pu.in_stock = '{in_stock}' AND pu.updated_at < NOW() - INTERVAL '{tiempo} minutes' LIMIT {limit}"
+                )
+                cursor = cursor.fetchall()
+                for row in cursor:
+                    data.append(dict(row))
+
+            logger.info(valid_messages.db_success(sys._getframe().f_code.co_name, "products_availabilities"))
+            return data
+        except Error as err:
+            logger.warning(error_messages.db_error(sys._getframe().f_code.co_name, "products_availabilities", err))
+            return []
@@ -2,15 +2,17 @@ import asyncio
 import random
 
 import aiohttp
-import lxml.html
-import ujson
 
+import app.common.html_scan as html_scan
+import app.common.page_stream as page_stream
+import app.common.rate_limiter as rate_limiter
 import app.common.shops.regex.aussar as aussar_aux_functions
-import app.shared.auxiliary.requests_handler as requests_handler
+import app.common.tasks as tasks
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
-from app.shared.auxiliary.functions import download_save_images, parse_number
+from app.common.images import download_image_sizes, validators_trace_config
+from app.shared.auxiliary.functions import parse_number
 from app.shared.environment_variables import IMAGE_BASE_DIR
 
 HEADERS = {
@@ -22,9 +24,15 @@ HEADERS = {
 
 SHOP = "Aussar"
 IMAGE_SHOP_DIR = f"{IMAGE_BASE_DIR}/{SHOP.lower()}"
+PARALLEL_PRODUCTS = 4
+# Elementos que se usan de la página: con ellos ya se puede cortar la descarga
+PAGE_NEEDS = [
+    html_scan.scripts_needed(7, in_head=True),
+    html_scan.start_tag_needed("div", id="product-details"),
+]
 
 
-async def process_response(logger, session, product, response, only_download_images):
+async def process_response(logger, session, product, product_details, only_download_images):
     code = product.get("code", 0)
     url = product.get("url", None)
     name = product.get("name", None)
@@ -56,21 +64,19 @@ async def process_response(logger, session, product, response, only_download_ima
         return product
     product["category"] = category
 
-    new_product = aussar_aux_functions.scrape_category(response, product, category)
+    new_product = aussar_aux_functions.scrape_category(product_details, product, category)
     if not new_product:
         product["error_message"] = error.SPECS_NOT_FOUND
         product["error"] = True
         return product
     product = new_product
 
-    images = {}
     image_sizes = {"medium": medium_image, "large": large_images}
-    for size, image_list in image_sizes.items():
-        if not image_list:
-            continue
-        image = await download_save_images(logger, session, image_list, part_number, code, size, IMAGE_SHOP_DIR)
-        if image:
-            images[size] = image
+    images = await download_image_sizes(logger, session, image_sizes, part_number, code, IMAGE_SHOP_DIR)
+    if not images:
+        product["error_message"] = error.PRODUCT_IMG_NOT_FOUND
+        product["error"] = True
+        return product
 
     if only_download_images:
         return product
@@ -86,24 +92,28 @@ async def process_response(logger, session, product, response, only_download_ima
 async def download_data(logger, session, url, proxy=None):
     logger.info(f"Consultando url: {url}")
 
-    response = await requests_handler.get(logger, session, url)
+    response = await page_stream.get(logger, session, url, SHOP, PAGE_NEEDS)
     if not response:
         return False, error.GET_NOT_COMPLETED
 
-    try:
-        response = lxml.html.fromstring(response)
-    except:
-        return False, error.HTML_PARSE_ERROR
+    # Todo lo necesario está en un <script> de <head> y en el atributo data-product: normalmente no se construye el DOM
+    page = html_scan.Page(response)
+    product_data_code = page.attribute("div", "data-product", id="product-details")
+    product_data = page.scripts(in_head=True)[6:7]
+    if not product_data:
+        try:
+            product_data = [script.text_content() for script in page.cssselect("html>head>script:nth-of-type(7)")]
+        except:
+            return False, error.HTML_PARSE_ERROR
 
-    product_data_code = response.cssselect("#product-details")
-    product_data = response.cssselect("html>head>script:nth-of-type(7)")
     if not product_data:
         return False, error.PRODUCT_DATA_NOT_FOUND
 
     try:
-        product_data_code = product_data_code[0].get("data-product")
-        product_data_code = ujson.loads(product_data_code)
-        product_data = ujson.loads(product_data[0].text_content())
+        product_data_code = html_scan.load_json(
+            [product_data_code] if product_data_code else [], lambda: page.xpath("(//div[@id='product-details'])/@data-product")
+        )
+        product_data = html_scan.load_json(product_data, lambda: [script.text_content() for script in page.cssselect("html>head>script:nth-of-type(7)")])
     except:
         return False, error.JSON_ERROR
 
@@ -113,7 +123,16 @@ async def download_data(logger, session, url, proxy=None):
 
     product_data["code"] = product_code
     product_data["url"] = url
-    return product_data, response
+    return product_data, product_data_code
+
+
+async def process_entry(logger, session, entry, only_download_images):
+    url = entry["url"]
+    product_data, response = await download_data(logger, session, url)
+    if product_data == False:
+        return {"error": True, "error_message": response}
+
+    return await process_response(logger, session, product_data, response, only_download_images)
 
 
 async def main(logger, shop_data, only_download_images=False):
@@ -123,15 +142,10 @@ async def main(logger, shop_data, only_download_images=False):
     try:
         conn = aiohttp.TCPConnector(limit=15)
         timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for entry in range(len(shop_data)):
-                url = shop_data[entry]["url"]
-                product_data, response = await download_data(logger, session, url)
-                if product_data == False:
-                    shop_data[entry]["result"] = {"error": True, "error_message": response}
-                    continue
-
-                shop_data[entry]["result"] = await process_response(logger, session, product_data, response, only_download_images)
+        async with aiohttp.ClientSession(
+            connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config(), validators_trace_config()], headers=HEADERS
+        ) as session:
+            await tasks.process_entries(logger, PARALLEL_PRODUCTS, shop_data, lambda entry: process_entry(logger, session, entry, only_download_images))
 
     except asyncio.exceptions.TimeoutError:
         logger.error(error.TIMEOUT_ERROR)
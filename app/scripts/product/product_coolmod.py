@@ -2,14 +2,16 @@ import asyncio
 import re
 
 import aiohttp
+import app.common.html_scan as html_scan
+import app.common.page_stream as page_stream
+import app.common.rate_limiter as rate_limiter
 import app.common.shops.regex.coolmod as coolmod_aux_functions
-import app.shared.auxiliary.requests_handler as requests_handler
+import app.common.tasks as tasks
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
-import lxml.html
-import ujson
-from app.shared.auxiliary.functions import download_save_images, parse_number
+from app.common.images import download_save_images, validators_trace_config
+from app.shared.auxiliary.functions import parse_number
 from app.shared.environment_variables import IMAGE_BASE_DIR
 
 HEADERS = {
@@ -32,6 +34,13 @@ HEADERS = {
 
 SHOP = "Coolmod"
 IMAGE_SHOP_DIR = f"{IMAGE_BASE_DIR}/{SHOP.lower()}"
+PARALLEL_PRODUCTS = 4
+# Elementos que se usan de la página: con ellos ya se puede cortar la descarga
+PAGE_NEEDS = [
+    html_scan.scripts_needed(3, type="application/ld+json"),
+    html_scan.element_needed("div", class_contains="w-100 productgallery"),
+    html_scan.element_needed("div", classes=["productdetailinfocontainer", "smoothshadow"]),
+]
 
 
 async def process_response(logger, session, product, response, only_download_images):
@@ -80,7 +89,8 @@ async def process_response(logger, session, product, response, only_download_ima
         "manufacturer": manufacturer,
     }
 
-    new_product = coolmod_aux_functions.scrape_category(response, product, category)
+    specs = response.fragment("div", classes=["productdetailinfocontainer", "smoothshadow"])
+    new_product = coolmod_aux_functions.scrape_category(specs if specs is not None else response, product, category)
     error_message = None
     if not new_product:
         error_message = error.SPECS_NOT_FOUND
@@ -116,27 +126,40 @@ async def process_response(logger, session, product, response, only_download_ima
 
 async def download_data(logger, session, url, proxy=None):
     logger.info(f"Consultando url: {url}")
-    response = await requests_handler.get(logger, session, url)
+    response = await page_stream.get(logger, session, url, SHOP, PAGE_NEEDS)
     if not response:
         return False, error.GET_NOT_COMPLETED
 
-    try:
-        response = lxml.html.fromstring(response)
-    except:
-        return False, error.HTML_PARSE_ERROR
+    # El DOM completo solo se construye si hace falta para las especificaciones
+    page = html_scan.Page(response)
+    product_data = page.scripts(type="application/ld+json")[2:3]
+    images = page.select("div", ".//a/@href", class_contains="w-100 productgallery")
+    if not product_data or not images:
+        try:
+            product_data = page.xpath("(//script[@type='application/ld+json'])[3]/text()")
+            images = page.xpath("//div[contains(@class,'w-100 productgallery')]//a/@href")
+        except:
+            return False, error.HTML_PARSE_ERROR
 
-    product_data = response.xpath("(//script[@type='application/ld+json'])[3]/text()")
     if not product_data:
         return False, error.PRODUCT_DATA_NOT_FOUND
 
-    images = response.xpath("//div[contains(@class,'w-100 productgallery')]//a/@href")
     try:
-        product_data = ujson.loads(product_data[0])
+        product_data = html_scan.load_json(product_data, lambda: page.xpath("(//script[@type='application/ld+json'])[3]/text()"))
     except:
         return False, error.JSON_ERROR
 
     product_data["images"] = images
-    return product_data, response
+    return product_data, page
+
+
+async def process_entry(logger, session, entry, only_download_images):
+    url = entry["url"]
+    product_data, response = await download_data(logger, session, url)
+    if not product_data:
+        return {"error": True, "error_message": response}
+
+    return await process_response(logger, session, product_data, response, only_download_images)
 
 
 async def main(logger, shop_data, only_download_images=False):
@@ -146,15 +169,8 @@ async def main(logger, shop_data, only_download_images=False):
     try:
         conn = aiohttp.TCPConnector(limit=15, verify_ssl=False)
         timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS, trust_env=True) as session:
-            for entry in range(len(shop_data)):
-                url = shop_data[entry]["url"]
-                product_data, response = await download_data(logger, session, url)
-                if not product_data:
-                    shop_data[entry]["result"] = {"error": True, "error_message": response}
-                    continue
-
-                shop_data[entry]["result"] = await process_response(logger, session, product_data, response, only_download_images)
+        async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config(), validators_trace_config()], headers=HEADERS, trust_env=True) as session:
+            await tasks.process_entries(logger, PARALLEL_PRODUCTS, shop_data, lambda entry: process_entry(logger, session, entry, only_download_images))
 
             return shop_data
 
@@ -3,12 +3,13 @@ import random
 import re
 
 import aiohttp
-import app.shared.auxiliary.requests_handler as requests_handler
+import app.common.rate_limiter as rate_limiter
+import app.common.tasks as tasks
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
 import lxml.html
-from app.shared.auxiliary.functions import download_save_images
+from app.common.images import download_save_images, validators_trace_config
 from app.shared.environment_variables import IMAGE_BASE_DIR
 
 HEADERS = {
@@ -21,6 +22,7 @@ HEADERS = {
 SHOP = "IzarMicro"
 
 IMAGE_SHOP_DIR = f"{IMAGE_BASE_DIR}/{SHOP.lower()}"
+PARALLEL_PRODUCTS = 4
 
 
 async def process_response(logger, session, response, url, only_download_images):
@@ -120,7 +122,7 @@ async def process_response(logger, session, response, url, only_download_images)
 async def download_data(logger, session, url, proxy=None):
     logger.info(f"Consultando url: {url}")
 
-    response = await requests_handler.get(logger, session, url)
+    response = await rate_limiter.get(logger, session, url)
     if not response:
         return False, error.GET_NOT_COMPLETED
 
@@ -133,6 +135,15 @@ async def download_data(logger, session, url, proxy=None):
     return True, response
 
 
+async def process_entry(logger, session, entry, only_download_images):
+    url = entry["url"]
+    result, response = await download_data(logger, session, url)
+    if not result:
+        return {"error": True, "error_message": response}
+
+    return await process_response(logger, session, response, url, only_download_images)
+
+
 async def main(logger, shop_data, only_download_images=False):
     if not shop_data:
         return False
@@ -140,15 +151,8 @@ async def main(logger, shop_data, only_download_images=False):
     try:
         conn = aiohttp.TCPConnector(limit=15)
         timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for entry in range(len(shop_data)):
-                url = shop_data[entry]["url"]
-                result, response = await download_data(logger, session, url)
-                if not result:
-                    shop_data[entry]["result"] = {"error": True, "error_message": response}
-                    continue
-
-                shop_data[entry]["result"] = await process_response(logger, session, response, url, only_download_images)
+        async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config(), validators_trace_config()], headers=HEADERS) as session:
+            await tasks.process_entries(logger, PARALLEL_PRODUCTS, shop_data, lambda entry: process_entry(logger, session, entry, only_download_images))
 
     except asyncio.exceptions.TimeoutError:
         logger.error(error.TIMEOUT_ERROR)
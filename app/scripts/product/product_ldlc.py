@@ -1,18 +1,18 @@
 import asyncio
-import random
 import re
-import time
 
 import aiohttp
-import lxml.html
-import ujson
 
+import app.common.html_scan as html_scan
+import app.common.page_stream as page_stream
+import app.common.rate_limiter as rate_limiter
 import app.common.shops.regex.ldlc as ldlc_aux_functions
-import app.shared.auxiliary.requests_handler as requests_handler
+import app.common.tasks as tasks
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
-from app.shared.auxiliary.functions import download_save_images, parse_number
+from app.common.images import download_save_images, validators_trace_config
+from app.shared.auxiliary.functions import parse_number
 from app.shared.environment_variables import IMAGE_BASE_DIR
 
 HEADERS = {
@@ -23,6 +23,13 @@ HEADERS = {
 
 SHOP = "LDLC"
 IMAGE_SHOP_DIR = f"{IMAGE_BASE_DIR}/{SHOP.lower()}"
+PARALLEL_PRODUCTS = 2
+# Elementos que se usan de la página: con ellos ya se puede cortar la descarga
+PAGE_NEEDS = [
+    html_scan.scripts_needed(1, type="application/ld+json"),
+    html_scan.element_needed("div", class_name="breadcrumb"),
+    html_scan.element_needed("table", id="product-parameters"),
+]
 
 
 async def process_product(logger, session, product, response, only_download_images):
@@ -59,7 +66,8 @@ async def process_product(logger, session, product, response, only_download_imag
         return product
     product["category"] = category
 
-    new_product = ldlc_aux_functions.scrape_category(response, product, category)
+    specs = response.fragment("table", id="product-parameters")
+    new_product = ldlc_aux_functions.scrape_category(specs if specs is not None else response, product, category)
     if not new_product:
         product["error_message"] = error.SPECS_NOT_FOUND
         product["error"] = True
@@ -87,25 +95,29 @@ async def process_product(logger, session, product, response, only_download_imag
 async def download_data(logger, session, url, only_download_images, proxy=None):
     logger.info(f"Consultando url: {url}")
 
-    response = await requests_handler.get(logger, session, url)
+    response = await page_stream.get(logger, session, url, SHOP, PAGE_NEEDS)
     if not response:
         return False, error.GET_NOT_COMPLETED
 
-    try:
-        response = lxml.html.fromstring(response)
-    except:
-        logger.error(error.HTML_PARSE_ERROR)
-        return False, error.HTML_PARSE_ERROR
+    # El DOM completo solo se construye si hace falta para las especificaciones
+    page = html_scan.Page(response)
+    product_data = page.scripts(type="application/ld+json")[:1]
+    data_category = page.select("div", ".//ul//li[4]//a/text()", class_name="breadcrumb")[:1]
+    if not product_data or not data_category:
+        try:
+            product_data = page.xpath("(//script[@type='application/ld+json'])[1]/text()")
+            data_category = page.xpath("(//div[@class='breadcrumb'])//ul//li[4]//a/text()")
+        except:
+            logger.error(error.HTML_PARSE_ERROR)
+            return False, error.HTML_PARSE_ERROR
 
-    product_data = response.xpath("(//script[@type='application/ld+json'])[1]/text()")
-    data_category = response.xpath("(//div[@class='breadcrumb'])//ul//li[4]//a/text()")
     if not product_data:
         logger.error(error.PRODUCT_DATA_NOT_FOUND)
         return False, error.PRODUCT_DATA_NOT_FOUND
 
     try:
         category = str(data_category[0])
-        product_data = ujson.loads(product_data[0])
+        product_data = html_scan.load_json(product_data, lambda: page.xpath("(//script[@type='application/ld+json'])[1]/text()"))
     except:
         logger.error(error.JSON_ERROR)
         return False, error.JSON_ERROR
@@ -113,7 +125,16 @@ async def download_data(logger, session, url, only_download_images, proxy=None):
     product_data["url"] = url
     product_data["category"] = category
 
-    return await process_product(logger, session, product_data, response, only_download_images), True
+    return await process_product(logger, session, product_data, page, only_download_images), True
+
+
+async def process_entry(logger, session, entry, only_download_images):
+    url = entry["url"]
+    product_data, response = await download_data(logger, session, url, only_download_images)
+    if product_data == False:
+        return {"error": True, "error_message": response}
+
+    return product_data
 
 
 async def main(logger, shop_data, only_download_images=False):
@@ -123,16 +144,8 @@ async def main(logger, shop_data, only_download_images=False):
     try:
         conn = aiohttp.TCPConnector(limit=15)
         timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for entry in range(len(shop_data)):
-                url = shop_data[entry]["url"]
-                product_data, response = await download_data(logger, session, url, only_download_images)
-                if product_data == False:
-                    shop_data[entry]["result"] = {"error": True, "error_message": response}
-                    continue
-
-                shop_data[entry]["result"] = product_data
-                time.sleep(random.randint(5, 10))
+        async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config(), validators_trace_config()], headers=HEADERS) as session:
+            await tasks.process_entries(logger, PARALLEL_PRODUCTS, shop_data, lambda entry: process_entry(logger, session, entry, only_download_images))
 
     except asyncio.exceptions.TimeoutError:
         logger.error(error.TIMEOUT_ERROR)
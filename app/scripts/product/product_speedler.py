@@ -1,11 +1,13 @@
 import aiohttp
-import app.shared.auxiliary.requests_handler as requests_handler
+import app.common.rate_limiter as rate_limiter
+import app.common.tasks as tasks
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
 import lxml.html
 import ujson
-from app.shared.auxiliary.functions import download_save_images, parse_number
+from app.common.images import download_save_images, validators_trace_config
+from app.shared.auxiliary.functions import parse_number
 from app.shared.environment_variables import IMAGE_BASE_DIR
 
 HEADERS = {
@@ -16,6 +18,7 @@ HEADERS = {
 
 SHOP = "Speedler"
 IMAGE_SHOP_DIR = f"{IMAGE_BASE_DIR}/{SHOP.lower()}"
+PARALLEL_PRODUCTS = 2
 
 
 async def process_response(logger, session, product, only_download_images):
@@ -77,7 +80,7 @@ async def process_response(logger, session, product, only_download_images):
 
 async def download_data(logger, session, url, proxy=None):
     logger.info(f"Consultando url: {url}")
-    response = await requests_handler.get(logger, session, url)
+    response = await rate_limiter.get(logger, session, url)
     if not response:
         return False, error.GET_NOT_COMPLETED
 
@@ -101,20 +104,22 @@ async def download_data(logger, session, url, proxy=None):
     return product_data, response
 
 
+async def process_entry(logger, session, entry, only_download_images):
+    url = entry["url"]
+    product_data, response = await download_data(logger, session, url)
+    if product_data == False:
+        return {"error": True, "error_message": response}
+
+    return await process_response(logger, session, product_data, only_download_images)
+
+
 async def main(logger, shop_data, only_download_images=False):
     if not shop_data:
         return False
 
     conn = aiohttp.TCPConnector(limit=15)
     timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-        for entry in range(len(shop_data)):
-            url = shop_data[entry]["url"]
-            product_data, response = await download_data(logger, session, url)
-            if product_data == False:
-                shop_data[entry]["result"] = {"error": True, "error_message": response}
-                continue
-
-            shop_data[entry]["result"] = await process_response(logger, session, product_data, only_download_images)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config(), validators_trace_config()], headers=HEADERS) as session:
+        await tasks.process_entries(logger, PARALLEL_PRODUCTS, shop_data, lambda entry: process_entry(logger, session, entry, only_download_images))
 
     return shop_data
@@ -1,12 +1,14 @@
 import aiohttp
-import lxml.html
-import ujson
 
-import app.shared.auxiliary.requests_handler as requests_handler
+import app.common.html_scan as html_scan
+import app.common.page_stream as page_stream
+import app.common.rate_limiter as rate_limiter
+import app.common.tasks as tasks
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
-from app.shared.auxiliary.functions import download_save_images, parse_number
+from app.common.images import download_image_sizes, validators_trace_config
+from app.shared.auxiliary.functions import parse_number
 from app.shared.environment_variables import IMAGE_BASE_DIR
 
 HEADERS = {
@@ -17,6 +19,12 @@ HEADERS = {
 
 SHOP = "Versus Gamers"
 IMAGE_SHOP_DIR = f"{IMAGE_BASE_DIR}/vsgamers"
+PARALLEL_PRODUCTS = 4
+# Elementos que se usan de la página: con ellos ya se puede cortar la descarga
+PAGE_NEEDS = [
+    html_scan.start_tag_needed("div", class_name="vs-product"),
+    html_scan.element_needed("div", class_name="vs-product-header-gallery"),
+]
 
 
 async def process_response(logger, session, product, only_download_images):
@@ -53,15 +61,8 @@ async def process_response(logger, session, product, only_download_images):
         return product
     product["category"] = category
 
-    images = {}
     image_sizes = {"medium": medium_images, "large": large_images}
-
-    for size, image_list in image_sizes.items():
-        if not image_list:
-            continue
-        image = await download_save_images(logger, session, image_list, part_number, code, size, IMAGE_SHOP_DIR)
-        if image:
-            images[size] = image
+    images = await download_image_sizes(logger, session, image_sizes, part_number, code, IMAGE_SHOP_DIR)
 
     if not images.get("medium", None) and not images.get("medium", None):
         product["error_message"] = error.PRODUCT_IMG_NOT_FOUND
@@ -85,31 +86,43 @@ async def process_response(logger, session, product, only_download_images):
 
 async def download_data(logger, session, url, proxy=None):
     logger.info(f"Consultando url: {url}")
-    response = await requests_handler.get(logger, session, url)
+    response = await page_stream.get(logger, session, url, SHOP, PAGE_NEEDS)
     if not response:
         return False, error.GET_NOT_COMPLETED
 
-    try:
-        response = lxml.html.fromstring(response)
-    except:
-        return False, error.HTML_PARSE_ERROR
-
-    product_data = response.xpath("//div[@class='vs-product']/@data-info")
-    images = response.xpath("//div[@class='vs-product-header-gallery']//div[@class='thumbnails']//div[@class='wrapper']//ul//li//a/@href")
+    page = html_scan.Page(response)
+    product_data = page.attribute("div", "data-info", class_name="vs-product")
+    product_data = [product_data] if product_data is not None else []
+    images = page.select("div", ".//div[@class='thumbnails']//div[@class='wrapper']//ul//li//a/@href", class_name="vs-product-header-gallery")
     if len(images) == 0:
-        images = response.xpath("//div[@class='vs-product-header-gallery']//div[@class='images']//ul//li//a/@href")
+        images = page.select("div", ".//div[@class='images']//ul//li//a/@href", class_name="vs-product-header-gallery")
+
+    if not product_data:
+        try:
+            product_data = page.xpath("//div[@class='vs-product']/@data-info")
+        except:
+            return False, error.HTML_PARSE_ERROR
 
     if not product_data:
         return False, error.ARTICLES_NOT_FOUND
 
     try:
-        product_data = ujson.loads(product_data[0])
+        product_data = html_scan.load_json(product_data, lambda: page.xpath("//div[@class='vs-product']/@data-info"))
     except:
         return False, error.JSON_ERROR
 
     product_data["url"] = url
     product_data["images"] = images
-    return product_data, response
+    return product_data, page
+
+
+async def process_entry(logger, session, entry, only_download_images):
+    url = entry["url"]
+    product_data, response = await download_data(logger, session, url)
+    if product_data == False:
+        return {"error": True, "error_message": response}
+
+    return await process_response(logger, session, product_data, only_download_images)
 
 
 async def main(logger, shop_data, only_download_images = False):
@@ -118,14 +131,7 @@ async def main(logger, shop_data, only_download_images = False):
 
     conn = aiohttp.TCPConnector(limit=15)
     timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-        for entry in range(len(shop_data)):
-            url = shop_data[entry]["url"]
-            product_data, response = await download_data(logger, session, url)
-            if product_data == False:
-                shop_data[entry]["result"] = {"error": True, "error_message": response}
-                continue
-
-            shop_data[entry]["result"] = await process_response(logger, session, product_data, only_download_images)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config(), validators_trace_config()], headers=HEADERS) as session:
+        await tasks.process_entries(logger, PARALLEL_PRODUCTS, shop_data, lambda entry: process_entry(logger, session, entry, only_download_images))
 
     return shop_data
@@ -1,3 +1,7 @@
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+import app.common.shop_codes as shop_codes
 import app.database_functions as database_functions
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
@@ -19,6 +23,7 @@ def process_data(logger, update_products):
         result = database_functions.update_multiple_row_availabilities(update_products_columns, update_products, equal_params)
         if result:
             logger.info(valid.DB_PRODUCTS_UPDATED)
+            logger.info(f"Disponibilidades - escaneadas: {result['scanned']} - cambiadas: {result['changed']} - vistas: {result['touched']}")
         else:
             logger.error(error.DB_PRODUCTS_ERROR)
 
@@ -68,20 +73,21 @@ def add_product(logger, shop_data, product, is_product=False, add_product=False,
         result = False
         if process_flag == True and part_number:
             result = regex_product.process_product(availability, shop_name, 0, add_product=add_product)
+            if result:
+                shop_codes.add_code(shop_id, code)
 
         if not result or process_flag == False or not part_number:
-            session = Session()
-            result = session.query(NewAvailabilityChannels).filter(NewAvailabilityChannels.url == url).first()
-            if result:
-                session.close()
+            if shop_codes.is_known_channel_url(url):
                 return False, None
 
             logger.info(valid.product_valid(availability))
-            channel_availability = NewAvailabilityChannels(url=url, shop_name=shop_name)
-            session.add(channel_availability)
-            session.commit()
-            session.close()
-            result = True
+            # Se registran todas las de la página a la vez con register_new_availabilities
+            new_availabilities = shop_data.get("new_availabilities", None)
+            if new_availabilities is None:
+                result = register_new_availabilities(logger, shop_name, [url]) > 0
+            else:
+                new_availabilities.append(url)
+                result = True
 
         if result:
             logger.info(f"Sí se ha añadido {msg}: {availability}")
@@ -89,3 +95,32 @@ def add_product(logger, shop_data, product, is_product=False, add_product=False,
             logger.error(f"No se ha añadido {msg}: {availability}")
 
     return False, None
+
+
+def register_new_availabilities(logger, shop_name, urls):
+    # Sin una restricción única sobre url, on_conflict_do_nothing no evita los duplicados:
+    # por eso se comprueba antes qué URLs existen ya en toda la tabla
+    try:
+        new_urls = shop_codes.get_new_channel_urls(urls)
+    except SQLAlchemyError as err:
+        logger.error(f"No se han podido comprobar las disponibilidades {urls}: {err}")
+        return 0
+
+    if not new_urls:
+        return 0
+
+    session = Session()
+    try:
+        statement = insert(NewAvailabilityChannels).values([{"url": url, "shop_name": shop_name} for url in new_urls]).on_conflict_do_nothing()
+        session.execute(statement)
+        session.commit()
+    except SQLAlchemyError as err:
+        session.rollback()
+        logger.error(f"No se han añadido las disponibilidades {new_urls}: {err}")
+        return 0
+    finally:
+        session.close()
+
+    shop_codes.add_channel_urls(new_urls)
+    logger.info(f"Se han añadido {len(new_urls)} disponibilidades de {shop_name}")
+    return len(new_urls)
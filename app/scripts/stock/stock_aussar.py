@@ -1,19 +1,23 @@
 import asyncio
+from functools import partial
 
 import aiohttp
 import ujson
 
+import app.common.pagination as pagination
+import app.common.rate_limiter as rate_limiter
+import app.common.shop_codes as shop_codes
 import app.common.shops.urls.aussar as aussar_data
-import app.database_functions as database_functions
+import app.common.tasks as tasks
 import app.scripts.stock.database_handler as database_handler
-import app.shared.auxiliary.requests_handler as requests_handler
 import app.shared.error_messages as error
-import app.shared.valid_messages as valid
 from app.shared.auxiliary.functions import parse_number
 from app.shared.environment_variables import IMAGE_BASE_DIR
                                               
 
 SHOP = "Aussar"
+PARALLEL_CATEGORIES = 3
+PARALLEL_PAGES = 3
 HEADERS = {
     "Host": "www.aussar.es",
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/112.0",
@@ -37,12 +41,11 @@ IMAGE_SHOP_DIR = f"{IMAGE_BASE_DIR}/{SHOP.lower()}"
 
 async def scrape_data(logger, response, category, http_session):
     shop_id = 2
-    aussar_db_data = database_functions.perform_select_availabilities(
-        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
-    )
+    aussar_db_data = shop_codes.get_codes(shop_id)
 
     products = response.get("products", None)
     update_products = []
+    new_availabilities = []
 
     for product in products:
         product["category"] = category
@@ -50,60 +53,63 @@ async def scrape_data(logger, response, category, http_session):
         product["price"] = parse_number(product.get("price", None))
         product["stock"] = True if product.get("add_to_cart_url", False) else False
 
-        shop_data = {"shop_name": SHOP, "shop_db_data": aussar_db_data, "shop_id": shop_id}
+        shop_data = {"shop_name": SHOP, "shop_db_data": aussar_db_data, "shop_id": shop_id, "new_availabilities": new_availabilities}
         result, product_tuple = database_handler.add_product(logger, shop_data, product)
         if result == False:
             continue
         update_products.append(product_tuple)
         continue
 
+    database_handler.register_new_availabilities(logger, SHOP, new_availabilities)
+
     current_page = response.get("pagination", None).get("current_page", None)
     total_page = response.get("pagination", None).get("pages_count", None)
     return update_products, current_page, total_page
 
 
-async def main(logger, category_selected=[]):
-    url_dict = aussar_data.urls
+async def download_page(logger, session, category, url):
+    # El navegador envía como Referer la propia página de la categoría, sin el parámetro xhr
+    headers = {"Referer": url.replace("&from-xhr", "")}
     try:
-        conn = aiohttp.TCPConnector(limit=60)
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for category in url_dict:
-                if len(category_selected) > 0 and category not in category_selected:
-                    continue
-                elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
-                    continue
-
-                url = url_dict[category]
-                current_page = 1
-                update_products = []
-                while current_page:
-                    HEADERS["Referer"] = f"https://www.aussar.es/tarjetas-graficas/?page={current_page}"
-
-                    response = await requests_handler.get(logger, session, url)
-                    if not response:
-                        break
-
-                    try:
-                        response = ujson.loads(response)
-                    except:
-                        logger.error(error.parse_json(url))
-                        break
-
-                    products_list, current_page, total_page = await scrape_data(logger, response, category, session)
-                    logger.info(valid.actual_total_pages(current_page, total_page, url))
-
-                    if products_list:
-                        update_products += products_list
-
-                    if not current_page or not total_page or current_page == total_page:
-                        break
-                    url = url.replace(f"page={current_page}", f"page={current_page+1}")
-
-                database_handler.process_data(logger, update_products)
-
+        response = await rate_limiter.get(logger, session, url, headers=headers)
     except asyncio.exceptions.TimeoutError:
         logger.error(error.TIMEOUT_ERROR)
-        return False
+        return None
+
+    if not response:
+        return None
+
+    try:
+        response = ujson.loads(response)
+    except:
+        logger.error(error.parse_json(url))
+        return None
+
+    products_list, current_page, total_page = await scrape_data(logger, response, category, session)
+    return products_list, total_page, None
+
+
+async def download_category(logger, session, url, category):
+    url_for = partial(pagination.replace_page, url, "page=")
+    return await pagination.fetch_pages(logger, url_for, partial(download_page, logger, session, category), PARALLEL_PAGES)
+
+
+async def main(logger, category_selected=[]):
+    url_dict = aussar_data.urls
+    categories = []
+    for category in url_dict:
+        if len(category_selected) > 0 and category not in category_selected:
+            continue
+        elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
+            continue
+        categories.append(category)
+
+    conn = aiohttp.TCPConnector(limit=60)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS) as session:
+        results = await tasks.gather_limited(
+            PARALLEL_CATEGORIES, [download_category(logger, session, url_dict[category], category) for category in categories], return_exceptions=True
+        )
 
+    database_handler.process_data(logger, tasks.flatten(tasks.drop_exceptions(logger, results)))
     return True
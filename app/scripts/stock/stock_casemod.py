@@ -1,14 +1,17 @@
 import asyncio
+from functools import partial
 
 import aiohttp
 import ujson
 from sqlalchemy import and_
 
+import app.common.pagination as pagination
+import app.common.rate_limiter as rate_limiter
+import app.common.shop_codes as shop_codes
 import app.common.shops.urls.casemod as casemod_data
-import app.database_functions as database_functions
+import app.common.tasks as tasks
 import app.scripts.stock.database_handler as database_handler
 import app.shared.auxiliary.inputs as auxiliary_inputs
-import app.shared.auxiliary.requests_handler as requests_handler
 import app.shared.error_messages as error
 import app.shared.valid_messages as valid
 from app.shared.auxiliary.functions import parse_number
@@ -16,6 +19,8 @@ from app.stockfinder_models.Availability import Availability
 from app.stockfinder_models.base import Session
 
 SHOP = "Casemod"
+PARALLEL_CATEGORIES = 3
+PARALLEL_PAGES = 3
 HEADERS = {
     "Host": "casemod.es",
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:108.0) Gecko/20100101 Firefox/108.0",
@@ -34,12 +39,11 @@ HEADERS = {
 
 async def scrape_data(logger, response, category):
     shop_id = 10
-    casemod_db_data = database_functions.perform_select_availabilities(
-        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
-    )
+    casemod_db_data = shop_codes.get_codes(shop_id)
 
     products = response.get("products", [])
     update_products = []
+    new_availabilities = []
     first_check = True
     add_vat = False
     for product in products:
@@ -87,59 +91,58 @@ async def scrape_data(logger, response, category):
             continue
 
         json_product = {"url": url, "name": name, "code": code, "price": price, "stock": stock, "category": category}
-        shop_data = {"shop_name": SHOP, "shop_db_data": casemod_db_data, "shop_id": shop_id}
+        shop_data = {"shop_name": SHOP, "shop_db_data": casemod_db_data, "shop_id": shop_id, "new_availabilities": new_availabilities}
         result, product_tuple = database_handler.add_product(logger, shop_data, json_product)
         if result == False:
             continue
         update_products.append(product_tuple)
         continue
 
+    database_handler.register_new_availabilities(logger, SHOP, new_availabilities)
+
     return update_products
 
 
-async def download_data(logger, session, url, category):
-    currrent_page = True
-    update_products = []
-    while currrent_page:
-        response = await requests_handler.get(logger, session, url, max_redirects=30)
-        if not response:
-            break
+async def download_page(logger, session, category, url):
+    try:
+        response = await rate_limiter.get(logger, session, url, max_redirects=30)
+    except asyncio.exceptions.TimeoutError:
+        logger.error(error.TIMEOUT_ERROR)
+        return None
 
-        try:
-            response = ujson.loads(response)
-        except:
-            logger.error(error.parse_json(url))
-            break
+    if not response:
+        return None
 
-        result = await scrape_data(logger, response, category)
-        if result:
-            update_products.extend(result)
+    try:
+        response = ujson.loads(response)
+    except:
+        logger.error(error.parse_json(url))
+        return None
 
-        currrent_page = response.get("pagination", {}).get("current_page", False)
-        total_page = response.get("pagination", {}).get("pages_count", False)
-        logger.info(f"current_page: {currrent_page} - total_page: {total_page}")
-        if not currrent_page or not total_page or currrent_page == total_page:
-            break
+    result = await scrape_data(logger, response, category)
+    total_page = response.get("pagination", {}).get("pages_count", False)
+    return result, total_page, None
 
-        url = url.replace(f"page={currrent_page}", f"page={currrent_page+1}")
 
-    return update_products
+async def download_data(logger, session, url, category):
+    url_for = partial(pagination.replace_page, url, "page=")
+    return await pagination.fetch_pages(logger, url_for, partial(download_page, logger, session, category), PARALLEL_PAGES)
 
 
 async def main(logger, category_selected=[]):
-    try:
-        conn = aiohttp.TCPConnector(limit=60)
-        timeout = aiohttp.ClientTimeout(total=15)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for category in casemod_data.urls:
-                if len(category_selected) > 0 and category not in category_selected:
-                    continue
-                elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
-                    continue
-
-                url = casemod_data.urls[category]
-                update_products = await download_data(logger, session, url, category)
-                database_handler.process_data(logger, update_products)
+    categories = []
+    for category in casemod_data.urls:
+        if len(category_selected) > 0 and category not in category_selected:
+            continue
+        elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
+            continue
+        categories.append(category)
 
-    except asyncio.exceptions.TimeoutError:
-        logger.error(error.TIMEOUT_ERROR)
+    conn = aiohttp.TCPConnector(limit=60)
+    timeout = aiohttp.ClientTimeout(total=15)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS) as session:
+        results = await tasks.gather_limited(
+            PARALLEL_CATEGORIES, [download_data(logger, session, casemod_data.urls[category], category) for category in categories], return_exceptions=True
+        )
+
+    database_handler.process_data(logger, tasks.flatten(tasks.drop_exceptions(logger, results)))
@@ -1,21 +1,23 @@
 import asyncio
-import random
-import time
+from functools import partial
 
 import aiohttp
 import lxml.html
 
+import app.common.pagination as pagination
+import app.common.rate_limiter as rate_limiter
+import app.common.shop_codes as shop_codes
+import app.common.shops.selectors.coolmod as coolmod_selectors
 import app.common.shops.urls.coolmod as coolmod_data
-import app.database_functions as database_functions
+import app.common.tasks as tasks
 import app.scripts.stock.database_handler as database_handler
 import app.shared.auxiliary.inputs as auxiliary_inputs
-import app.shared.auxiliary.requests_handler as requests_handler
 import app.shared.error_messages as error
-import app.shared.valid_messages as valid
 from app.shared.auxiliary.functions import parse_number
 
 SHOP = "Coolmod"
 WEB = "https://www.coolmod.com"
+PARALLEL_CATEGORIES = 3
 
 HEADERS = {
     "Host": "www.coolmod.com",
@@ -38,37 +40,36 @@ HEADERS = {
 
 async def scrape_data(logger, response, category):
     shop_id = 3
-    coolmod_db_data = database_functions.perform_select_availabilities(
-        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
-    )
+    coolmod_db_data = shop_codes.get_codes(shop_id)
 
-    products = response.xpath("//div[contains(@class,'productInfo')]")
-    next_page = response.xpath("//div[contains(@class,'infiniteloadercontainer')]//button")
-    next_page = next_page[len(next_page)-1].xpath("./@data-page")
+    products = coolmod_selectors.XPATHS["products"](response)
+    next_page = coolmod_selectors.XPATHS["next_page_buttons"](response)
+    next_page = coolmod_selectors.XPATHS["next_page"](next_page[len(next_page)-1])
     try:
         next_page = int(next_page[0])
     except:
         next_page = None
 
     update_products = []
+    new_availabilities = []
 
     for product in products:
-        code = product.xpath("./@id")
+        code = coolmod_selectors.XPATHS["code"](product)
         if not code:
             logger.warning(error.CODE_NOT_FOUND)
             continue
         code = int(parse_number(code[0].replace("productPROD-", "")))
 
-        price = product.xpath("./@data-price")
+        price = coolmod_selectors.XPATHS["price"](product)
         if not price:
             logger.warning(error.PRODUCT_PRICE_NOT_FOUND)
             continue
         price = parse_number(price[0])
 
-        stock = product.xpath("(.//span[@class='stock on'])")
+        stock = coolmod_selectors.XPATHS["stock"](product)
         stock = True if stock else False
 
-        name = product.xpath(".//div[@class='productName']//div//div//a//text()")
+        name = coolmod_selectors.XPATHS["name"](product)
         if not name:
             logger.warning(error.PRODUCT_NAME_NOT_FOUND)
             continue
@@ -82,62 +83,62 @@ async def scrape_data(logger, response, category):
 
         name = auxiliary_inputs.fix_name(name[0])
 
-        url = product.xpath(".//div[@class='productName']//div//div//a/@href")
+        url = coolmod_selectors.XPATHS["url"](product)
         if not url:
             logger.warning(error.URL_NOT_FOUND)
             continue
         url = WEB + url[0]
 
         json_product = {"url": url, "name": name, "code": code, "price": price, "stock": stock, "category": category, "refurbished": refurbished}
-        shop_data = {"shop_name": SHOP, "shop_db_data": coolmod_db_data, "shop_id": shop_id}
+        shop_data = {"shop_name": SHOP, "shop_db_data": coolmod_db_data, "shop_id": shop_id, "new_availabilities": new_availabilities}
         result, product_tuple = database_handler.add_product(logger, shop_data, json_product)
         if result == False:
             continue
         update_products.append(product_tuple)
         continue
 
+    database_handler.register_new_availabilities(logger, SHOP, new_availabilities)
+
     return update_products, next_page
 
 
-async def main(logger, category_selected=[]):
+async def download_page(logger, session, category, url):
     try:
-        conn = aiohttp.TCPConnector(limit=60)
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for category in coolmod_data.urls:
-                if len(category_selected) > 0 and category not in category_selected:
-                    continue
-                elif (category == "GPU" or category == "CPU" or category == "Reaco") and len(category_selected) == 0:
-                    continue
-
-                url = coolmod_data.urls[category]
-                current_page = 1
-                update_products = []
-                while current_page:
-
-                    response = await requests_handler.get(logger, session, url)
-                    if not response:
-                        continue
-
-                    try:
-                        response = lxml.html.fromstring(response)
-                    except:
-                        logger.error(error.parse_html(url))
-                        continue
-
-                    products, next_page = await scrape_data(logger, response, category)
-                    logger.info(valid.actual_total_pages(current_page, next_page, url))
-                    
-                    url = url.replace(f"pagina={current_page}", f"pagina={next_page}")
-                    update_products.append(products)
-                    database_handler.process_data(logger, products)
-
-                    if not next_page or current_page == next_page:
-                        break
-                    current_page += 1
-
-                    wait_time = random.randint(200, 500) / 1000
-                    time.sleep(wait_time)
-
+        response = await rate_limiter.get(logger, session, url)
     except asyncio.exceptions.TimeoutError:
         logger.error(error.TIMEOUT_ERROR)
+        return None
+
+    if not response:
+        return None
+
+    try:
+        response = lxml.html.fromstring(response)
+    except:
+        logger.error(error.parse_html(url))
+        return None
+
+    products, next_page = await scrape_data(logger, response, category)
+    return products, None, next_page
+
+
+async def download_category(logger, session, category):
+    url_for = partial(pagination.replace_page, coolmod_data.urls[category], "pagina=")
+    return await pagination.fetch_pages(logger, url_for, partial(download_page, logger, session, category))
+
+
+async def main(logger, category_selected=[]):
+    categories = []
+    for category in coolmod_data.urls:
+        if len(category_selected) > 0 and category not in category_selected:
+            continue
+        elif (category == "GPU" or category == "CPU" or category == "Reaco") and len(category_selected) == 0:
+            continue
+        categories.append(category)
+
+    conn = aiohttp.TCPConnector(limit=60)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS) as session:
+        results = await tasks.gather_limited(PARALLEL_CATEGORIES, [download_category(logger, session, category) for category in categories], return_exceptions=True)
+
+    database_handler.process_data(logger, tasks.flatten(tasks.drop_exceptions(logger, results)))
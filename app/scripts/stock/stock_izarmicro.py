@@ -1,21 +1,22 @@
 import asyncio
-import random
 import re
-import time
 
 import aiohttp
 import lxml.html
 
+import app.common.rate_limiter as rate_limiter
+import app.common.shop_codes as shop_codes
+import app.common.shops.selectors.izarmicro as izarmicro_selectors
 import app.common.shops.urls.izarmicro as izarmicro_data
-import app.database_functions as database_functions
+import app.common.tasks as tasks
 import app.scripts.stock.database_handler as database_handler
 import app.shared.auxiliary.inputs as auxiliary_inputs
-import app.shared.auxiliary.requests_handler as requests_handler
 import app.shared.error_messages as error
 import app.shared.valid_messages as valid
 from app.shared.auxiliary.functions import parse_number
 
 SHOP = "IzarMicro"
+PARALLEL_CATEGORIES = 3
 USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_20_77) AppleWebKit/531.71.18 (KHTML, like Gecko) Chrome/55.1.6997.1625 Safari/532.00 Edge/36.04460"
 HEADERS = {
     "Origin": "www.izarmicro.com",
@@ -29,21 +30,20 @@ HEADERS = {
 
 async def scrape_data(logger, response, category):
     shop_id = 4
-    izarmicro_db_data = database_functions.perform_select_availabilities(
-        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
-    )
+    izarmicro_db_data = shop_codes.get_codes(shop_id)
 
-    products = response.xpath("(.//div[@class='divproportada2'])")
+    products = izarmicro_selectors.XPATHS["products"](response)
     update_products = []
+    new_availabilities = []
 
     counter = 0
     for product in products:
-        destacado = product.xpath(f"(.//div[@class='plist_img2'])//span[@class='destacado']/text()")
+        destacado = izarmicro_selectors.XPATHS["featured"](product)
         if destacado and counter == 0:
             counter += 1
             continue
 
-        url = product.xpath(f"(.//div[@class='plist_img2'])//a/@href")
+        url = izarmicro_selectors.XPATHS["url"](product)
         if not url:
             logger.warning(f"NO url {url}")
             continue
@@ -58,36 +58,36 @@ async def scrape_data(logger, response, category):
         code = int(code)
 
         try:
-            price = product.xpath(f"(.//div[@class='tdispo4'])//div[2]//span/text()")[0]
+            price = izarmicro_selectors.XPATHS["price"](product)[0]
         except:
             logger.warning(f"NO price")
             continue
         price = auxiliary_inputs.fix_name(price)
         price = parse_number(float(price))
 
-        stock = product.xpath(f"(.//button[@class='compra2'])/text()")
+        stock = izarmicro_selectors.XPATHS["stock"](product)
         if not stock:
             stock = False
         else:
             stock = stock[0].upper()
             stock = True if stock == "COMPRAR" else False
 
-        name = product.xpath(f"(.//div[@class='plist_img2'])//a/text()")
+        name = izarmicro_selectors.XPATHS["name"](product)
         if not name:
-            name = product.xpath(f"(.//div[@class='plist_img2'])//a//h2/text()")
+            name = izarmicro_selectors.XPATHS["name_h2"](product)
             if not name:
                 logger.warning(error.PRODUCT_NAME_NOT_FOUND)
                 continue
 
         name = auxiliary_inputs.fix_name(name[0])
 
-        second_name = product.xpath(f"(.//div[@class='plist_img2'])//span[@class='desport']/text()")
+        second_name = izarmicro_selectors.XPATHS["second_name"](product)
         if second_name:
             second_name = second_name[0]
         else:
             second_name = None
 
-        part_number = product.xpath(f"(.//div[@class='plist_img2'])//span[@class='mpntxt']/text()")
+        part_number = izarmicro_selectors.XPATHS["part_number"](product)
         if part_number:
             part_number = part_number[0]
         else:
@@ -106,7 +106,7 @@ async def scrape_data(logger, response, category):
             "part_number": part_number,
             "second_name": second_name,
         }
-        shop_data = {"shop_name": SHOP, "shop_db_data": izarmicro_db_data, "shop_id": shop_id}
+        shop_data = {"shop_name": SHOP, "shop_db_data": izarmicro_db_data, "shop_id": shop_id, "new_availabilities": new_availabilities}
 
         if category == "CPU Cooler" or category == "Chassis":
             result, product_tuple = database_handler.add_product(logger, shop_data, json_product)
@@ -118,42 +118,44 @@ async def scrape_data(logger, response, category):
         update_products.append(product_tuple)
         continue
 
+    database_handler.register_new_availabilities(logger, SHOP, new_availabilities)
+
     return update_products
 
 
-async def main(logger, category_selected=[]):
+async def download_url(logger, session, url, category):
     try:
-        for category in izarmicro_data.urls:
-            conn = aiohttp.TCPConnector(limit=60)
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-                if len(category_selected) > 0 and category not in category_selected:
-                    continue
-                elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
-                    continue
-
-                update_products = []
-                for data in izarmicro_data.urls[category]:
-                    url = data.get("url", None)
-
-                    response = await requests_handler.get(logger, session, url)
-                    if not response:
-                        continue
-
-                    try:
-                        response = lxml.html.fromstring(response)
-                    except:
-                        logger.error(error.parse_html(url))
-                        continue
-
-                    products_list = await scrape_data(logger, response, category)
-                    if products_list:
-                        update_products += products_list
-
-            database_handler.process_data(logger, update_products)
-
-            wait_time = random.randint(500, 3000) / 1000
-            time.sleep(wait_time)
-
+        response = await rate_limiter.get(logger, session, url)
     except asyncio.exceptions.TimeoutError:
         logger.error(error.TIMEOUT_ERROR)
+        return []
+
+    if not response:
+        return []
+
+    try:
+        response = lxml.html.fromstring(response)
+    except:
+        logger.error(error.parse_html(url))
+        return []
+
+    return await scrape_data(logger, response, category)
+
+
+async def main(logger, category_selected=[]):
+    urls = []
+    for category in izarmicro_data.urls:
+        if len(category_selected) > 0 and category not in category_selected:
+            continue
+        elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
+            continue
+
+        for data in izarmicro_data.urls[category]:
+            urls.append((data.get("url", None), category))
+
+    conn = aiohttp.TCPConnector(limit=60)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS) as session:
+        results = await tasks.gather_limited(PARALLEL_CATEGORIES, [download_url(logger, session, url, category) for url, category in urls], return_exceptions=True)
+
+    database_handler.process_data(logger, tasks.flatten(tasks.drop_exceptions(logger, results)))
@@ -1,24 +1,26 @@
 import asyncio
-import random
 import re
-import time
+from functools import partial
 
 import aiohttp
 import lxml.html
 import ujson
 import unidecode
 
+import app.common.pagination as pagination
+import app.common.rate_limiter as rate_limiter
+import app.common.shop_codes as shop_codes
+import app.common.shops.selectors.ldlc as ldlc_selectors
 import app.common.shops.urls.ldlc as ldlc_data
-import app.database_functions as database_functions
+import app.common.tasks as tasks
 import app.scripts.stock.database_handler as database_handler
 import app.shared.auxiliary.inputs as auxiliary_inputs
-import app.shared.auxiliary.requests_handler as requests_handler
 import app.shared.error_messages as error
-import app.shared.valid_messages as valid
 from app.shared.auxiliary.functions import parse_number
 
 SHOP = "LDLC"
 WEB = "https://www.ldlc.com"
+PARALLEL_CATEGORIES = 2
 HEADERS = {
     "Host": "www.ldlc.com",
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:103.0) Gecko/20100101 Firefox/103.0",
@@ -52,15 +54,14 @@ async def scrape_data(logger, response, url, category):
         return None
 
     shop_id = 5
-    ldlc_db_data = database_functions.perform_select_availabilities(
-        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
-    )
+    ldlc_db_data = shop_codes.get_codes(shop_id)
 
-    products = listing.xpath("(.//div[@class='listing-product'])//li[@class='pdt-item']")
+    products = ldlc_selectors.XPATHS["products"](listing)
     update_products = []
+    new_availabilities = []
 
     for product in products:
-        url = product.xpath("(.//h3[@class='title-3']//a/@href)")
+        url = ldlc_selectors.XPATHS["url"](product)
         if not url:
             continue
         url = url[0]
@@ -74,94 +75,101 @@ async def scrape_data(logger, response, url, category):
         code = int(code_string[0])
 
         try:
-            price_int = product.xpath("(.//div[@class='basket'])//div//div/text()")[0].replace("€", "")
+            price_int = ldlc_selectors.XPATHS["price_int"](product)[0].replace("€", "")
             price_int = parse_number(unidecode.unidecode(price_int).replace(" ", ""))
-            price_dec = product.xpath("(.//div[@class='basket'])//div//div//sup/text()")[0]
+            price_dec = ldlc_selectors.XPATHS["price_dec"](product)[0]
             price = parse_number(str(price_int) + "." + str(price_dec))
         except:
             price = -1
 
-        stock1 = product.xpath("(.//div[@data-stock-web='9'])")
-        stock2 = product.xpath("(.//div[@data-stock-web='10'])")
+        stock1 = ldlc_selectors.XPATHS["no_stock_9"](product)
+        stock2 = ldlc_selectors.XPATHS["no_stock_10"](product)
         stock = True if (not stock1 and not stock2) else False
 
         url = WEB + url
-        name = product.xpath("(.//h3[@class='title-3'])//a/text()")
+        name = ldlc_selectors.XPATHS["name"](product)
         if not name:
             logger.warning(error.PRODUCT_NAME_NOT_FOUND)
             continue
         name = auxiliary_inputs.fix_name(name[0])
 
-        description = product.xpath(".//div[@class='pdt-desc']//p/text()")
+        description = ldlc_selectors.XPATHS["description"](product)
         description = description[0] if description else None
 
         json_product = {"url": url, "name": name, "code": code, "price": price, "stock": stock, "category": category, "description": description}
-        shop_data = {"shop_name": SHOP, "shop_db_data": ldlc_db_data, "shop_id": shop_id}
+        shop_data = {"shop_name": SHOP, "shop_db_data": ldlc_db_data, "shop_id": shop_id, "new_availabilities": new_availabilities}
         result, product_tuple = database_handler.add_product(logger, shop_data, json_product)
         if result == False:
             continue
         update_products.append(product_tuple)
         continue
 
+    database_handler.register_new_availabilities(logger, SHOP, new_availabilities)
+
     current_page = response.get("page", None)
     try:
-        total_page = listing.xpath("(.//li[@class='next'])//a/@data-page")[0]
+        total_page = ldlc_selectors.XPATHS["total_page"](listing)[0]
     except:
         total_page = current_page
 
     return update_products, current_page, total_page
 
 
-async def main(logger, category_selected=[]):
-    url_dict = ldlc_data.urls
-    try:
-        conn = aiohttp.TCPConnector(limit=60)
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for category in url_dict:
-                if len(category_selected) > 0 and category not in category_selected:
-                    continue
-                elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
-                    continue
-
-                url_list = url_dict[category]
-
-                for url in url_list:
-                    update_products = []
-                    current_page = 1
-
-                    while current_page:
-                        HEADERS["Refer"] = f"{url}"
-
-                        response = await requests_handler.post(logger, session, url, data=DATA, headers=HEADERS)
-                        if not response:
-                            continue
-
-                        try:
-                            response = ujson.loads(response)
-                        except:
-                            logger.error(error.parse_json(url))
-                            continue
-
-                        products_list, current_page, next_page = await scrape_data(logger, response, url, category)
-                        logger.info(valid.actual_next_page(current_page, next_page, url))
-
-                        wait_time = random.randint(3000, 5000) / 1000
-                        time.sleep(wait_time)
-
-                        if products_list:
-                            update_products += products_list
-                        if not current_page or not next_page or current_page == next_page:
-                            break
-                        if current_page == 1:
-                            url = url.replace(f"page", f"page{next_page}")
-                        else:
-                            url = url.replace(f"page{current_page}", f"page{next_page}")
-
-                    database_handler.process_data(logger, update_products)
+def page_url(url, page):
+    if page == 1:
+        return url
+    return url.replace("page", f"page{page}")
 
+
+async def download_page(logger, session, category, url):
+    headers = {**HEADERS, "Refer": f"{url}"}
+    try:
+        response = await rate_limiter.post(logger, session, url, data=DATA, headers=headers)
     except asyncio.exceptions.TimeoutError:
         logger.error(error.TIMEOUT_ERROR)
-        return False
+        return None
+
+    if not response:
+        return None
+
+    try:
+        response = ujson.loads(response)
+    except:
+        logger.error(error.parse_json(url))
+        return None
+
+    result = await scrape_data(logger, response, url, category)
+    if not result:
+        return None
+
+    products_list, current_page, next_page = result
+    try:
+        next_page = int(next_page)
+    except (TypeError, ValueError):
+        next_page = None
+    return products_list, None, next_page
+
+
+async def download_url(logger, session, url, category):
+    return await pagination.fetch_pages(logger, partial(page_url, url), partial(download_page, logger, session, category))
+
+
+async def main(logger, category_selected=[]):
+    url_dict = ldlc_data.urls
+    urls = []
+    for category in url_dict:
+        if len(category_selected) > 0 and category not in category_selected:
+            continue
+        elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
+            continue
+
+        for url in url_dict[category]:
+            urls.append((url, category))
+
+    conn = aiohttp.TCPConnector(limit=60)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS) as session:
+        results = await tasks.gather_limited(PARALLEL_CATEGORIES, [download_url(logger, session, url, category) for url, category in urls], return_exceptions=True)
 
+    database_handler.process_data(logger, tasks.flatten(tasks.drop_exceptions(logger, results)))
     return True
@@ -1,15 +1,14 @@
 import asyncio
-import random
-import time
 
 import aiohttp
 import ujson
 
+import app.common.rate_limiter as rate_limiter
+import app.common.shop_codes as shop_codes
 import app.common.shops.urls.neobyte as neobyte_data
-import app.database_functions as database_functions
+import app.common.tasks as tasks
 import app.scripts.stock.database_handler as database_handler
 import app.shared.auxiliary.inputs as auxiliary_inputs
-import app.shared.auxiliary.requests_handler as requests_handler
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
@@ -17,6 +16,7 @@ from app.shared.auxiliary.functions import parse_number
 
 SHOP = "Neobyte"
 WEB = "https://www.neobyte.es"
+PARALLEL_CATEGORIES = 3
 
 HEADERS = {
     "Accept": "application/json, text/javascript, */*; q=0.0",
@@ -30,12 +30,11 @@ HEADERS = {
 
 async def scrape_data(logger, response, category):
     shop_id = 7
-    neobyte_db_data = database_functions.perform_select_availabilities(
-        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
-    )
+    neobyte_db_data = shop_codes.get_codes(shop_id)
 
     elements = response["products"]
     update_products = []
+    new_availabilities = []
 
     for element in elements:
         code = int(element.get("id_product", None))
@@ -70,48 +69,51 @@ async def scrape_data(logger, response, category):
         description = element.get("description_short", None)
 
         json_product = {"url": url, "name": name, "code": code, "price": price, "stock": stock, "category": category, "description": description}
-        shop_data = {"shop_name": SHOP, "shop_db_data": neobyte_db_data, "shop_id": shop_id}
+        shop_data = {"shop_name": SHOP, "shop_db_data": neobyte_db_data, "shop_id": shop_id, "new_availabilities": new_availabilities}
         result, product_tuple = database_handler.add_product(logger, shop_data, json_product)
         if result == False:
             continue
         update_products.append(product_tuple)
         continue
 
+    database_handler.register_new_availabilities(logger, SHOP, new_availabilities)
+
     return update_products
 
 
-async def main(logger, category_selected=[]):
+async def download_data(logger, session, url, category):
     try:
-        conn = aiohttp.TCPConnector(limit=60)
-        timeout = aiohttp.ClientTimeout(total=45)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for category in neobyte_data.urls:
-                if len(category_selected) > 0 and category not in category_selected:
-                    continue
-                elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
-                    continue
+        response = await rate_limiter.get(logger, session, url)
+    except asyncio.exceptions.TimeoutError:
+        logger.error(error.TIMEOUT_ERROR)
+        return []
 
-                url = neobyte_data.urls[category]
-                HEADERS["Referer"] = url
+    if not response:
+        return []
 
-                response = await requests_handler.get(logger, session, url)
-                if not response:
-                    continue
+    try:
+        response = ujson.loads(response)
+    except:
+        logger.error(error.parse_html(url))
+        return []
 
-                try:
-                    response = ujson.loads(response)
-                except:
-                    logger.error(error.parse_html(url))
-                    continue
+    return await scrape_data(logger, response, category)
 
-                update_products = await scrape_data(logger, response, category)
-                if not update_products:
-                    continue
 
-                database_handler.process_data(logger, update_products)
+async def main(logger, category_selected=[]):
+    categories = []
+    for category in neobyte_data.urls:
+        if len(category_selected) > 0 and category not in category_selected:
+            continue
+        elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
+            continue
+        categories.append(category)
 
-                wait_time = random.randint(500, 3000) / 1000
-                time.sleep(wait_time)
+    conn = aiohttp.TCPConnector(limit=60)
+    timeout = aiohttp.ClientTimeout(total=45)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS) as session:
+        results = await tasks.gather_limited(
+            PARALLEL_CATEGORIES, [download_data(logger, session, neobyte_data.urls[category], category) for category in categories], return_exceptions=True
+        )
 
-    except asyncio.exceptions.TimeoutError:
-        logger.error(error.TIMEOUT_ERROR)
+    database_handler.process_data(logger, tasks.flatten(tasks.drop_exceptions(logger, results)))
@@ -3,18 +3,17 @@ import datetime
 import json
 import logging
 import math
+import os
 import re
 import time
-import typing
 
 import aiohttp
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.exceptions import InfluxDBError
-from influxdb_client.client.write_api import SYNCHRONOUS
 from sqlalchemy import and_, func
-from urllib3.exceptions import ReadTimeoutError
+from sqlalchemy.exc import SQLAlchemyError
 
-import app.shared.environment_variables as ev
+import app.common.adaptive_poll as adaptive_poll
+import app.common.metrics as metrics
+import app.common.rate_limiter as rate_limiter
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
@@ -63,23 +62,55 @@ HEADERS = {
 
 NVIDIA_SHOP_ID = 9
 
+# Sondeo adaptativo (segundos). Las ventanas son UTC: "22:00-22:09" o "tue 13:00-16:00", separadas por comas
+poller = adaptive_poll.AdaptivePoller(
+    base=int(os.environ.get("NVIDIA_POLL_BASE", "90")),
+    min_interval=int(os.environ.get("NVIDIA_POLL_MIN", "20")),
+    max_interval=int(os.environ.get("NVIDIA_POLL_MAX", "300")),
+    requests_per_hour=int(os.environ.get("NVIDIA_REQUESTS_PER_HOUR", "400")),
+    drop_windows=os.environ.get("NVIDIA_DROP_WINDOWS", ""),
+    pause_windows=os.environ.get("NVIDIA_PAUSE_WINDOWS", "22:00-22:09"),
+)
+
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-class BatchingCallback(object):
-    def success(self, conf: typing.Tuple[str, str, str], data: str):
-        logger.info(f"Written batch: {conf}, data: {data}")
+# fe_sku (sin sufijo) -> product_id. Se carga una vez y solo se vuelve a consultar cuando aparece un SKU desconocido
+part_numbers = {}
+# fe_sku -> (is_active, price, time.monotonic() de la última pasada en la que se vio)
+last_states = {}
+http_session = None
+
 
-    def error(self, conf: typing.Tuple[str, str, str], data: str, exception: InfluxDBError):
-        logger.error(f"Cannot write batch: {conf}, data: {data} due: {exception}")
+def load_part_numbers(session):
+    rows = (
+        session.query(ProductPartNumber.part_number, ProductPartNumber.product_id)
+        .join(Availability, Availability.product_id == ProductPartNumber.product_id)
+        .filter(Availability.shop_id == NVIDIA_SHOP_ID)
+        .all()
+    )
+    part_numbers.clear()
+    part_numbers.update({part_number: product_id for part_number, product_id in rows})
+    logger.info(f"{len(part_numbers)} part numbers de {SERVICE_NAME} cargados")
 
-    def retry(self, conf: typing.Tuple[str, str, str], data: str, exception: InfluxDBError):
-        logger.warning(f"Retryable error occurs for batch: {conf}, data: {data} retry: {exception}")
 
+def get_product_id(session, part_number):
+    if not part_numbers:
+        load_part_numbers(session)
+    product_id = part_numbers.get(part_number, None)
+    if product_id:
+        return product_id
+
+    ProductPartNumber_db = session.query(ProductPartNumber).filter(ProductPartNumber.part_number == part_number).first()
+    if ProductPartNumber_db:
+        part_numbers[part_number] = ProductPartNumber_db.product_id
+        return ProductPartNumber_db.product_id
+    return None
 
-async def process_data(product, proxy_chosen):
+
+def process_data(session, product, proxy_chosen):
     price = product.get("price", None)
     active = product.get("is_active", None)
     part_number = product.get("fe_sku", None)
@@ -101,10 +132,10 @@ async def process_data(product, proxy_chosen):
     url = f"https://store.nvidia.com/es-es/geforce/store/?page=1&limit=9&locale=es-es&gpu=RTX%20{gpu_model}&category=GPU,DESKTOP"
 
     new_product = {"url": url, "name": name, "part_number": part_number, "price": price, "stock": active}
+    record_state(part_number, active, price)
 
-    session = Session()
-    ProductPartNumber_db = session.query(ProductPartNumber).filter(ProductPartNumber.part_number == part_number).first()
-    if not ProductPartNumber_db:
+    product_id = get_product_id(session, part_number)
+    if not product_id:
         highest_code = session.query(func.max(Availability.code)).filter(Availability.shop_id == NVIDIA_SHOP_ID).first()
 
         new_product["category"] = "GPU"
@@ -116,63 +147,96 @@ async def process_data(product, proxy_chosen):
         result = regex_product.process_product(new_product, "NVIDIA", 0)
         if result == 0:
             logger.warning(f"No se ha registrado el producto")
-            session.close()
             return
 
         # ASOCIAR LA ALERTA AL USUARIO
-        ProductPartNumber_db = session.query(ProductPartNumber).filter(ProductPartNumber.part_number == part_number).first()
-        if not ProductPartNumber_db:
+        product_id = get_product_id(session, part_number)
+        if not product_id:
             logger.error(f"No se ha obtenido el ProductPartNumber")
-            session.close()
             return
 
         new_alert = Alert(
             user_id=1390,
-            product_id=ProductPartNumber_db.product_id,
+            product_id=product_id,
             max_price=math.ceil(price / 100) * 100,
             alert_by_telegram=True,
             alert_by_email=False,
         )
         session.add(new_alert)
-        session.close()
         logger.error(f"Se ha creado la alerta {new_alert}")
         return
 
     logger.info(valid.nvidia_custom_msg(new_product, f"Se han recogido los datos - Proxy {proxy_chosen}"))
-    availability_db = session.query(Availability).filter(and_(Availability.product_id == ProductPartNumber_db.product_id)).first()
-    if not availability_db:
+    logger.info(valid.nvidia_custom_msg(new_product, "Se actualiza la DB"))
+    data = {"url": url, "stock": active, "price": price}
+    updated = session.query(Availability).filter(and_(Availability.product_id == product_id)).update(data, synchronize_session=False)
+    if not updated:
         logger.warning(error.product_not_in_DB(new_product))
-        session.close()
+        part_numbers.pop(part_number, None)
+
+
+# Un cambio de stock o precio acelera el sondeo. El tiempo de detección es, como mucho, el tiempo desde la pasada anterior
+def record_state(part_number, active, price):
+    now = time.monotonic()
+    previous = last_states.get(part_number, None)
+    last_states[part_number] = (active, price, now)
+    if previous is None:
         return
 
-    logger.info(valid.nvidia_custom_msg(new_product, "Se actualiza la DB"))
-    data = {"url": url, "stock": active, "price": price}
-    availability_db = (
-        session.query(Availability).filter(and_(Availability.product_id == ProductPartNumber_db.product_id)).update(data, synchronize_session=False)
-    )
-    session.commit()
-    session.close()
+    previous_active, previous_price, previous_seen = previous
+    changes = []
+    if previous_active != active:
+        changes.append("is_active")
+    if previous_price != price:
+        changes.append("price")
+
+    for field in changes:
+        poller.record_flip()
+        detect_window = round(now - previous_seen, 1)
+        logger.warning(
+            f"{part_number}: {field} ha cambiado (stock {previous_active} -> {active}, precio {previous_price} -> {price}) - detectado en <= {detect_window} s"
+        )
+        metrics.write(
+            {
+                "measurement": "Flip",
+                "tags": {"service": f"Check Stock {SERVICE_NAME}", "sku": part_number, "field": field},
+                "fields": {"Time to detect": detect_window, "Stock": active, "Price": price},
+                "time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }
+        )
+
+
+# Sesión HTTP compartida entre pasadas para reutilizar las conexiones TLS con la API
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        timeout = aiohttp.ClientTimeout(total=7)
+        connector = aiohttp.TCPConnector(limit=len(API_URLS), keepalive_timeout=300)
+        http_session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS)
+    return http_session
 
 
 async def scrape_api(url):
     try:
-        timeout = aiohttp.ClientTimeout(total=7)
-        async with aiohttp.ClientSession(timeout=timeout, headers=HEADERS) as session:
-            proxy_chosen = None
-            async with session.get(url, proxy=proxy_chosen) as response:
-                if response.status != 200:
-                    return logger.error(error.code_not_200(url, response.status))
+        session = get_http_session()
+        proxy_chosen = None
+        await rate_limiter.acquire(url)
+        async with session.get(url, proxy=proxy_chosen) as response:
+            if response.status != 200:
+                logger.error(error.code_not_200(url, response.status))
+                return None
 
-                response = await response.text()
+            response = await response.text()
 
         try:
             json_response = json.loads(response)
         except:
             logger.error(error.JSON_ERROR)
-            return logger.error(response)
+            logger.error(response)
+            return None
 
         logger.info(valid.url_successful(url))
-        await asyncio.gather(*[process_data(product, proxy_chosen=proxy_chosen) for product in json_response["listMap"]])
+        return json_response.get("listMap", [])
 
     except asyncio.exceptions.TimeoutError:
         logger.error(error.TIMEOUT_ERROR)
@@ -183,44 +247,54 @@ async def scrape_api(url):
     except:
         logger.error("Error desconocido")
 
+    return None
+
 
 async def main():
-    sleep()
+    pause = poller.pause_remaining()
+    if pause:
+        logger.info(f"Pausa de {round(pause)} s")
+        await asyncio.sleep(pause)
+
     t0 = datetime.datetime.now()
     logger.info(f"The Scrape of {SERVICE_NAME} for checking the stock will start")
 
-    for url in API_URLS:
-        await scrape_api(url)
+    # Los SKUs se consultan a la vez y los resultados se guardan con una única sesión de la DB
+    results = await asyncio.gather(*[scrape_api(url) for url in API_URLS])
+    poller.record_requests(len(API_URLS))
+    ok = None not in results
+    # Cada producto va en un SAVEPOINT: un error en uno no descarta los cambios del resto ni detiene el sondeo
+    session = Session()
+    try:
+        for products in results:
+            for product in products or []:
+                try:
+                    with session.begin_nested():
+                        process_data(session, product, proxy_chosen=None)
+                except Exception as err:
+                    logger.error(f"Error procesando {product.get('fe_sku', None)}: {err}")
+        session.commit()
+    except SQLAlchemyError as err:
+        session.rollback()
+        logger.error(f"No se han podido guardar los cambios: {err}")
+        ok = False
+    finally:
+        session.close()
+    poller.record_result(ok)
 
     t1 = datetime.datetime.now()
     elapsed_time = float(round((t1 - t0).total_seconds() * 1000))
-    logger.info(f"The Scrape of {SERVICE_NAME} has finished - elapsed_time: {elapsed_time} ms")
+    delay, reason = poller.next_delay(len(API_URLS))
+    logger.info(f"The Scrape of {SERVICE_NAME} has finished - elapsed_time: {elapsed_time} ms - next in {round(delay)} s ({reason})")
 
     actual_time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-    client = InfluxDBClient(url=ev.INFLUXDB_URL, token=ev.INFLUXDB_TOKEN, org=ev.INFLUXDB_ORG)
-    callback = BatchingCallback()
-    write_api = client.write_api(write_options=SYNCHRONOUS, success_callback=callback.success, error_callback=callback.error, retry_callback=callback.retry)
-
-    try:
-        write_api.write(
-            bucket=ev.INFLUXDB_BUCKET,
-            record=[
-                {
-                    "measurement": "Stock",
-                    "tags": {"service": f"Check Stock {SERVICE_NAME}"},
-                    "fields": {"Elapsed time": elapsed_time},
-                    "time": actual_time,
-                }
-            ],
-        )
-    except ReadTimeoutError:
-        pass
-
-    await asyncio.sleep(90)
-
+    metrics.write(
+        {
+            "measurement": "Stock",
+            "tags": {"service": f"Check Stock {SERVICE_NAME}", "reason": reason},
+            "fields": {"Elapsed time": elapsed_time, "Poll interval": float(delay)},
+            "time": actual_time,
+        }
+    )
 
-def sleep():
-    current_hour = int(datetime.datetime.utcnow().strftime("%H"))
-    if current_hour == 22:
-        sleep_time = 9 * 60
-        time.sleep(sleep_time)
+    await asyncio.sleep(delay)
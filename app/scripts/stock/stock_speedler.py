@@ -1,22 +1,23 @@
 import asyncio
-import random
 import re
-import time
 
 import aiohttp
 import lxml.html
 import ujson
 
+import app.common.rate_limiter as rate_limiter
+import app.common.shop_codes as shop_codes
+import app.common.shops.selectors.speedler as speedler_selectors
 import app.common.shops.urls.speedler as speedler_data
-import app.database_functions as database_functions
+import app.common.tasks as tasks
 import app.scripts.stock.database_handler as database_handler
 import app.shared.auxiliary.inputs as auxiliary_inputs
-import app.shared.auxiliary.requests_handler as requests_handler
 import app.shared.error_messages as error
 import app.shared.valid_messages as valid
 from app.shared.auxiliary.functions import parse_number
 
 SHOP = "Speedler"
+PARALLEL_CATEGORIES = 2
 
 HEADERS = {
     "Host": "www.speedler.es",
@@ -65,57 +66,63 @@ URL = "https://www.speedler.es/ajax/product_list"
 
 async def scrape_data(logger, response, category):
     shop_id = 17
-    speedler_db_data = database_functions.perform_select_availabilities(
-        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
-    )
+    speedler_db_data = shop_codes.get_codes(shop_id)
 
     update_products = []
+    new_availabilities = []
 
-    products = response.xpath("//div[@class='JS_product prod prodGrid2']")
+    products = speedler_selectors.XPATHS["products"](response)
     for product in products:
-        code = product.xpath("./@sku")
+        code = speedler_selectors.XPATHS["code"](product)
         if not code:
             logger.warning(error.CODE_NOT_FOUND)
             continue
         code = int(parse_number(code[0]))
 
-        price = product.xpath("./@price")
+        price = speedler_selectors.XPATHS["price"](product)
         if not price:
             logger.warning(error.PRODUCT_PRICE_NOT_FOUND)
             continue
         price = parse_number(price[0])
 
-        stock = product.xpath(".//div[@class='side-loader']//span//text()")
+        stock = speedler_selectors.XPATHS["stock"](product)
         if stock:
             stock = True if stock[0] == "En stock" or stock[0] == "Últimas unidades" else False
         else:
             stock = False
 
-        name = product.xpath("./@name")
+        name = speedler_selectors.XPATHS["name"](product)
         if not name:
             logger.warning(error.PRODUCT_NAME_NOT_FOUND)
             continue
         name = auxiliary_inputs.fix_name(name[0])
 
-        url = product.xpath(".//a[@class='JSproductName name']/@href")
+        url = speedler_selectors.XPATHS["url"](product)
         if not url:
             logger.warning(error.URL_NOT_FOUND)
             continue
         url = url[0]
 
         json_product = {"url": url, "name": name, "code": code, "price": price, "stock": stock, "category": category}
-        shop_data = {"shop_name": SHOP, "shop_db_data": speedler_db_data, "shop_id": shop_id}
+        shop_data = {"shop_name": SHOP, "shop_db_data": speedler_db_data, "shop_id": shop_id, "new_availabilities": new_availabilities}
         result, product_tuple = database_handler.add_product(logger, shop_data, json_product)
         if result == False:
             continue
         update_products.append(product_tuple)
         continue
 
+    database_handler.register_new_availabilities(logger, SHOP, new_availabilities)
+
     return update_products
 
 
-async def download_data(logger, session, url, category):
-    response = await requests_handler.post(logger, session, url, data=BODY, headers=HEADERS)
+async def download_data(logger, session, url, category, body):
+    try:
+        response = await rate_limiter.post(logger, session, url, data=body, headers=HEADERS)
+    except asyncio.exceptions.TimeoutError:
+        logger.error(error.TIMEOUT_ERROR)
+        return False
+
     if not response:
         return False
 
@@ -134,31 +141,33 @@ async def download_data(logger, session, url, category):
     return await scrape_data(logger, response, category)
 
 
-async def main(logger, category_selected=[]):
-    try:
-        conn = aiohttp.TCPConnector(limit=60)
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-            for category in speedler_data.urls:
-                if len(category_selected) > 0 and category not in category_selected:
-                    continue
-                elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
-                    continue
-
-                url = speedler_data.urls[category].get("url", "")
-                category_code = re.findall("\d+", url, re.IGNORECASE)[0]
-
-                BODY["url"] = url
-                BODY["page[url]"] = url
-                BODY["options[value]"] = category_code
-                BODY["options[params]"] = category_code
-
-                # HEADERS["Content-Length"] = speedler_data.urls[category].get("Content-Length", "")
-                update_products = await download_data(logger, session, URL, category)
-                database_handler.process_data(logger, update_products)
-
-                wait_time = random.randint(500, 3000) / 1000
-                time.sleep(wait_time)
+def category_body(url):
+    category_code = re.findall("\d+", url, re.IGNORECASE)[0]
 
-    except asyncio.exceptions.TimeoutError:
-        logger.error(error.TIMEOUT_ERROR)
+    body = dict(BODY)
+    body["url"] = url
+    body["page[url]"] = url
+    body["options[value]"] = category_code
+    body["options[params]"] = category_code
+    return body
+
+
+async def main(logger, category_selected=[]):
+    categories = []
+    for category in speedler_data.urls:
+        if len(category_selected) > 0 and category not in category_selected:
+            continue
+        elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
+            continue
+        categories.append(category)
+
+    conn = aiohttp.TCPConnector(limit=60)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS) as session:
+        results = await tasks.gather_limited(
+            PARALLEL_CATEGORIES,
+            [download_data(logger, session, URL, category, category_body(speedler_data.urls[category].get("url", ""))) for category in categories],
+            return_exceptions=True,
+        )
+
+    database_handler.process_data(logger, tasks.flatten(tasks.drop_exceptions(logger, results)))
@@ -1,15 +1,16 @@
-import random
-import time
+import asyncio
 
 import aiohttp
 import lxml.html
 import ujson
 
+import app.common.rate_limiter as rate_limiter
+import app.common.shop_codes as shop_codes
+import app.common.shops.selectors.vsgamers as vsgamers_selectors
 import app.common.shops.urls.vsgamers as vsgamers_data
-import app.database_functions as database_functions
+import app.common.tasks as tasks
 import app.scripts.stock.database_handler as database_handler
 import app.shared.auxiliary.inputs as auxiliary_inputs
-import app.shared.auxiliary.requests_handler as requests_handler
 import app.shared.error_messages as error
 import app.shared.regex.product as regex_product
 import app.shared.valid_messages as valid
@@ -17,6 +18,7 @@ from app.shared.auxiliary.functions import parse_number
 
 SHOP = "Versus Gamers"
 WEB = "https://www.vsgamers.es"
+PARALLEL_CATEGORIES = 3
 
 HEADERS = {
     "Accept-Encoding": "gzip, deflate",
@@ -30,17 +32,16 @@ HEADERS = {
 
 async def scrape_data(logger, response, category):
     shop_id = 12
-    vsgamers_db_data = database_functions.perform_select_availabilities(
-        search_params={"shop_id": shop_id}, select_params={"code"}, distinct=True, as_dict=True, data_askey=True, key="code"
-    )
+    vsgamers_db_data = shop_codes.get_codes(shop_id)
 
-    elements = response.xpath("(//div[@class='vs-product-card'])")
+    elements = vsgamers_selectors.XPATHS["products"](response)
     update_products = []
+    new_availabilities = []
 
     contador = 0
     for element in elements:
         try:
-            product = element.xpath("(./@data-info)")[0]
+            product = vsgamers_selectors.XPATHS["data_info"](element)[0]
             product = ujson.loads(product)
             contador += 1
         except:
@@ -53,16 +54,16 @@ async def scrape_data(logger, response, category):
             logger.warning(f"Sin code {code}")
             continue
 
-        price = element.xpath("(.//span[@class='vs-product-card-prices-price'])/@data-price")
+        price = vsgamers_selectors.XPATHS["price"](element)
         if not price:
             logger.warning(f"Sin precio {code - {price}}")
             continue
 
         price = parse_number(round(float(price[0]), 2))
 
-        stock = True if element.xpath("(.//button[@type='button'])") else False
+        stock = True if vsgamers_selectors.XPATHS["stock"](element) else False
 
-        url = element.xpath("(.//div[@class='vs-product-card-title']//a/@href)")
+        url = vsgamers_selectors.XPATHS["url"](element)
         if not url:
             logger.warning(error.URL_NOT_FOUND)
             continue
@@ -73,7 +74,7 @@ async def scrape_data(logger, response, category):
             logger.warning(error.PRODUCT_NAME_NOT_FOUND)
             continue
 
-        second_name = element.xpath("(.//div[@class='vs-product-card-title']//a/@title)")
+        second_name = vsgamers_selectors.XPATHS["second_name"](element)
         if second_name:
             second_name = second_name[0]
         else:
@@ -97,7 +98,7 @@ async def scrape_data(logger, response, category):
             "second_name": second_name,
             "part_number": part_number,
         }
-        shop_data = {"shop_name": SHOP, "shop_db_data": vsgamers_db_data, "shop_id": shop_id}
+        shop_data = {"shop_name": SHOP, "shop_db_data": vsgamers_db_data, "shop_id": shop_id, "new_availabilities": new_availabilities}
 
         if category == "CPU Cooler" or category == "Chassis":
             result, product_tuple = database_handler.add_product(logger, shop_data, json_product)
@@ -109,11 +110,18 @@ async def scrape_data(logger, response, category):
         update_products.append(product_tuple)
         continue
 
+    database_handler.register_new_availabilities(logger, SHOP, new_availabilities)
+
     return update_products
 
 
 async def download_data(logger, session, url, category, proxy=None):
-    response = await requests_handler.get(logger, session, url)
+    try:
+        response = await rate_limiter.get(logger, session, url)
+    except asyncio.exceptions.TimeoutError:
+        logger.error(error.TIMEOUT_ERROR)
+        return False
+
     if not response:
         return False
 
@@ -123,24 +131,24 @@ async def download_data(logger, session, url, category, proxy=None):
         logger.error(error.parse_html(url))
         return False
 
+    logger.info(valid.url_successful(url))
     return await scrape_data(logger, response, category)
 
 
 async def main(logger, category_selected=[]):
+    categories = []
+    for category in vsgamers_data.urls:
+        if len(category_selected) > 0 and category not in category_selected:
+            continue
+        elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
+            continue
+        categories.append(category)
+
     conn = aiohttp.TCPConnector(limit=60)
     timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=conn, timeout=timeout, headers=HEADERS) as session:
-        for category in vsgamers_data.urls:
-            if len(category_selected) > 0 and category not in category_selected:
-                continue
-            elif (category == "GPU" or category == "CPU") and len(category_selected) == 0:
-                continue
-
-            url = vsgamers_data.urls[category]
-            update_products = await download_data(logger, session, url, category)
-            logger.info(valid.url_successful(url))
-
-            database_handler.process_data(logger, update_products)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=[rate_limiter.trace_config()], headers=HEADERS) as session:
+        results = await tasks.gather_limited(
+            PARALLEL_CATEGORIES, [download_data(logger, session, vsgamers_data.urls[category], category) for category in categories], return_exceptions=True
+        )
 
-            wait_time = random.randint(500, 3000) / 1000
-            time.sleep(wait_time)
+    database_handler.process_data(logger, tasks.flatten(tasks.drop_exceptions(logger, results)))
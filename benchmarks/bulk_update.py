@@ -0,0 +1,76 @@
+import os
+import random
+import sys
+import time
+
+# Compara execute_values con COPY + tabla temporal en update_multiple_row_availabilities.
+# Necesita un Postgres local (variables POSGRESQL_*). Se trabaja en un esquema temporal que se borra al terminar.
+#   python3 -m benchmarks.bulk_update 500 5000 20000
+SCHEMA = "stockfinder_benchmark"
+os.environ["PGOPTIONS"] = f"-c search_path={SCHEMA}"
+
+import app.database_functions as database_functions  # noqa: E402
+
+COLUMNS = ["price", "stock", "code", "shop_id"]
+EQUAL_PARAMS = ["code", "shop_id"]
+SHOP_ID = 17
+REPEATS = 3
+
+
+def prepare(rows):
+    connection = database_functions.sql_connection()
+    with connection, connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+        cursor.execute(
+            f"CREATE TABLE {SCHEMA}.products_availabilities ("
+            "code integer, shop_id integer, price numeric(10, 2), stock boolean, updated_at timestamp DEFAULT NOW(), PRIMARY KEY (code, shop_id))"
+        )
+        cursor.execute(
+            f"INSERT INTO {SCHEMA}.products_availabilities (code, shop_id, price, stock) "
+            f"SELECT code, {SHOP_ID}, 100, true FROM generate_series(1, {rows}) AS code"
+        )
+    connection.close()
+
+
+def cleanup():
+    connection = database_functions.sql_connection()
+    with connection, connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    connection.close()
+
+
+def scraped_values(rows, changed_ratio=0.1):
+    values = []
+    for code in range(1, rows + 1):
+        price = round(random.uniform(50, 150), 2) if random.random() < changed_ratio else 100
+        values.append((price, True, code, SHOP_ID))
+    return values
+
+
+def run(rows, use_copy):
+    timings = []
+    for unused in range(REPEATS):
+        values = scraped_values(rows)
+        t0 = time.perf_counter()
+        result = database_functions.update_multiple_row_availabilities(COLUMNS, values, EQUAL_PARAMS, use_copy=use_copy)
+        timings.append(time.perf_counter() - t0)
+        if not result:
+            raise RuntimeError("update_multiple_row_availabilities ha fallado")
+    return min(timings)
+
+
+def main(sizes):
+    try:
+        for rows in sizes:
+            prepare(rows)
+            values_time = run(rows, use_copy=False)
+            copy_time = run(rows, use_copy=True)
+            print(f"rows: {rows:>7} - execute_values: {values_time * 1000:8.1f} ms - copy: {copy_time * 1000:8.1f} ms - ratio: {values_time / copy_time:5.2f}x")
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [500, 2000, 5000, 20000]
+    main(sizes)
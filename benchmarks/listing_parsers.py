@@ -0,0 +1,115 @@
+import sys
+import time
+
+import lxml.html
+
+import app.common.shops.selectors.coolmod as coolmod_selectors
+import app.common.shops.selectors.izarmicro as izarmicro_selectors
+import app.common.shops.selectors.ldlc as ldlc_selectors
+import app.common.shops.selectors.speedler as speedler_selectors
+import app.common.shops.selectors.vsgamers as vsgamers_selectors
+
+# Compara element.xpath("expresión") (se compila en cada llamada) con los XPath precompilados de app.common.shops.selectors
+# sobre listados sintéticos con la misma estructura que los de cada tienda. No hace peticiones.
+#   python3 -m benchmarks.listing_parsers 50 500
+REPEATS = 5
+
+PRODUCTS = {
+    "coolmod": (
+        "<div class='productInfo' id='productPROD-{i}' data-price='{i},99'>"
+        "<div class='productName'><div><div><a href='/producto-{i}'>Producto {i}</a></div></div></div>"
+        "<span class='stock on'>En stock</span></div>"
+    ),
+    "ldlc": (
+        "<li class='pdt-item'><h3 class='title-3'><a href='/fiche/PB{i}.html'>Producto {i}</a></h3>"
+        "<div class='pdt-desc'><p>Descripción {i}</p></div>"
+        "<div class='basket'><div><div>{i}€<sup>99</sup></div></div></div>"
+        "<div data-stock-web='1'></div></li>"
+    ),
+    "izarmicro": (
+        "<div class='divproportada2'><div class='plist_img2'><a href='/producto-{i}'><h2>Producto {i}</h2></a>"
+        "<span class='desport'>Nombre {i}</span><span class='mpntxt'>PN-{i}</span></div>"
+        "<div class='tdispo4'><div></div><div><span>{i},99 €</span></div></div>"
+        "<button class='compra2'>Comprar</button></div>"
+    ),
+    "speedler": (
+        "<div class='JS_product prod prodGrid2' sku='{i}' price='{i}.99' name='Producto {i}'>"
+        "<a class='JSproductName name' href='/producto-{i}'>Producto {i}</a>"
+        "<div class='side-loader'><span>En stock</span></div></div>"
+    ),
+    "vsgamers": (
+        "<div class='vs-product-card' data-info='{{\"id\": {i}}}'>"
+        "<span class='vs-product-card-prices-price' data-price='{i}.99'></span>"
+        "<div class='vs-product-card-title'><a href='/product/{i}' title='Producto {i}'>Producto {i}</a></div>"
+        "<button type='button'>Añadir</button></div>"
+    ),
+}
+WRAPPERS = {
+    "coolmod": "<div class='infiniteloadercontainer'><button data-page='2'></button></div>",
+    "ldlc": "<div class='listing-product'><ul>{products}</ul></div><ul><li class='next'><a data-page='2'></a></li></ul>",
+}
+SELECTORS = {
+    "coolmod": coolmod_selectors.XPATHS,
+    "ldlc": ldlc_selectors.XPATHS,
+    "izarmicro": izarmicro_selectors.XPATHS,
+    "speedler": speedler_selectors.XPATHS,
+    "vsgamers": vsgamers_selectors.XPATHS,
+}
+# Expresiones que se evalúan sobre el listado y no sobre cada producto
+LISTING_KEYS = {"products", "next_page_buttons", "next_page", "total_page"}
+
+
+def listing(shop, count):
+    products = "".join(PRODUCTS[shop].format(i=i) for i in range(1, count + 1))
+    wrapper = WRAPPERS.get(shop, "{products}")
+    if "{products}" not in wrapper:
+        wrapper = "{products}" + wrapper
+    return lxml.html.fromstring(f"<html><body>{wrapper.format(products=products)}</body></html>")
+
+
+def parse_strings(response, xpaths):
+    product_keys = [key for key in xpaths if key not in LISTING_KEYS]
+    found = 0
+    for product in response.xpath(xpaths["products"].path):
+        for key in product_keys:
+            product.xpath(xpaths[key].path)
+        found += 1
+    return found
+
+
+def parse_compiled(response, xpaths):
+    product_keys = [key for key in xpaths if key not in LISTING_KEYS]
+    found = 0
+    for product in xpaths["products"](response):
+        for key in product_keys:
+            xpaths[key](product)
+        found += 1
+    return found
+
+
+def run(parse, response, xpaths):
+    timings = []
+    for unused in range(REPEATS):
+        t0 = time.perf_counter()
+        found = parse(response, xpaths)
+        timings.append(time.perf_counter() - t0)
+    return found, min(timings)
+
+
+def main(sizes):
+    for count in sizes:
+        for shop, xpaths in SELECTORS.items():
+            response = listing(shop, count)
+            found, strings_time = run(parse_strings, response, xpaths)
+            compiled_found, compiled_time = run(parse_compiled, response, xpaths)
+            if found != count or compiled_found != count:
+                raise RuntimeError(f"{shop}: se esperaban {count} productos y se han encontrado {found} / {compiled_found}")
+            print(
+                f"{shop:>10} - productos: {count:>5} - xpath(): {count / strings_time:9.0f} prod/s - "
+                f"precompilado: {count / compiled_time:9.0f} prod/s - ratio: {strings_time / compiled_time:5.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [50, 500]
+    main(sizes)
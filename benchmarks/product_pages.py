@@ -0,0 +1,72 @@
+import multiprocessing
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import lxml.html
+
+import app.common.html_scan as html_scan
+
+# Compara lxml.html.fromstring de la página completa con html_scan.Page para sacar el JSON-LD y la galería
+# de una página de producto sintética (menú, listados relacionados y descripción de un tamaño parecido a las reales).
+# Cada modo se ejecuta en un proceso aparte para medir el pico de memoria.
+#   python3 -m benchmarks.product_pages 200
+PAGES = 200
+
+
+def product_page(extra_products=400):
+    related = "".join(
+        f"<div class='product-card'><a href='/p/{i}'><img src='/img/{i}.jpg'><span>Producto relacionado {i}</span></a>"
+        f"<div class='price'>{i},99 €</div></div>"
+        for i in range(extra_products)
+    )
+    menu = "".join(f"<li><a href='/categoria/{i}'>Categoría {i}</a></li>" for i in range(300))
+    gallery = "".join(f"<a href='https://cdn.example.com/{i}.jpg'><img src='/thumb/{i}.jpg'></a>" for i in range(6))
+    return (
+        "<html><head><title>Producto</title>"
+        "<script type='application/ld+json'>{\"@type\": \"Organization\"}</script>"
+        "<script type='application/ld+json'>{\"@type\": \"BreadcrumbList\"}</script>"
+        "<script type='application/ld+json'>{\"@type\": \"Product\", \"sku\": \"PROD-1\", \"name\": \"Producto\"}</script>"
+        f"</head><body><ul class='menu'>{menu}</ul><div class='w-100 productgallery'>{gallery}</div>"
+        f"<div class='productdetailinfocontainer smoothshadow'><ul><li>Dimensiones: 300 mm</li></ul></div>{related}</body></html>"
+    )
+
+
+def parse_document(html):
+    response = lxml.html.fromstring(html)
+    product_data = response.xpath("(//script[@type='application/ld+json'])[3]/text()")
+    images = response.xpath("//div[contains(@class,'w-100 productgallery')]//a/@href")
+    return product_data, images
+
+
+def parse_scan(html):
+    page = html_scan.Page(html)
+    product_data = page.scripts(type="application/ld+json")[2:3]
+    images = page.select("div", ".//a/@href", class_contains="w-100 productgallery")
+    return product_data, images
+
+
+def run(mode, pages):
+    parse = parse_document if mode == "dom" else parse_scan
+    html = product_page()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    for unused in range(pages):
+        product_data, images = parse(html)
+    elapsed = time.perf_counter() - t0
+    if not product_data or len(images) != 6:
+        raise RuntimeError(f"{mode}: no se han encontrado los datos del producto")
+    # ru_maxrss está en KB en Linux
+    return len(html), elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+
+
+def main(pages):
+    for mode in ("dom", "scan"):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            size, elapsed, peak = executor.submit(run, mode, pages).result()
+        print(f"{mode:>4} - página: {size // 1024} KB - {pages / elapsed:8.1f} páginas/s - pico de memoria: +{peak / 1024:6.1f} MB")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else PAGES)
@@ -3,10 +3,32 @@ import logging
 import random
 import sys
 
+import app.common.shop_codes as shop_codes
 import app.scripts.stock.stock_nvidia_api as stock_nvidia_api
 from startup_code import check_images, check_new_availabilities, check_stock
 
 SLEEP_TIME = 10  # Minutes
+LISTENER_RESTART = 60  # Seconds
+
+listener = None
+
+
+# Si la escucha falla se registra el error y se vuelve a arrancar; mientras tanto sigue el barrido periódico
+def start_listener(service_name, logger):
+    global listener
+
+    def on_done(task):
+        if task.cancelled():
+            return
+        # Sin error solo termina si la tienda no tiene dominios que escuchar
+        err = task.exception()
+        if err is None:
+            return
+        logger.error(f"La escucha de disponibilidades nuevas ha fallado, se reinicia en {LISTENER_RESTART} s", exc_info=err)
+        asyncio.get_running_loop().call_later(LISTENER_RESTART, start_listener, service_name, logger)
+
+    listener = asyncio.create_task(check_new_availabilities.listen(service_name=service_name, logger=logger))
+    listener.add_done_callback(on_done)
 
 
 async def main(service_name):
@@ -14,6 +36,10 @@ async def main(service_name):
     logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
     logger = logging.getLogger(service_name)
 
+    # Las disponibilidades que añaden los usuarios se procesan al momento, sin esperar al siguiente ciclo
+    if service_name != "nvidia":
+        start_listener(service_name, logger)
+
     counter = -1
     while True:
         logger.info(f"service_name {service_name} - counter {counter}")
@@ -23,6 +49,9 @@ async def main(service_name):
         
         category = ["GPU", "CPU", "Reaco"] if service_name == "Coolmod" else ["GPU", "CPU"]
 
+        # Los códigos de la tienda se cargan una vez por ciclo
+        shop_codes.reset()
+
         if counter == -1 or counter == 10:
             await check_images.start(service_name=service_name, logger=logger)
             await asyncio.sleep(random.randint(10, 30))
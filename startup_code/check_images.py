@@ -1,14 +1,14 @@
 import logging
-import os
-import typing
 from datetime import datetime
 
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.exceptions import InfluxDBError
-from influxdb_client.client.write_api import SYNCHRONOUS
-from sqlalchemy import and_
-from urllib3.exceptions import ReadTimeoutError
+from sqlalchemy import and_, func
 
+import app.common.html_scan as html_scan
+import app.common.image_manifest as image_manifest
+import app.common.images as images
+import app.common.metrics as metrics
+import app.common.page_stream as page_stream
+import app.common.shop_codes as shop_codes
 import app.scripts.product.product_aussar as aussar
 import app.scripts.product.product_casemod as casemod
 import app.scripts.product.product_coolmod as coolmod
@@ -17,7 +17,7 @@ import app.scripts.product.product_ldlc as ldlc
 import app.scripts.product.product_neobyte as neobyte
 import app.scripts.product.product_speedler as speedler
 import app.scripts.product.product_vsgamers as vsgamers
-import app.shared.environment_variables as ev
+from app.shared.environment_variables import IMAGE_BASE_DIR
 from app.stockfinder_models.Alert import Alert
 from app.stockfinder_models.Availability import Availability
 from app.stockfinder_models.base import Base, Session, engine
@@ -34,102 +34,114 @@ from app.stockfinder_models.TelegramChannel import TelegramChannel
 from app.stockfinder_models.User import User
 
 
-class BatchingCallback(object):
-    def __init__(self, logger):
-        self.logger = logger
+FOLDERS_CHUNK_SIZE = 1000
 
-    def success(self, conf: typing.Tuple[str, str, str], data: str):
-        self.logger.info(f"Written batch: {conf}, data: {data}")
 
-    def error(self, conf: typing.Tuple[str, str, str], data: str, exception: InfluxDBError):
-        self.logger.error(f"Cannot write batch: {conf}, data: {data} due: {exception}")
+# Misma ruta que IMAGE_SHOP_DIR en los scripts de producto: el manifiesto se guarda por ruta de tienda
+def get_shop_folder(service_name):
+    return f"{IMAGE_BASE_DIR}/{service_name.lower().replace('versus gamers', 'vsgamers')}"
 
-    def retry(self, conf: typing.Tuple[str, str, str], data: str, exception: InfluxDBError):
-        self.logger.warning(f"Retryable error occurs for batch: {conf}, data: {data} retry: {exception}")
 
-SHOPS_ID = {
-    'ldlc': 5,
-    'aussar': 2,
-    'coolmod': 3,
-    'neobyte': 7,
-    'casemod': 10,
-    'izarmicro': 4,
-    'vsgamers': 12,
-    'speedler': 17,
-}  
-SHOPS_ABSOLUTE_PATH = "/usr/src/StockFinderImages/shops"
+# Nombre de la carpeta de un part number, sin distinguir mayúsculas (como image_manifest.find_folder)
+def folder_key(part_number):
+    return str(part_number).replace("/", "_--_").lower()
+
+
+# Carpetas vacías por lotes, leídas del manifiesto de imágenes en vez de recorrer el volumen
+def iter_empty_folders(shop_folder, chunk_size=FOLDERS_CHUNK_SIZE):
+    folders = image_manifest.get_empty_folders(shop_folder)
+    for index in range(0, len(folders), chunk_size):
+        yield folders[index : index + chunk_size]
+
 
 def get_availabilities_with_empty_folders(service_name, logger):
     service_name = service_name.replace("versus gamers", "vsgamers")
     service_name = service_name.lower()
-    shop_id = SHOPS_ID.get(service_name, False)
+    shop_id = shop_codes.get_shop_id(service_name)
     if not shop_id:
         return None
-    
+
     availability_list = []
+    urls = set()
+    total_folders = 0
     session = Session()
-    part_numbers_folders = os.listdir(f"{SHOPS_ABSOLUTE_PATH}/{service_name}")
-    for folder in part_numbers_folders:
-        images = os.listdir(f"{SHOPS_ABSOLUTE_PATH}/{service_name}/{folder}")
-        if len(images) > 0:
-            continue
-        
-        product_part_number = folder.upper().replace("_--_", "/")
-
-        result = session.query(ProductPartNumber).filter(ProductPartNumber.part_number == product_part_number).first()
-        if not result:
-            logger.warning("part_number del producto no encontrado")
-            continue
-        product_id = result.product._id
-
-        availability_url = session.query(Availability.url).filter(and_(Availability.product_id == product_id, Availability.shop_id == shop_id )).first()
-        if not availability_url:
-            logger.warning("URL del producto no encontrada")
-            continue
-        availability_url = availability_url[0]
-
-        availability_list.append({"url": availability_url})
+    for folders in iter_empty_folders(get_shop_folder(service_name)):
+        total_folders += len(folders)
+        part_numbers = {folder.upper().replace("_--_", "/") for folder in folders}
+
+        results = (
+            session.query(ProductPartNumber.part_number, Availability.url)
+            .join(Availability, Availability.product_id == ProductPartNumber.product_id)
+            .filter(and_(Availability.shop_id == shop_id, ProductPartNumber.part_number.in_(part_numbers)))
+            .all()
+        )
+
+        found = set()
+        for part_number, url in results:
+            found.add(part_number)
+            if url in urls:
+                continue
+            urls.add(url)
+            availability_list.append({"url": url})
+
+        if len(found) != len(part_numbers):
+            logger.warning(f"part_number o URL del producto no encontrados: {part_numbers - found}")
 
     session.close()
     if len(availability_list) == 0:
         return None
 
-    logger.info(f"The shop {service_name} has a total of {len(availability_list)} empty folders")
+    logger.info(f"The shop {service_name} has a total of {total_folders} empty folders - {len(availability_list)} availabilities")
     return availability_list
 
-def get_availabilities_without_images(service_name, logger):
+
+# Solo se consultan las carpetas cambiadas desde la última comprobación ('changes'); con None se consultan todas
+def get_availabilities_without_images(service_name, logger, changes=None):
     service_name = service_name.lower().replace("versus gamers", "vsgamers")
-    shop_id = SHOPS_ID.get(service_name, False)
+    shop_id = shop_codes.get_shop_id(service_name)
     if not shop_id:
         return None
 
-    session = Session()
+    folders = image_manifest.get_folders(get_shop_folder(service_name))
+    if changes is not None:
+        folders = [folder for folder in changes if folder in folders]
+        if not folders:
+            logger.info(f"The shop {service_name} has no image folders changed since the last check")
+            return []
 
-    db_availabilities_with_no_images = (
-        session.query(Availability)
+    session = Session()
+    query = (
+        session.query(Availability.url, ProductPartNumber.part_number)
         .join(Product)
+        .join(ProductPartNumber, ProductPartNumber.product_id == Product._id)
         .filter(and_(Availability.shop_id == shop_id, Product.images == None))
-        .all()
     )
-
+    if changes is None:
+        batches = [query.yield_per(FOLDERS_CHUNK_SIZE)]
+    else:
+        batches = []
+        sql_folder_key = func.lower(func.replace(ProductPartNumber.part_number, "/", "_--_"))
+        for index in range(0, len(folders), FOLDERS_CHUNK_SIZE):
+            chunk = folders[index : index + FOLDERS_CHUNK_SIZE]
+            batches.append(query.filter(sql_folder_key.in_({folder.lower() for folder in chunk})))
+
+    # Los dos caminos comparan igual el part number con las carpetas (en la consulta de los cambios ya viene filtrado)
+    folder_keys = {folder.lower() for folder in folders}
     availability_list = []
-    folders = os.listdir(f"{SHOPS_ABSOLUTE_PATH}/{service_name}")
-    for availability in db_availabilities_with_no_images:
-        dbPartNumbers = availability.product.product_part_numbers
-
-        for index in dbPartNumbers:
-            if index.part_number not in folders:
+    urls = set()
+    for batch in batches:
+        for url, part_number in batch:
+            if url in urls or folder_key(part_number) not in folder_keys:
                 continue
-            availability_list.append({"url": availability.url})
-            break
-        continue
-    
+            urls.add(url)
+            availability_list.append({"url": url})
+
     session.close()
 
     logger.info(f"The shop {service_name} has a total of {len(availability_list)} availabilities without images")
     return availability_list
 
-    
+
 async def download_images_for_each_shop(service_name, logger, empty_folders):
     shops_scripts = {
         "ldlc": {ldlc: "async"},
@@ -164,42 +176,60 @@ async def start(service_name, logger):
     t0 = datetime.now()
     logger.info(f"The Scrape of {service_name} for checking the images will start")
 
+    # Se recogen antes de descargar: lo que se descargue en esta pasada se comprueba en la siguiente
+    shop_folder = get_shop_folder(service_name)
+    await image_manifest.refresh_async(shop_folder)
+    changes = image_manifest.pop_changes(shop_folder)
+    logger.info(f"{'Todas las' if changes is None else len(changes)} carpetas de imágenes actualizadas desde la última comprobación")
+
     availability_list = get_availabilities_with_empty_folders(service_name, logger)
     if not availability_list:
         logger.info(f"Sin directorios vacíos {availability_list}")
     else:
         await download_images_for_each_shop(service_name, logger, availability_list)
 
-    availability_list = get_availabilities_without_images(service_name, logger)
+    availability_list = get_availabilities_without_images(service_name, logger, changes)
     if not availability_list:
         logger.info(f"No hay disponibilidades sin imagenes {availability_list}")
     else:
         await download_images_for_each_shop(service_name, logger, availability_list)
 
+    image_manifest.flush()
+
+    downloaded_bytes = 0
+    saved_bytes = 0
+    for shop, report in images.pop_report().items():
+        downloaded_bytes += report["bytes"]
+        saved_bytes += report["saved"]
+        logger.info(
+            f"Imágenes {shop}: {report['done']} conjuntos descargados ({report['unchanged']} sin cambios, 304, {report['reused']} ya convertidos), {report['failed']} fallidos - "
+            f"{round(report['bytes'] / 1024 / 1024, 1)} MB en {round(report['seconds'], 1)} s - "
+            f"{round(report['saved'] / 1024 / 1024, 1)} MB ahorrados - {round(report['deduped'] / 1024 / 1024, 1)} MB deduplicados"
+        )
+
+    pages = html_scan.pop_report()
+    if pages["pages"]:
+        logger.info(f"Páginas de producto: {pages['pages']} escaneadas - {pages['documents']} DOM completos - {pages['fragments']} fragmentos")
+
+    avoided_bytes = 0
+    for shop, report in page_stream.pop_report().items():
+        avoided_bytes += report["avoided"]
+        logger.info(
+            f"Páginas de {shop}: {report['aborted']}/{report['pages']} cortadas - {round(report['read'] / 1024 / 1024, 1)} MB leídos - "
+            f"{round(report['avoided'] / 1024 / 1024, 1)} MB sin descargar ({round(report['estimated'] / 1024 / 1024, 1)} MB estimados)"
+        )
+
     t1 = datetime.now()
     elapsed_time = float(round((t1 - t0).total_seconds() * 1000))
     logger.info(f"The Scrape of {service_name} for checking the images has finished - elapsed_time: {elapsed_time} ms")
 
     actual_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
 
-    client = InfluxDBClient(url=ev.INFLUXDB_URL, token=ev.INFLUXDB_TOKEN, org=ev.INFLUXDB_ORG)
-    callback = BatchingCallback(logger=logger)
-    write_api = client.write_api(write_options=SYNCHRONOUS, success_callback=callback.success, error_callback=callback.error, retry_callback=callback.retry)
-
-    try:
-        write_api.write(
-            bucket=ev.INFLUXDB_BUCKET,
-            record=[
-                {
-                    "measurement": "Images",
-                    "tags": {"service": f"Check Images {service_name}"},
-                    "fields": {"Elapsed time": elapsed_time},
-                    "time": actual_time,
-                }
-            ],
-        )
-
-    except ReadTimeoutError as error:
-        logger.error(f"ReadTimeoutError - Trace: {error}")
-        pass
-
+    metrics.write(
+        {
+            "measurement": "Images",
+            "tags": {"service": f"Check Images {service_name}"},
+            "fields": {"Elapsed time": elapsed_time, "Downloaded bytes": downloaded_bytes, "Saved bytes": saved_bytes, "Avoided page bytes": avoided_bytes},
+            "time": actual_time,
+        }
+    )
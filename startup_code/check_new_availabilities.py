@@ -1,13 +1,14 @@
+import asyncio
 import logging
-import typing
+import os
 from datetime import datetime
 
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.exceptions import InfluxDBError
-from influxdb_client.client.write_api import SYNCHRONOUS
-from sqlalchemy import and_
-from urllib3.exceptions import ReadTimeoutError
-
+import app.common.html_scan as html_scan
+import app.common.image_manifest as image_manifest
+import app.common.metrics as metrics
+import app.common.new_availabilities as new_availabilities
+import app.common.page_stream as page_stream
+import app.common.shop_codes as shop_codes
 import app.scripts.product.product_aussar as aussar
 import app.scripts.product.product_casemod as casemod
 import app.scripts.product.product_coolmod as coolmod
@@ -16,8 +17,6 @@ import app.scripts.product.product_ldlc as ldlc
 import app.scripts.product.product_neobyte as neobyte
 import app.scripts.product.product_speedler as speedler
 import app.scripts.product.product_vsgamers as vsgamers
-import app.shared.auxiliary.inputs as auxiliary_inputs
-import app.shared.environment_variables as ev
 import app.shared.error_messages as error_messages
 import app.shared.valid_messages as valid_messages
 from app.stockfinder_models.Alert import Alert
@@ -39,22 +38,13 @@ from app.stockfinder_models.Spec import Spec
 from app.stockfinder_models.TelegramChannel import TelegramChannel
 from app.stockfinder_models.User import User
 
+# Filas reclamadas por lote, corrutinas que vacían la cola a la vez y límite de lotes por corrutina en cada ciclo
+BATCH_SIZE = 5
+QUEUE_WORKERS = int(os.environ.get("NEW_AVAILABILITIES_WORKERS", "2"))
+MAX_BATCHES = 20
 
-class BatchingCallback(object):
-    def __init__(self, logger):
-        self.logger = logger
-
-    def success(self, conf: typing.Tuple[str, str, str], data: str):
-        self.logger.info(f"Written batch: {conf}, data: {data}")
-
-    def error(self, conf: typing.Tuple[str, str, str], data: str, exception: InfluxDBError):
-        self.logger.error(f"Cannot write batch: {conf}, data: {data} due: {exception}")
-
-    def retry(self, conf: typing.Tuple[str, str, str], data: str, exception: InfluxDBError):
-        self.logger.warning(f"Retryable error occurs for batch: {conf}, data: {data} retry: {exception}")
 
-
-async def check_availabilities(logger, service_name, channels):
+async def process_batch(logger, service_name, channels, max_products):
     shops_scripts = {
         "ldlc": {ldlc: "async"},
         "aussar": {aussar: "async"},
@@ -66,198 +56,203 @@ async def check_availabilities(logger, service_name, channels):
         "izarmicro": {izarmicro: "async"},
     }
 
-    # Limit 5 products for shop each run
-    max_products = 5
+    if service_name == "Versus Gamers":
+        service_name = "vsgamers"
+    shop_name = service_name.lower()
 
-    for unused in range(1):
-        if service_name == "Versus Gamers":
-            service_name = "vsgamers"
+    model = NewAvailabilityChannels if channels else NewAvailability
 
-        session = Session()
+    session = Session()
+    # El filtro por tienda, la disponibilidad existente y el límite se resuelven en una única consulta
+    availabilities_db = new_availabilities.claim_pending(session, model, shop_name, max_products)
 
-        if channels:
-            availabilities_db = (
-                session.query(NewAvailabilityChannels)
-                .filter(
-                    and_(
-                        NewAvailabilityChannels.processed == False,
-                        NewAvailabilityChannels.invalid == False,
-                        NewAvailabilityChannels.counter != 3,
-                    )
-                )
-                .all()
+    if not availabilities_db:
+        session.commit()
+        session.close()
+        return 0
+
+    claimed_ids = [availability._id for availability, unused in availabilities_db]
+    availabilities = {}
+    for availability, aval_result in availabilities_db:
+        availability_dict = availability.__dict__
+        if not channels and aval_result:
+            # Si la disponibilidad ya existiese, se añade la alerta al usuario
+            #
+            user_id = availability_dict["user_id"]
+            max_price = availability_dict["max_price"]
+            alert_by_email = availability_dict["alert_by_email"]
+            alert_by_telegram = availability_dict["alert_by_telegram"]
+            #
+            alert = Alert(
+                user_id=user_id,
+                availability=aval_result,
+                max_price=max_price,
+                alert_by_telegram=alert_by_telegram,
+                alert_by_email=alert_by_email,
             )
+            session.add(alert)
+            availability.processed = True
+            continue
+        elif aval_result:
+            logger.warning("La disponibilidad ya existe")
+            availability.processed = True
+            continue
 
-        else:
-            availabilities_db = (
-                session.query(NewAvailability)
-                .filter(
-                    and_(
-                        NewAvailability.processed == False,
-                        NewAvailability.invalid == False,
-                        NewAvailability.counter != 3,
-                    )
-                )
-                .all()
-            )
+        if not availabilities.get(shop_name, None):
+            availabilities[shop_name] = []
 
-        if not availabilities_db:
-            session.close()
-            break
+        if channels:
+            temp_dict = {
+                "_id": availability_dict["_id"],
+                "url": availability_dict["url"],
+                "counter": availability_dict["counter"],
+            }
+        else:
+            temp_dict = {
+                "_id": availability_dict["_id"],
+                "url": availability_dict["url"],
+                "user_id": availability_dict["user_id"],
+                "counter": availability_dict["counter"],
+                "max_price": availability_dict["max_price"],
+                "alert_by_email": availability_dict["alert_by_email"],
+                "alert_by_telegram": availability_dict["alert_by_telegram"],
+            }
+
+        availabilities[shop_name].append(temp_dict)
+
+    session.commit()
+    if not availabilities:
+        new_availabilities.release_finished(session, model, claimed_ids)
+        session.commit()
+        session.close()
+        return len(availabilities_db)
 
-        availabilities = {}
-        for availability in availabilities_db:
-            availability_dict = availability.__dict__
-            shop_name = auxiliary_inputs.get_shop_from_url(availability_dict["url"])
-            if shop_name == "Unknown":
-                availability.processed = True
-            elif shop_name == service_name.lower():
-                aval_result = session.query(Availability).filter(Availability.url == availability_dict["url"]).first()
-                if not channels and aval_result:
-                    # Si la disponibilidad ya existiese, se añade la alerta al usuario
-                    #
-                    user_id = availability_dict["user_id"]
-                    max_price = availability_dict["max_price"]
-                    alert_by_email = availability_dict["alert_by_email"]
-                    alert_by_telegram = availability_dict["alert_by_telegram"]
-                    #
-                    alert = Alert(
-                        user_id=user_id,
-                        availability=aval_result,
-                        max_price=max_price,
-                        alert_by_telegram=alert_by_telegram,
-                        alert_by_email=alert_by_email,
-                    )
-                    session.add(alert)
-                    availability.processed = True
-                    continue
-                elif aval_result:
-                    logger.warning("La disponibilidad ya existe")
-                    availability.processed = True
-                    continue
+    for shop in availabilities:
+        module = shops_scripts.get(shop, {})
+        script = list(module.keys())[0]
+        type_func = list(module.values())[0]
 
-                if not availabilities.get(shop_name, None):
-                    availabilities[shop_name] = []
+        if type_func == "sync":
+            data = script.main(logger, availabilities[shop])
+        elif type_func == "async":
+            data = await script.main(logger, availabilities[shop])
+        else:
+            break
 
-                if len(availabilities[shop_name]) == max_products:
-                    break
+        if len(data) == 0:
+            continue
+        for product in data:
+            logger.warning(product)
+
+            if channels:
+                result = product.get("result", {})
+                counter = int(product["counter"]) + 1
+                new_avai_chan_id = int(product["_id"])
+                #
+                row_data = {
+                    "counter": counter,
+                    "name": result.get("name", None),
+                    "code": result.get("code", None),
+                    "category": result.get("category", None),
+                    "part_number": result.get("part_number", None),
+                    "manufacturer": result.get("manufacturer", None),
+                }
+                #
+                error_flag = result.get("error", False)
+                if error_flag == False:
+                    row_data["processed"] = True
+                    shop_codes.add_code(shop_codes.get_shop_id(shop), result.get("code", None))
+
+                elif result.get("error_message", None) == error_messages.SPECS_NOT_FOUND or counter == 3:
+                    row_data["invalid"] = True
+                    row_data["error_message"] = result.get("error_message", None)
+
+                session.query(NewAvailabilityChannels).filter(NewAvailabilityChannels._id == new_avai_chan_id).update(row_data, synchronize_session=False)
+                session.commit()
+                continue
 
-                if channels:
-                    temp_dict = {
-                        "_id": availability_dict["_id"],
-                        "url": availability_dict["url"],
-                        "counter": availability_dict["counter"],
-                    }
-                else:
-                    temp_dict = {
-                        "_id": availability_dict["_id"],
-                        "url": availability_dict["url"],
-                        "user_id": availability_dict["user_id"],
-                        "counter": availability_dict["counter"],
-                        "max_price": availability_dict["max_price"],
-                        "alert_by_email": availability_dict["alert_by_email"],
-                        "alert_by_telegram": availability_dict["alert_by_telegram"],
+            else:
+                url = product["url"]
+                user_id = product["user_id"]
+                max_price = product["max_price"]
+                new_avai_id = int(product["_id"])
+                counter = int(product["counter"]) + 1
+                alert_by_email = product["alert_by_email"]
+                alert_by_telegram = product["alert_by_telegram"]
+
+                success = product.get("result", False)
+                #
+                if success != True:
+                    table_update = {
+                        "counter": counter,
+                        "invalid": True if counter == 3 else False,
                     }
 
-                availabilities[shop_name].append(temp_dict)
+                    session.query(NewAvailability).filter(NewAvailability._id == new_avai_id).update(table_update, synchronize_session=False)
+                    session.commit()
+                    continue
+                #
+                availability = session.query(Availability).filter(Availability.url == url).first()
+                alert = Alert(
+                    user_id=user_id,
+                    availability=availability,
+                    max_price=max_price,
+                    alert_by_telegram=alert_by_telegram,
+                    alert_by_email=alert_by_email,
+                )
 
-            else:
+                session.add(alert)
+                session.query(NewAvailability).filter(NewAvailability._id == new_avai_id).update(
+                    {"counter": counter, "processed": True},
+                    synchronize_session=False,
+                )
+                session.commit()
                 continue
 
-        session.commit()
-        if not availabilities:
-            session.close()
-            break
+    new_availabilities.release_finished(session, model, claimed_ids)
+    session.commit()
+    session.close()
+    return len(availabilities_db)
 
-        for shop in availabilities:
-            module = shops_scripts.get(shop, {})
-            script = list(module.keys())[0]
-            type_func = list(module.values())[0]
 
-            if type_func == "sync":
-                data = script.main(logger, availabilities[shop])
-            elif type_func == "async":
-                data = await script.main(logger, availabilities[shop])
-            else:
+async def check_availabilities(logger, service_name, channels):
+    model = NewAvailabilityChannels if channels else NewAvailability
+    new_availabilities.ensure_schema([NewAvailability, NewAvailabilityChannels])
+
+    session = Session()
+    new_availabilities.discard_unknown(session, model)
+    new_availabilities.purge_expired(session)
+    session.commit()
+    session.close()
+
+    # Cada corrutina reclama lotes hasta vaciar la cola de la tienda. Las leases evitan que dos procesen la misma fila
+    async def drain():
+        claimed = 0
+        for unused in range(MAX_BATCHES):
+            batch = await process_batch(logger, service_name, channels, BATCH_SIZE)
+            if not batch:
                 break
+            claimed += batch
+        return claimed
 
-            if len(data) == 0:
-                continue
-            for product in data:
-                logger.warning(product)
-
-                if channels:
-                    result = product.get("result", {})
-                    counter = int(product["counter"]) + 1
-                    new_avai_chan_id = int(product["_id"])
-                    #
-                    row_data = {
-                        "counter": counter,
-                        "name": result.get("name", None),
-                        "code": result.get("code", None),
-                        "category": result.get("category", None),
-                        "part_number": result.get("part_number", None),
-                        "manufacturer": result.get("manufacturer", None),
-                    }
-                    #
-                    error_flag = result.get("error", False)
-                    if error_flag == False:
-                        row_data["processed"] = True
+    claimed = sum(await asyncio.gather(*[drain() for unused in range(QUEUE_WORKERS)]))
+    logger.info(f"{claimed} disponibilidades nuevas procesadas ({'canales' if channels else 'usuarios'})")
+    return None
 
-                    elif result.get("error_message", None) == error_messages.SPECS_NOT_FOUND or counter == 3:
-                        row_data["invalid"] = True
-                        row_data["error_message"] = result.get("error_message", None)
 
-                    session.query(NewAvailabilityChannels).filter(NewAvailabilityChannels._id == new_avai_chan_id).update(row_data, synchronize_session=False)
-                    session.commit()
-                    continue
+# Procesa las disponibilidades de los usuarios en cuanto se insertan (LISTEN/NOTIFY). start() sigue haciendo el barrido periódico
+async def listen(service_name, logger):
+    async def on_notify():
+        await check_availabilities(logger, service_name, channels=False)
 
-                else:
-                    url = product["url"]
-                    user_id = product["user_id"]
-                    max_price = product["max_price"]
-                    new_avai_id = int(product["_id"])
-                    counter = int(product["counter"]) + 1
-                    alert_by_email = product["alert_by_email"]
-                    alert_by_telegram = product["alert_by_telegram"]
-
-                    success = product.get("result", False)
-                    #
-                    if success != True:
-                        table_update = {
-                            "counter": counter,
-                            "invalid": True if counter == 3 else False,
-                        }
-
-                        session.query(NewAvailability).filter(NewAvailability._id == new_avai_id).update(table_update, synchronize_session=False)
-                        session.commit()
-                        continue
-                    #
-                    availability = session.query(Availability).filter(Availability.url == url).first()
-                    alert = Alert(
-                        user_id=user_id,
-                        availability=availability,
-                        max_price=max_price,
-                        alert_by_telegram=alert_by_telegram,
-                        alert_by_email=alert_by_email,
-                    )
-
-                    session.add(alert)
-                    session.query(NewAvailability).filter(NewAvailability._id == new_avai_id).update(
-                        {"counter": counter, "processed": True},
-                        synchronize_session=False,
-                    )
-                    session.commit()
-                    continue
+    await new_availabilities.listen(logger, NewAvailability, service_name, on_notify)
 
-        session.close()
 
-    return None
+# COLISION
+# Las leases evitan que dos procesos (o dos corrutinas) reclamen la misma fila
+# Puede haber varias filas para una misma disponibilidad: en el usuario comprobamos nuevamente si la disponibilidad existe
 
 
-# COLISION
-# Puede haber duplicidades de entradas para una misma disponibilidad
-# En el usuario comprobamos nuevamente si la disponibilidad existe
 async def start(service_name, logger=None):
     if not logger:
         logger = logging.getLogger(__name__)
@@ -269,6 +264,19 @@ async def start(service_name, logger=None):
 
     await check_availabilities(logger, service_name, channels=True)
     await check_availabilities(logger, service_name, channels=False)
+    image_manifest.flush()
+
+    pages = html_scan.pop_report()
+    if pages["pages"]:
+        logger.info(f"Páginas de producto: {pages['pages']} escaneadas - {pages['documents']} DOM completos - {pages['fragments']} fragmentos")
+
+    avoided_bytes = 0
+    for shop, report in page_stream.pop_report().items():
+        avoided_bytes += report["avoided"]
+        logger.info(
+            f"Páginas de {shop}: {report['aborted']}/{report['pages']} cortadas - {round(report['read'] / 1024 / 1024, 1)} MB leídos - "
+            f"{round(report['avoided'] / 1024 / 1024, 1)} MB sin descargar ({round(report['estimated'] / 1024 / 1024, 1)} MB estimados)"
+        )
 
     t1 = datetime.now()
     elapsed_time = float(round((t1 - t0).total_seconds() * 1000))
@@ -276,23 +284,11 @@ async def start(service_name, logger=None):
 
     actual_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
 
-    client = InfluxDBClient(url=ev.INFLUXDB_URL, token=ev.INFLUXDB_TOKEN, org=ev.INFLUXDB_ORG)
-    callback = BatchingCallback(logger=logger)
-    write_api = client.write_api(write_options=SYNCHRONOUS, success_callback=callback.success, error_callback=callback.error, retry_callback=callback.retry)
-
-    try:
-        write_api.write(
-            bucket=ev.INFLUXDB_BUCKET,
-            record=[
-                {
-                    "measurement": "Availability",
-                    "tags": {"service": f"Check Availability {service_name}"},
-                    "fields": {"Elapsed time": elapsed_time},
-                    "time": actual_time,
-                }
-            ],
-        )
-
-    except ReadTimeoutError as error:
-        logger.error(f"ReadTimeoutError - Trace: {error}")
-        pass
+    metrics.write(
+        {
+            "measurement": "Availability",
+            "tags": {"service": f"Check Availability {service_name}"},
+            "fields": {"Elapsed time": elapsed_time, "Avoided page bytes": avoided_bytes},
+            "time": actual_time,
+        }
+    )
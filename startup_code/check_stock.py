@@ -1,12 +1,7 @@
-import os
-import typing
 from datetime import datetime
 
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.exceptions import InfluxDBError
-from influxdb_client.client.write_api import SYNCHRONOUS
-from urllib3.exceptions import ReadTimeoutError
-
+import app.common.metrics as metrics
+import app.common.rate_limiter as rate_limiter
 import app.scripts.stock.stock_aussar as stock_aussar
 import app.scripts.stock.stock_casemod as stock_casemod
 import app.scripts.stock.stock_coolmod as stock_coolmod
@@ -16,7 +11,6 @@ import app.scripts.stock.stock_neobyte as stock_neobyte
 import app.scripts.stock.stock_nvidia_api as stock_nvidia_api
 import app.scripts.stock.stock_speedler as stock_speedler
 import app.scripts.stock.stock_vsgamers as stock_vsgamers
-import app.shared.environment_variables as ev
 
 MODULES_DICT = {
     "Aussar": {"module": stock_aussar, "async": True},
@@ -31,20 +25,6 @@ MODULES_DICT = {
 }
 
 
-class BatchingCallback(object):
-    def __init__(self, logger):
-        self.logger = logger
-
-    def success(self, conf: typing.Tuple[str, str, str], data: str):
-        self.logger.info(f"Written batch: {conf}, data: {data}")
-
-    def error(self, conf: typing.Tuple[str, str, str], data: str, exception: InfluxDBError):
-        self.logger.error(f"Cannot write batch: {conf}, data: {data} due: {exception}")
-
-    def retry(self, conf: typing.Tuple[str, str, str], data: str, exception: InfluxDBError):
-        self.logger.warning(f"Retryable error occurs for batch: {conf}, data: {data} retry: {exception}")
-
-
 async def start(service_name, logger, category=[]):
     t0 = datetime.now()
     logger.info(f"The Scrape of {service_name} for checking the stock will start - category: {category}")
@@ -61,6 +41,10 @@ async def start(service_name, logger, category=[]):
     elapsed_time = float(round((t1 - t0).total_seconds() * 1000))
     logger.info(f"The Scrape of {service_name} has finished - elapsed_time: {elapsed_time} ms")
 
+    rate_limit_report = rate_limiter.pop_report()
+    throttled_time = float(round(sum(host["throttled"] for host in rate_limit_report.values()) * 1000))
+    logger.info(f"Rate limiter report: {rate_limit_report}")
+
     actual_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
 
     tag_name = f"Check Stock {service_name}"
@@ -68,22 +52,11 @@ async def start(service_name, logger, category=[]):
         for value in category:
             tag_name += f" {value}"
 
-    client = InfluxDBClient(url=ev.INFLUXDB_URL, token=ev.INFLUXDB_TOKEN, org=ev.INFLUXDB_ORG)
-    callback = BatchingCallback(logger=logger)
-    write_api = client.write_api(write_options=SYNCHRONOUS, success_callback=callback.success, error_callback=callback.error, retry_callback=callback.retry)
-
-    try:
-        write_api.write(
-            bucket=ev.INFLUXDB_BUCKET,
-            record=[
-                {
-                    "measurement": "Stock",
-                    "tags": {"service": tag_name},
-                    "fields": {"Elapsed time": elapsed_time},
-                    "time": actual_time,
-                }
-            ],
-        )
-    except ReadTimeoutError as error:
-        logger.error(f"ReadTimeoutError - Trace: {error}")
-        pass
+    metrics.write(
+        {
+            "measurement": "Stock",
+            "tags": {"service": tag_name},
+            "fields": {"Elapsed time": elapsed_time, "Throttled time": throttled_time},
+            "time": actual_time,
+        }
+    )